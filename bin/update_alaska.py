@@ -1,4 +1,5 @@
 import sys
+import logging
 import pytest
 
 sys.path.append('/tmp/pysnotel_0')
@@ -23,4 +24,5 @@ def main():
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=snotel.LOG_FORMAT)
     main()
\ No newline at end of file
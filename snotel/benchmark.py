@@ -0,0 +1,307 @@
+''' Benchmarks
+    ~~~~~~~~~~
+    Times and peak memory of the ingest, storage and analytics hot paths on a
+    synthetic network (synthetic.py), saved as JSON so runs can be compared
+    across versions.
+
+        python -m snotel.benchmark --stations 5 --years 2 --out bench.json
+        python -m snotel.benchmark --compare before.json bench.json
+
+    The runs use a temporary sqlite database and data path, the package
+    database is not touched.
+'''
+
+__author__ = 'nsteiner'
+
+import gc
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import pathlib
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from . import snotel
+from .snotel import Data, Station, session_scope
+from .framecache import FRAME_CACHE
+from .synthetic import SyntheticNetwork
+
+DAY_NIGHT = ('soil_day', 'soil_night', 'air_day', 'air_night', 'sd_day', 'sm_day', 'sm_night')
+
+
+'''
+Synthetic Setup
+~~~~~~~~~~~~~~~
+'''
+
+
+def _station(meta):
+    meta = dict(meta)
+    for key in ('elevation', 'latitude', 'longitude', 'stationDataTimeZone'):
+        meta[key] = float(meta[key])
+    return snotel.construct_station(meta)
+
+
+def _element(meta):
+    meta = dict(meta)
+    if 'heightDepth' in meta:
+        meta['heightDepth'] = SimpleNamespace(unitCd=meta['heightDepth']['unitCd'],
+                                              value=float(meta['heightDepth']['value']))
+    return snotel.construct_element(meta)
+
+
+def _data_result(data_):
+    """ getHourlyData-like response object """
+    values_ = [SimpleNamespace(**row) for row in data_['values']]
+    return SimpleNamespace(beginDate=data_['beginDate'], endDate=data_['endDate'],
+                           stationTriplet=data_['stationTriplet'], values=values_)
+
+
+class BenchmarkData(object):
+    """
+    Synthetic stations, elements and responses loaded into the package database.
+    """
+
+    def __init__(self, n_stations=5, years=2, elements=None):
+        kwargs = {} if elements is None else {'elements': elements}
+        self.network = SyntheticNetwork(n_stations, years=years, **kwargs)
+        self.elements = []
+        self.responses = {}
+
+    def __repr__(self):
+        return '<BenchmarkData: {}>'.format(self.network)
+
+    @property
+    def n_values(self):
+        return sum(len(result.values) for result in self.responses.values())
+
+    def setup(self):
+        snotel.metadata.create_all()
+        for station_triplet in self.network.station_list:
+            snotel.add_station(_station(self.network.station_meta(station_triplet)))
+            for element_meta in self.network.station_elements(station_triplet):
+                element = _element(element_meta)
+                self.elements.append(element)
+                self.responses[element.ElementTriplet] = _data_result(
+                    self.network.hourly_data(station_triplet, element.ElementCd, depth=element.HeightDepth))
+        snotel.write_transaction(lambda conn: snotel.replace_rows(conn, self.elements), op='benchmark')
+        return self
+
+    def stations(self):
+        """ fresh Station objects, nothing cached on them """
+        with session_scope() as session:
+            station_list = session.query(Station).filter(Station.StationTriplet.in_(self.network.station_list)).all()
+            session.expunge_all()
+        return station_list
+
+
+'''
+Benchmarks
+~~~~~~~~~~
+Each benchmark is fn(data) -> items processed, with an optional setup(data) run untimed before it.
+'''
+
+
+def bench_parse_data_values(data):
+    for element in data.elements:
+        snotel.parse_data_values(element, data.responses[element.ElementTriplet])
+    return data.n_values
+
+
+def bench_write_par(data):
+    for element in data.elements:
+        snotel.write_par(element, data.responses[element.ElementTriplet])
+    return data.n_values
+
+
+def _clear_data(data):
+    dtable = Data.__table__
+    snotel.write_transaction(lambda conn: conn.execute(
+        dtable.delete().where(dtable.c.StationTriplet.in_(data.network.station_list))), op='benchmark')
+
+
+def bench_add_data(data):
+    for element in data.elements:
+        snotel.add_data(snotel.parse_data_values(element, data.responses[element.ElementTriplet]))
+    return data.n_values
+
+
+def _set_dataframe(data_format):
+    def bench_set_dataframe(data):
+        for element in data.elements:
+            element.set_dataframe(data_format=data_format)
+        return data.n_values
+    return bench_set_dataframe
+
+
+def bench_get_raw_data_frame(data):
+    for station in data.stations():
+        station.get_raw_data_frame()
+    return data.n_values
+
+
+def bench_get_data_frame(data):
+    for station in data.stations():
+        station.get_data_frame(frequency='D', apply_filter=True, how='median')
+    return data.n_values
+
+
+def bench_day_night(data):
+    for station in data.stations():
+        for property_ in DAY_NIGHT:
+            getattr(station, property_)
+    return data.n_values
+
+
+def bench_freeze_stations(data):
+    from .freeze import freeze_stations
+    store_dir = tempfile.mkdtemp()
+    try:
+        freeze_stations(data.stations(), data_store=os.path.join(store_dir, 'benchmark.h5'))
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+    return len(data.network.station_list)
+
+
+# name: (fn, setup)
+BENCHMARKS = [
+    ('parse_data_values', bench_parse_data_values, None),
+    ('write_par', bench_write_par, None),
+    ('add_data', bench_add_data, _clear_data),
+    ('set_dataframe_par', _set_dataframe('par'), None),
+    ('set_dataframe_sql', _set_dataframe('sql'), None),
+    ('get_raw_data_frame', bench_get_raw_data_frame, None),
+    ('get_data_frame', bench_get_data_frame, None),
+    ('day_night', bench_day_night, None),
+    ('freeze_stations', bench_freeze_stations, None),
+]
+
+
+def _measure(fn, setup, data, repeat):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup(data)
+        # every run starts cold
+        FRAME_CACHE.clear()
+        gc.collect()
+        start_ = time.perf_counter()
+        n_items = fn(data)
+        times.append(time.perf_counter() - start_)
+    # memory on a separate run, tracemalloc slows the timed ones
+    if setup is not None:
+        setup(data)
+    FRAME_CACHE.clear()
+    gc.collect()
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': min(times), 'runs': times, 'peak_mb': peak / 1024. ** 2, 'items': n_items,
+            'items_per_second': n_items / min(times) if min(times) else None}
+
+
+def _version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=str(snotel._PATH),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(n_stations=5, years=2, repeat=3, names=None, out=None):
+    """
+    :param names: subset of BENCHMARKS to run, all if None
+    :param out: optional json file for the results
+    :return: results dictionary
+    """
+    engine_str, dat_path = snotel.engine_str, snotel._DAT_PATH
+    bench_dir = pathlib.Path(tempfile.mkdtemp(prefix='snotel_benchmark_'))
+    try:
+        snotel.set_engine('sqlite:///{}'.format(bench_dir / 'benchmark.sqlite'))
+        snotel._DAT_PATH = bench_dir / 'dat'
+        results = _run(n_stations, years, repeat, names)
+    finally:
+        snotel.set_engine(engine_str)
+        snotel._DAT_PATH = dat_path
+        FRAME_CACHE.clear()
+        shutil.rmtree(bench_dir, ignore_errors=True)
+    if out:
+        with open(out, 'w') as out_file:
+            json.dump(results, out_file, indent=1)
+    return results
+
+
+def _run(n_stations, years, repeat, names):
+    data = BenchmarkData(n_stations=n_stations, years=years).setup()
+    results = {'meta': {'version': _version(), 'time': datetime.datetime.utcnow().isoformat(),
+                        'host': socket.gethostname(), 'python': platform.python_version(),
+                        'pandas': pd.__version__, 'numpy': np.__version__,
+                        'stations': n_stations, 'years': years, 'elements': len(data.elements),
+                        'values': data.n_values, 'repeat': repeat},
+               'results': {}}
+    for name, fn, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        try:
+            results['results'][name] = _measure(fn, setup, data, repeat)
+        except Exception as e:
+            # e.g. freeze_stations without pytables, the run goes on
+            results['results'][name] = {'skipped': '{}: {}'.format(e.__class__.__name__, e)}
+        print('{:20s} {}'.format(name, format_result(results['results'][name])))
+    return results
+
+
+def format_result(result):
+    if 'skipped' in result:
+        return 'skipped: {}'.format(result['skipped'])
+    return '{seconds:9.3f} s {peak_mb:9.1f} MB peak {items_per_second:12.0f} items/s'.format(**result)
+
+
+def compare(before, after):
+    """
+    Print the speedup and memory change of every benchmark in two result files.
+    """
+    with open(before) as before_file, open(after) as after_file:
+        before_, after_ = json.load(before_file), json.load(after_file)
+    print('{:20s} {:>10s} {:>10s} {:>8s} {:>10s}'.format('', before_['meta']['version'], after_['meta']['version'],
+                                                        'speedup', 'memory'))
+    for name, result in after_['results'].items():
+        old_ = before_['results'].get(name)
+        if not old_ or 'skipped' in old_ or 'skipped' in result:
+            continue
+        print('{:20s} {:9.3f}s {:9.3f}s {:7.2f}x {:9.2f}x'.format(
+            name, old_['seconds'], result['seconds'], old_['seconds'] / result['seconds'],
+            result['peak_mb'] / old_['peak_mb'] if old_['peak_mb'] else float('nan')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pysnotel hot paths on synthetic data.')
+    parser.add_argument('--stations', type=int, default=5)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', default=None, help='benchmarks to run: {}'.format(
+        ' '.join(name for name, _, _ in BENCHMARKS)))
+    parser.add_argument('--out', default=None, help='json results file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), default=None)
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    run_benchmarks(n_stations=args.stations, years=args.years, repeat=args.repeat, names=args.only, out=args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+''' Response Cache
+    ~~~~~~~~~~~~~~
+    Content-addressed on-disk cache of AWDB responses, keyed by method and
+    normalized arguments, stored compressed.  Metadata methods are cached with
+    per-method TTLs; an entry past its TTL is still served while a background
+    refresh runs (stale-while-revalidate).  The cache directory is bounded in
+    bytes with least-recently-used eviction.
+
+    The cache also works as a record/replay layer:
+      * mode 'record' calls the service for every method and stores every response
+      * mode 'replay' answers every method from the cache only, a miss raises CacheMiss
+'''
+
+__author__ = 'nsteiner'
+
+import os
+import json
+import time
+import zlib
+import pickle
+import hashlib
+import logging
+import pathlib
+import threading
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600.
+# seconds, methods missing here are not cached in normal mode
+TTL = {
+    'getStations': DAY,
+    'getStationMetadata': 3 * DAY,
+    'getStationMetadataMultiple': 3 * DAY,
+    'getStationElements': DAY,
+    'getElements': 7 * DAY,
+}
+MAX_BYTES = 512 * 1024 ** 2
+MODES = ('normal', 'record', 'replay', 'off')
+
+
+class CacheMiss(KeyError):
+    """ Replay mode and the response was never recorded """
+
+
+def to_plain(obj):
+    """
+    suds objects -> picklable tree, rebuilt by from_plain.
+    """
+    if isinstance(obj, (list, tuple)):
+        return [to_plain(val) for val in obj]
+    if hasattr(obj, '__keylist__'):
+        return {'__suds__': obj.__class__.__name__, 'fields': [(key, to_plain(val)) for key, val in obj]}
+    if isinstance(obj, str):
+        return str(obj)
+    return obj
+
+
+def from_plain(obj):
+    if isinstance(obj, list):
+        return [from_plain(val) for val in obj]
+    if isinstance(obj, dict) and '__suds__' in obj:
+        from suds.sudsobject import Factory
+        return Factory.object(obj['__suds__'], dict((key, from_plain(val)) for key, val in obj['fields']))
+    return obj
+
+
+def cache_key(method, args, kwargs, scope=''):
+    normal_ = json.dumps({'scope': scope, 'method': method, 'args': list(args), 'kwargs': kwargs},
+                         sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(normal_.encode()).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    :param path: cache directory
+    :param ttl: {method: seconds}, methods cached in normal mode
+    :param stale: seconds past the TTL an entry is still served while it is refreshed
+    :param max_bytes: size bound of the cache directory
+    :param mode: one of MODES
+    """
+
+    def __init__(self, path, ttl=None, stale=None, max_bytes=MAX_BYTES, mode='normal'):
+        if mode not in MODES:
+            raise ValueError('Unknown cache mode {}, choose from {}'.format(mode, MODES))
+        self.path = pathlib.Path(path)
+        self.ttl = dict(TTL if ttl is None else ttl)
+        self.stale = stale
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._n_bytes = None
+
+    def __repr__(self):
+        return '<ResponseCache: {} {} hits={} misses={}>'.format(self.path, self.mode, self.hits, self.misses)
+
+    def _file(self, key):
+        return self.path / key[:2] / (key + '.pkl.z')
+
+    def _read(self, key):
+        """
+        :return: (created, response) or None
+        """
+        file_ = self._file(key)
+        try:
+            with open(file_, 'rb') as cache_file:
+                created, plain = pickle.loads(zlib.decompress(cache_file.read()))
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+            return None
+        # mtime is the last use, for LRU eviction
+        os.utime(file_, None)
+        return created, from_plain(plain)
+
+    def _write(self, key, response):
+        file_ = self._file(key)
+        file_.parent.mkdir(parents=True, exist_ok=True)
+        data_ = zlib.compress(pickle.dumps((time.time(), to_plain(response)), protocol=pickle.HIGHEST_PROTOCOL))
+        tmp_file = file_.with_suffix('.tmp{}'.format(threading.get_ident()))
+        with open(tmp_file, 'wb') as cache_file:
+            cache_file.write(data_)
+        os.replace(tmp_file, file_)
+        with self._lock:
+            if self._n_bytes is not None:
+                self._n_bytes += len(data_)
+        self.evict()
+
+    def size(self):
+        with self._lock:
+            if self._n_bytes is None:
+                self._n_bytes = sum(file_.stat().st_size for file_ in self.path.glob('*/*.pkl.z'))
+            return self._n_bytes
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits max_bytes.
+        """
+        if self.size() <= self.max_bytes:
+            return
+        entries = sorted((file_.stat().st_mtime, file_.stat().st_size, file_) for file_ in self.path.glob('*/*.pkl.z'))
+        n_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_ in entries:
+            if n_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                file_.unlink()
+            except OSError:
+                continue
+            n_bytes -= size
+        with self._lock:
+            self._n_bytes = n_bytes
+
+    def clear(self):
+        for file_ in self.path.glob('*/*.pkl.z'):
+            file_.unlink()
+        with self._lock:
+            self._n_bytes = 0
+
+    def _refresh(self, key, fetch):
+        try:
+            self._write(key, fetch())
+        except Exception as e:
+            logger.warning('Cache refresh failed, keeping stale entry: %s', e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def call(self, method, args, kwargs, fetch, scope=''):
+        """
+        :param fetch: fetch() -> response, the uncached call
+        :param scope: keeps responses of different services apart, e.g. the service url
+        :return: response
+        """
+        if self.mode == 'off' or (self.mode == 'normal' and method not in self.ttl):
+            return fetch()
+        key = cache_key(method, args, kwargs, scope=scope)
+        if self.mode == 'record':
+            response = fetch()
+            self._write(key, response)
+            return response
+        entry = self._read(key)
+        if self.mode == 'replay':
+            if entry is None:
+                raise CacheMiss('{} {} {} not recorded'.format(method, args, kwargs))
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            created, response = entry
+            age = time.time() - created
+            ttl = self.ttl[method]
+            stale = ttl if self.stale is None else self.stale
+            if age <= ttl:
+                self.hits += 1
+                return response
+            if age <= ttl + stale:
+                self.stale_hits += 1
+                with self._lock:
+                    start_refresh = key not in self._refreshing
+                    self._refreshing.add(key)
+                if start_refresh:
+                    threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+                return response
+        self.misses += 1
+        try:
+            response = fetch()
+        except Exception:
+            if entry is not None:
+                logger.warning('%s failed, serving expired cache entry', method)
+                return entry[1]
+            raise
+        self._write(key, response)
+        return response
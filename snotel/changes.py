@@ -0,0 +1,164 @@
+''' Change Feed
+    ~~~~~~~~~~~
+    Every stored response appends a row to the change table: element triplet,
+    time window (local and UTC), row count and content hash.  The row is written
+    in the same transaction as the element LocalBeginDate/LocalEndDate
+    bookkeeping (snotel.commit_element_update), so the feed and the element
+    table never disagree.  Writers of change rows hold a lock until they commit
+    (snotel.lock_change_feed), so offsets become visible in order even with
+    concurrent writers on postgres, and `Offset > since` never skips a row.
+
+    Consumers pull changes after their last offset and read only the changed
+    windows:
+
+        cursor = ChangeCursor('rollups')     # named cursors keep their offset in the database
+        for change in cursor.poll():
+            data_frame = read_change(change)
+            ...
+        cursor.commit()                      # at-least-once: commit after processing
+'''
+
+__author__ = 'nsteiner'
+
+import logging
+import datetime
+
+from sqlalchemy import types, Column, func
+
+from . import snotel
+from .snotel import Base, Change, Element, session_scope
+
+logger = logging.getLogger(__name__)
+
+CHANGE_BATCH = 1000
+
+
+class ChangeCursorRow(Base):
+    """ Committed offset of a named consumer """
+
+    __tablename__ = 'change_cursor'
+    Name = Column(types.String, primary_key=True)
+    Offset = Column(types.Integer)
+    UpdatedAt = Column(types.DateTime)  # UTC
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+
+def _ensure_tables():
+    snotel._ensure_change_table()
+    ChangeCursorRow.__table__.create(snotel.ee, checkfirst=True)
+
+
+def latest_offset():
+    """
+    :return: offset of the newest change, 0 if the feed is empty
+    """
+    _ensure_tables()
+    with session_scope() as session:
+        return session.query(func.max(Change.Offset)).scalar() or 0
+
+
+def get_changes(since=0, limit=CHANGE_BATCH, element_triplets=None, station_triplets=None, element_cd=None):
+    """
+    :param since: last processed offset, changes after it are returned
+    :param element_cd: element code(s), matched on the element triplet
+    :return: Change rows ordered by offset
+    """
+    _ensure_tables()
+    with session_scope() as session:
+        query = session.query(Change).filter(Change.Offset > since)
+        if element_triplets is not None:
+            query = query.filter(Change.ElementTriplet.in_(list(element_triplets)))
+        if station_triplets is not None:
+            query = query.filter(Change.StationTriplet.in_(list(station_triplets)))
+        if element_cd is not None:
+            codes = [element_cd] if isinstance(element_cd, str) else element_cd
+            query = query.filter(snotel.or_(*[Change.ElementTriplet.like('%:{}:%'.format(code)) for code in codes]))
+        change_list = query.order_by(Change.Offset).limit(limit).all()
+        session.expunge_all()
+    return change_list
+
+
+def read_change(change, data_format=None):
+    """
+    :param data_format: 'par' or 'sql', the format the change was stored in if None
+    :return: element frame (value, flag) of the changed window, indexed by UTC ns
+    """
+    from .export import read_element_window
+    with session_scope() as session:
+        element = session.query(Element).filter(Element.ElementTriplet == change.ElementTriplet).first()
+        session.expunge_all()
+    if element is None:
+        return None
+    return read_element_window(element, change.BeginUTC, change.EndUTC + 1,
+                               data_format=data_format or change.DataFormat or 'par')
+
+
+class ChangeCursor(object):
+    """
+    :param name: consumer name; named cursors load and commit their offset in the change_cursor
+                 table, anonymous cursors start at `since`
+    :param since: starting offset, overrides the committed offset
+    :param filters: get_changes filters (element_triplets, station_triplets, element_cd)
+    """
+
+    def __init__(self, name=None, since=None, batch=CHANGE_BATCH, **filters):
+        self.name = name
+        self.batch = batch
+        self.filters = filters
+        if since is None:
+            since = self._load() if name else 0
+        self.offset = since
+        self._position = since
+
+    def __repr__(self):
+        return '<ChangeCursor: {} offset={}>'.format(self.name, self.offset)
+
+    def _load(self):
+        _ensure_tables()
+        with session_scope() as session:
+            row = session.query(ChangeCursorRow).filter(ChangeCursorRow.Name == self.name).first()
+            return row.Offset if row is not None else 0
+
+    def poll(self, limit=None):
+        """
+        :return: next changes after the read position (not committed until commit())
+        """
+        change_list = get_changes(self._position, limit=limit or self.batch, **self.filters)
+        if change_list:
+            self._position = change_list[-1].Offset
+        return change_list
+
+    def __iter__(self):
+        """ every pending change, batch by batch """
+        while True:
+            change_list = self.poll()
+            if not change_list:
+                return
+            for change in change_list:
+                yield change
+
+    def lag(self):
+        """
+        :return: changes in the feed after the committed offset
+        """
+        with session_scope() as session:
+            return session.query(func.count(Change.Offset)).filter(Change.Offset > self.offset).scalar()
+
+    def commit(self, offset=None):
+        """
+        Mark changes up to `offset` (the read position if None) as processed.
+        """
+        self.offset = self._position if offset is None else offset
+        self._position = max(self._position, self.offset)
+        if self.name:
+            _ensure_tables()
+            row = ChangeCursorRow(Name=self.name, Offset=self.offset, UpdatedAt=datetime.datetime.utcnow())
+            snotel.write_transaction(lambda conn: snotel.replace_rows(conn, [row]), op='change_cursor')
+        return self.offset
+
+    def rewind(self):
+        """ Read again from the committed offset, e.g. after a failed batch """
+        self._position = self.offset
@@ -0,0 +1,324 @@
+''' AWDB Client
+    ~~~~~~~~~~~
+    Wrapper around the suds SOAP client for the AWDB web service.  Calls keep the
+    suds form, client.service.getHourlyData(**request), and get:
+      * per-call timeouts sized to the requested volume
+      * a token-bucket rate limit shared by threads and processes (file lock)
+      * retries with exponential backoff and jitter on transport errors
+      * a circuit breaker that stops calls while the service is failing
+      * latency, outcome and payload size metrics (metrics.py)
+    The suds client is built lazily, one per thread, so importing the package
+    does not touch the network.
+'''
+
+__author__ = 'nsteiner'
+
+import os
+import json
+import time
+import socket
+import random
+import hashlib
+import logging
+import datetime
+import tempfile
+import threading
+import http.client
+import urllib.error
+
+try:
+    import fcntl
+except ImportError:  # no inter-process locking on windows, threads only
+    fcntl = None
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_BASE = 30.  # seconds
+TIMEOUT_PER_ROW = 0.002  # seconds per requested value
+TIMEOUT_MAX = 900.
+RATE = 4.  # requests per second
+BURST = 8
+RETRIES = 4
+BACKOFF = 2.  # seconds, first retry
+BACKOFF_MAX = 120.
+BREAKER_FAILURES = 5  # consecutive failed calls that open the breaker
+BREAKER_COOLDOWN = 300.  # seconds the breaker stays open
+BREAKER_POLL = 1.  # seconds between checks while a trial call is out
+
+RETRY_ERRORS = (socket.timeout, OSError, urllib.error.URLError, http.client.HTTPException)
+
+
+def _retry_errors():
+    try:
+        from suds.transport import TransportError
+    except ImportError:
+        return RETRY_ERRORS
+    return RETRY_ERRORS + (TransportError,)
+
+
+class CircuitOpenError(Exception):
+    """ The service is degraded, calls are paused """
+
+
+class TokenBucket(object):
+    """
+    Token bucket kept in a small state file so every process on the machine shares it.
+
+    :param rate: tokens added per second
+    :param burst: bucket size
+    :param path: state file, one per rate-limited service
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, path=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.path = path or os.path.join(tempfile.gettempdir(), 'snotel_bucket.json')
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """
+        :return: seconds to wait before a token is available, 0 if one was taken
+        """
+        with open(self.path, 'a+') as state_file:
+            if fcntl is not None:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    tokens, stamp = json.loads(state_file.read())
+                except ValueError:
+                    tokens, stamp = self.burst, time.time()
+                now = time.time()
+                tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+                wait_ = 0. if tokens >= 1. else (1. - tokens) / self.rate
+                if not wait_:
+                    tokens -= 1.
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps([tokens, now]))
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(state_file, fcntl.LOCK_UN)
+        return wait_
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                wait_ = self._take()
+            if not wait_:
+                return
+            time.sleep(wait_)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failures` consecutive failed calls, stays open for `cooldown` seconds, then lets
+    one trial caller through (half open) while the others keep waiting; a success closes it again,
+    a failure opens it for another cooldown.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.n_failures = 0
+        self.opened_at = None
+        self.trial = None  # thread of the trial caller
+        self.trial_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.open_for() > 0
+
+    def _open_for(self):
+        if self.opened_at is None or self.trial == threading.get_ident():
+            return 0.
+        now = time.time()
+        wait_ = self.opened_at + self.cooldown - now
+        if self.trial is not None:
+            # a trial that never reports back is replaced after a cooldown
+            wait_ = max(wait_, self.trial_at + self.cooldown - now)
+        return max(wait_, 0.)
+
+    def open_for(self):
+        """
+        :return: seconds until this caller may call, 0 when closed or it is the trial caller
+        """
+        with self._lock:
+            return self._open_for()
+
+    def _admit(self):
+        """
+        :return: seconds to wait, 0 if this caller may call; past the cooldown the first caller becomes the trial
+        """
+        with self._lock:
+            wait_ = self._open_for()
+            if not wait_ and self.opened_at is not None and self.trial != threading.get_ident():
+                logger.info('AWDB circuit half open, letting a trial call through')
+                self.trial, self.trial_at = threading.get_ident(), time.time()
+            return wait_
+
+    def wait(self):
+        """ Block while the breaker is open, used by schedulers to pause """
+        wait_ = self._admit()
+        if wait_:
+            logger.warning('AWDB circuit open, pausing %.0f s', wait_)
+        while wait_:
+            time.sleep(min(wait_, BREAKER_POLL) if self.trial is not None else wait_)
+            wait_ = self._admit()
+
+    def check(self):
+        wait_ = self._admit()
+        if wait_:
+            raise CircuitOpenError('AWDB circuit open for another {:.0f} s'.format(wait_))
+
+    def success(self):
+        with self._lock:
+            self.n_failures = 0
+            self.opened_at = None
+            self.trial = None
+
+    def failure(self):
+        with self._lock:
+            self.n_failures += 1
+            self.trial = None
+            if self.n_failures >= self.failures:
+                if self.opened_at is None or self.opened_at + self.cooldown < time.time():
+                    logger.error('AWDB circuit opened after %s failures', self.n_failures)
+                self.opened_at = time.time()
+
+
+def _parse_date(date_):
+    # getHourlyData takes 'YYYY-MM-DD HH:MM', getData date only 'YYYY-MM-DD'
+    date_ = str(date_)
+    if len(date_) >= 16:
+        return datetime.datetime.strptime(date_[:16], '%Y-%m-%d %H:%M')
+    return datetime.datetime.strptime(date_[:10], '%Y-%m-%d')
+
+
+def _hours(begin_date, end_date):
+    try:
+        begin_, end_ = _parse_date(begin_date), _parse_date(end_date)
+    except ValueError:
+        return 1.
+    return max((end_ - begin_).total_seconds() / 3600., 1.)
+
+
+def request_volume(method, args, kwargs):
+    """
+    Rough number of values a call returns, sizes the timeout.
+    """
+    triplets = kwargs.get('stationTriplets', args[0] if args else None)
+    n_stations = len(triplets) if isinstance(triplets, (list, tuple)) else 1
+    if 'beginDate' in kwargs and 'endDate' in kwargs:
+        hours = _hours(kwargs['beginDate'], kwargs['endDate'])
+        if method == 'getData':
+            hours /= 24.
+        return n_stations * hours
+    return n_stations * 100.
+
+
+def call_timeout(method, args, kwargs):
+    return min(TIMEOUT_BASE + request_volume(method, args, kwargs) * TIMEOUT_PER_ROW, TIMEOUT_MAX)
+
+
+def _payload_plugin(local):
+    """ suds plugin recording the size of every reply, labelled with the thread's current method """
+    from suds.plugin import MessagePlugin
+
+    class PayloadPlugin(MessagePlugin):
+        def received(self, context):
+            metrics.observe('awdb_payload_bytes', len(context.reply), method=getattr(local, 'method', None))
+
+    return PayloadPlugin()
+
+
+class _Service(object):
+    """ Stands in for suds client.service, every method call goes through AWDBClient.call """
+
+    def __init__(self, awdb_client):
+        self._client = awdb_client
+
+    def __getattr__(self, method):
+        def _method(*args, **kwargs):
+            return self._client.call(method, *args, **kwargs)
+        _method.__name__ = method
+        return _method
+
+
+class AWDBClient(object):
+    """
+    :param url: AWDB wsdl url
+    :param rate: requests per second for all processes sharing the bucket
+    :param retries: retries after the first attempt
+    :param cache: optional cache.ResponseCache in front of the service
+    """
+
+    def __init__(self, url, rate=RATE, burst=BURST, retries=RETRIES, backoff=BACKOFF,
+                 breaker_failures=BREAKER_FAILURES, breaker_cooldown=BREAKER_COOLDOWN, cache=None):
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.breaker = CircuitBreaker(failures=breaker_failures, cooldown=breaker_cooldown)
+        self.service = _Service(self)
+        self._retry_errors = _retry_errors()
+        self.set_url(url)
+
+    def __repr__(self):
+        return '<AWDBClient: {}>'.format(self.url)
+
+    def set_url(self, url):
+        """
+        Switch the service, e.g. to a local stand-in; clients are rebuilt and the rate limit is per url.
+        """
+        self.url = url
+        bucket_name = 'snotel_bucket_{}.json'.format(hashlib.md5(url.encode()).hexdigest()[:12])
+        self.bucket.path = os.path.join(tempfile.gettempdir(), bucket_name)
+        self.breaker.success()
+        self._local = threading.local()
+
+    @property
+    def suds_client(self):
+        if getattr(self._local, 'client', None) is None:
+            from suds.client import Client
+            self._local.client = Client(self.url, timeout=TIMEOUT_MAX, plugins=[_payload_plugin(self._local)])
+        return self._local.client
+
+    def call(self, method, *args, **kwargs):
+        """
+        Rate limited, retried call of an AWDB method, answered from the cache when possible.
+        """
+        if self.cache is not None:
+            return self.cache.call(method, args, kwargs, lambda: self._call(method, args, kwargs), scope=self.url)
+        return self._call(method, args, kwargs)
+
+    def _call(self, method, args, kwargs):
+        self.breaker.check()
+        timeout = call_timeout(method, args, kwargs)
+        attempt = 0
+        self._local.method = method
+        start_ = time.perf_counter()
+        while True:
+            self.bucket.acquire()
+            try:
+                suds_client = self.suds_client
+                suds_client.set_options(timeout=timeout)
+                result = getattr(suds_client.service, method)(*args, **kwargs)
+            except self._retry_errors as e:
+                self.breaker.failure()
+                if attempt >= self.retries or self.breaker.is_open:
+                    metrics.inc('awdb_requests_total', method=method, outcome='failed')
+                    raise
+                delay = min(self.backoff * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.5)
+                logger.warning('%s failed (%s), retry %s in %.1f s', method, e, attempt + 1, delay)
+                time.sleep(delay)
+                attempt += 1
+                metrics.inc('awdb_requests_total', method=method, outcome='retried')
+                continue
+            self.breaker.success()
+            metrics.observe('awdb_request_seconds', time.perf_counter() - start_, method=method)
+            metrics.inc('awdb_requests_total', method=method, outcome='ok')
+            return result
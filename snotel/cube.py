@@ -0,0 +1,309 @@
+''' Cube Store
+    ~~~~~~~~~~
+    Chunked, compressed N-D array of hourly data: (station, variable, depth, time).
+    Coordinates come from the station and element tables; data from the element
+    parquet/sql storage.  Chunks are zlib-compressed float32 blocks, one file per
+    (variable, depth, station chunk, time chunk), described by cube.json, so a read
+    of one variable, year or region only opens the chunks it touches.  Chunks
+    that were never written (e.g. TOBS at a soil depth) read as NaN.
+
+        cube = CubeStore.create('ak_cube', Collection(state='AK'), begin=datetime.datetime(2000, 1, 1))
+        cube.build()
+        ...  # after updates
+        cube.append()
+        values, coords = cube.read(variables='STO', depths=-2., begin=datetime.datetime(2015, 1, 1),
+                                   end=datetime.datetime(2016, 1, 1), bbox=(-150., 60., -145., 65.))
+'''
+
+__author__ = 'nsteiner'
+
+import os
+import json
+import zlib
+import logging
+import datetime
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import snotel
+from .snotel import Element, Station, session_scope, NS_PER_HOUR
+from .units import NATIVE, check_unit_system, get_conversion, native_unit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIABLES = ('STO', 'SMS', 'TOBS', 'SNWD', 'WTEQ')
+STATION_CHUNK = 64
+TIME_CHUNK = 24 * 7 * 52  # hours, ~1 year
+DTYPE = 'float32'
+META_FILE = 'cube.json'
+STATION_COORDS = ('Name', 'Latitude', 'Longitude', 'Elevation', 'StationDataTimeZone')
+
+
+def _hour(date_):
+    """ datetime (UTC) -> int64 ns, floored to the hour """
+    return pd.Timestamp(date_).floor('h').value
+
+
+def _depth_key(depth):
+    return 'none' if depth is None else '{:g}'.format(depth)
+
+
+class CubeStore(object):
+    """
+    :param path: cube directory, holding cube.json and the chunk files
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path / META_FILE) as meta_file:
+            self.meta = json.load(meta_file)
+        self.chunks_read = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<CubeStore: {} {}>'.format(self.path, 'x'.join(str(n) for n in self.shape))
+
+    # Metadata
+    # ========
+    @classmethod
+    def create(cls, path, station_list=None, variables=DEFAULT_VARIABLES, begin=datetime.datetime(2000, 1, 1),
+               end=None, station_chunk=STATION_CHUNK, time_chunk=TIME_CHUNK, units=NATIVE):
+        """
+        New empty cube with coordinates from the station and element tables.
+
+        :param station_list: station triplets or a Collection, all local stations if None
+        :param begin: first hour, UTC
+        :param end: last hour, UTC, defaults to now; extended later by append
+        """
+        if hasattr(station_list, 'station_triplets'):
+            station_list = station_list.station_triplets
+        variables = list(variables)
+        with session_scope() as session:
+            query = session.query(Station)
+            if station_list is not None:
+                query = query.filter(Station.StationTriplet.in_(list(station_list)))
+            stations = sorted(query.all(), key=lambda station: station.StationTriplet)
+            # the time axis is hourly, daily elements are not cube variables
+            depths = session.query(Element.HeightDepth).filter(Element.ElementCd.in_(variables)). \
+                filter(Element.Duration == 'HOURLY').distinct().all()
+            station_coords = dict((key, [getattr(station, key) for station in stations]) for key in STATION_COORDS)
+            triplets = [station.StationTriplet for station in stations]
+        depths = [None] + sorted(set(depth for depth, in depths if depth is not None), reverse=True)
+        units = check_unit_system(units)
+        t0 = _hour(begin)
+        meta = {'dims': ['station', 'variable', 'depth', 'time'],
+                'chunks': [station_chunk, 1, 1, time_chunk],
+                'dtype': DTYPE,
+                'time': {'start': t0, 'step': NS_PER_HOUR, 'length': 0, 'start_iso': pd.Timestamp(t0).isoformat()},
+                'coords': {'station': triplets, 'variable': variables, 'depth': depths},
+                'station_coords': station_coords,
+                'units': dict((variable, get_conversion(native_unit(variable), units)[0]) for variable in variables),
+                'unit_system': units,
+                'built_through': None}
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path / META_FILE, 'w') as meta_file:
+            json.dump(meta, meta_file, indent=1, default=str)
+        cube = cls(path)
+        cube._end = _hour(end or datetime.datetime.utcnow())
+        return cube
+
+    def _save_meta(self):
+        tmp_file = self.path / (META_FILE + '.tmp')
+        with open(tmp_file, 'w') as meta_file:
+            json.dump(self.meta, meta_file, indent=1, default=str)
+        os.replace(tmp_file, self.path / META_FILE)
+
+    @property
+    def coords(self):
+        return self.meta['coords']
+
+    @property
+    def shape(self):
+        return (len(self.coords['station']), len(self.coords['variable']), len(self.coords['depth']),
+                self.meta['time']['length'])
+
+    @property
+    def t0(self):
+        return self.meta['time']['start']
+
+    def time_index(self, start=0, stop=None):
+        stop = self.meta['time']['length'] if stop is None else stop
+        return pd.DatetimeIndex((self.t0 + np.arange(start, stop, dtype='i8') * NS_PER_HOUR).view('datetime64[ns]'),
+                                name='DateTime').tz_localize('UTC')
+
+    # Chunks
+    # ======
+    def _chunk_file(self, n_var, n_depth, n_station_chunk, n_time_chunk):
+        return self.path / self.coords['variable'][n_var] / _depth_key(self.coords['depth'][n_depth]) / \
+            '{}.{}'.format(n_station_chunk, n_time_chunk)
+
+    def _chunk_shape(self, n_station_chunk):
+        station_chunk, _, _, time_chunk = self.meta['chunks']
+        n_stations = len(self.coords['station'])
+        return min(station_chunk, n_stations - n_station_chunk * station_chunk), time_chunk
+
+    def _write_chunk(self, key_, block):
+        file_ = self._chunk_file(*key_)
+        file_.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = file_.with_suffix('.tmp{}'.format(threading.get_ident()))
+        with open(tmp_file, 'wb') as chunk_file:
+            chunk_file.write(zlib.compress(np.ascontiguousarray(block, dtype=DTYPE).tobytes(), 4))
+        os.replace(tmp_file, file_)
+
+    def _read_chunk(self, key_):
+        shape_ = self._chunk_shape(key_[2])
+        try:
+            with open(self._chunk_file(*key_), 'rb') as chunk_file:
+                data_ = zlib.decompress(chunk_file.read())
+        except FileNotFoundError:
+            return np.full(shape_, np.nan, dtype=DTYPE)
+        with self._lock:
+            self.chunks_read += 1
+        return np.frombuffer(data_, dtype=DTYPE).reshape(shape_)
+
+    # Build
+    # =====
+    def _element_lookup(self, triplets):
+        with session_scope() as session:
+            element_list = session.query(Element).filter(Element.StationTriplet.in_(triplets)). \
+                filter(Element.ElementCd.in_(self.coords['variable'])). \
+                filter(Element.Duration == 'HOURLY').all()
+            session.expunge_all()
+        return dict(((element.StationTriplet, element.ElementCd, element.HeightDepth), element)
+                    for element in element_list)
+
+    def _build_station_chunk(self, n_station_chunk, first_time_chunk, n_time, data_format):
+        station_chunk, _, _, time_chunk = self.meta['chunks']
+        triplets = self.coords['station'][n_station_chunk * station_chunk:(n_station_chunk + 1) * station_chunk]
+        element_lookup = self._element_lookup(triplets)
+        t_start = first_time_chunk * time_chunk
+        n_time_chunks = -(-n_time // time_chunk)
+        for n_var, variable in enumerate(self.coords['variable']):
+            for n_depth, depth in enumerate(self.coords['depth']):
+                block = None
+                for n_station, triplet in enumerate(triplets):
+                    element = element_lookup.get((triplet, variable, depth))
+                    if element is None:
+                        continue
+                    if data_format != 'par':
+                        element.set_dataframe(data_format=data_format)
+                    series_ = element.to_series(units=self.meta['unit_system'], tz='int')
+                    hour_ = (series_.index.values.astype('i8') - self.t0) // NS_PER_HOUR - t_start
+                    in_range = (hour_ >= 0) & (hour_ < n_time_chunks * time_chunk)
+                    if not in_range.any():
+                        continue
+                    if block is None:
+                        block = np.full((len(triplets), n_time_chunks * time_chunk), np.nan, dtype=DTYPE)
+                    block[n_station, hour_[in_range]] = series_.values[in_range]
+                if block is None:
+                    continue
+                for n_chunk in range(n_time_chunks):
+                    self._write_chunk((n_var, n_depth, n_station_chunk, first_time_chunk + n_chunk),
+                                      block[:, n_chunk * time_chunk:(n_chunk + 1) * time_chunk])
+        return len(triplets)
+
+    def _materialize(self, first_time_chunk, end, workers, data_format):
+        time_chunk = self.meta['chunks'][3]
+        length = max((_hour(end) - self.t0) // NS_PER_HOUR + 1, 0)
+        n_time = length - first_time_chunk * time_chunk
+        if n_time <= 0:
+            return 0
+        n_station_chunks = -(-len(self.coords['station']) // self.meta['chunks'][0])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            n_stations = sum(executor.map(
+                lambda n_station_chunk: self._build_station_chunk(n_station_chunk, first_time_chunk, n_time,
+                                                                  data_format), range(n_station_chunks)))
+        self.meta['time']['length'] = int(length)
+        self.meta['built_through'] = pd.Timestamp(self.t0 + (length - 1) * NS_PER_HOUR).isoformat()
+        self._save_meta()
+        logger.info('Cube %s: %s stations through %s', self.path, n_stations, self.meta['built_through'])
+        return n_stations
+
+    def build(self, end=None, workers=4, data_format='par'):
+        """
+        Materialize every chunk from the element data.
+
+        :param end: last hour, UTC, defaults to the end given at create or now
+        """
+        end = end or getattr(self, '_end', None) or datetime.datetime.utcnow()
+        return self._materialize(0, end, workers, data_format)
+
+    def append(self, end=None, workers=4, data_format='par'):
+        """
+        Extend the time axis after updates; the last time chunk is rewritten, earlier chunks are kept.
+        """
+        length = self.meta['time']['length']
+        first_time_chunk = max(length - 1, 0) // self.meta['chunks'][3]
+        return self._materialize(first_time_chunk, end or datetime.datetime.utcnow(), workers, data_format)
+
+    # Read
+    # ====
+    def _select(self, dim, values):
+        labels = self.coords[dim]
+        if values is None:
+            return list(range(len(labels)))
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        return [labels.index(value) for value in values]
+
+    def _select_stations(self, stations, bbox):
+        selected = self._select('station', stations)
+        if bbox is not None:
+            lon_min, lat_min, lon_max, lat_max = bbox
+            lat_, lon_ = self.meta['station_coords']['Latitude'], self.meta['station_coords']['Longitude']
+            selected = [i for i in selected if lat_min <= lat_[i] <= lat_max and lon_min <= lon_[i] <= lon_max]
+        return selected
+
+    def read(self, stations=None, variables=None, depths=None, begin=None, end=None, bbox=None):
+        """
+        Read a subset, opening only the chunks it touches.
+
+        :param stations: station triplet(s), all if None
+        :param bbox: (lon_min, lat_min, lon_max, lat_max) station filter
+        :param begin: first hour, UTC
+        :param end: last hour, UTC
+        :return: (float32 array station x variable x depth x time, coordinates of the subset)
+        """
+        station_chunk, _, _, time_chunk = self.meta['chunks']
+        n_station_sel = self._select_stations(stations, bbox)
+        n_var_sel = self._select('variable', variables)
+        n_depth_sel = self._select('depth', depths)
+        length = self.meta['time']['length']
+        t_begin = 0 if begin is None else min(max((_hour(begin) - self.t0) // NS_PER_HOUR, 0), length)
+        t_end = length if end is None else min(max((_hour(end) - self.t0) // NS_PER_HOUR + 1, 0), length)
+        out_ = np.full((len(n_station_sel), len(n_var_sel), len(n_depth_sel), max(t_end - t_begin, 0)),
+                       np.nan, dtype=DTYPE)
+        station_groups = {}
+        for n_out, n_station in enumerate(n_station_sel):
+            station_groups.setdefault(n_station // station_chunk, []).append((n_out, n_station % station_chunk))
+        time_chunks = range(t_begin // time_chunk, -(-t_end // time_chunk)) if t_end > t_begin else []
+        for i_var, n_var in enumerate(n_var_sel):
+            for i_depth, n_depth in enumerate(n_depth_sel):
+                for n_station_chunk, members in station_groups.items():
+                    rows_out = [n_out for n_out, _ in members]
+                    rows_chunk = [n_row for _, n_row in members]
+                    for n_time_chunk in time_chunks:
+                        chunk_ = self._read_chunk((n_var, n_depth, n_station_chunk, n_time_chunk))
+                        c_begin = max(t_begin, n_time_chunk * time_chunk)
+                        c_end = min(t_end, (n_time_chunk + 1) * time_chunk)
+                        out_[rows_out, i_var, i_depth, c_begin - t_begin:c_end - t_begin] = \
+                            chunk_[rows_chunk, c_begin - n_time_chunk * time_chunk:c_end - n_time_chunk * time_chunk]
+        coords = {'station': [self.coords['station'][i] for i in n_station_sel],
+                  'variable': [self.coords['variable'][i] for i in n_var_sel],
+                  'depth': [self.coords['depth'][i] for i in n_depth_sel],
+                  'time': self.time_index(t_begin, t_end)}
+        return out_, coords
+
+    def read_frame(self, variable, depth=None, **kwargs):
+        """
+        :return: frame of one variable and depth, UTC time x station
+        """
+        values_, coords = self.read(variables=variable, depths=depth, **kwargs)
+        data_frame = pd.DataFrame(values_[:, 0, 0, :].T, index=coords['time'], columns=coords['station'])
+        data_frame.attrs['units'] = self.meta['units'][variable]
+        return data_frame
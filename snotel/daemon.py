@@ -0,0 +1,192 @@
+''' Ingest Daemon
+    ~~~~~~~~~~~~~
+    Near-real-time ingest: a long-running process that keeps its web service
+    client and database connections warm and wakes on a schedule.  Each cycle
+    fetches only the hours reported since each element's LocalEndDate, with
+    elements of the same kind batched into multi-station requests, and stops
+    issuing requests when the cycle's time budget is spent.
+'''
+
+__author__ = 'nsteiner'
+
+import json
+import time
+import random
+import logging
+import datetime
+
+from sqlalchemy import func
+
+from . import snotel
+from .client import CircuitOpenError
+from .snotel import Element, Station, session_scope
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 15 * 60  # seconds between cycles
+JITTER = 60  # seconds, +/- on every sleep
+BATCH_SIZE = 50  # stations per request
+MAX_SPREAD = 24  # hours, largest begin date difference within one batch
+
+
+def batch_plan(plan, batch_size=BATCH_SIZE, max_spread=MAX_SPREAD):
+    """
+    Group work items into multi-station getHourlyData requests: same element code, duration,
+    ordinal and depth, begin dates within max_spread hours.
+
+    :param plan: list of WorkItem
+    :return: list of WorkItem lists, stalest batch first
+    """
+    groups = {}
+    for item in plan:
+        element = item.element
+        key_ = (element.ElementCd, element.Duration, element.Ordinal, element.HeightDepth)
+        groups.setdefault(key_, []).append(item)
+    spread_ = datetime.timedelta(hours=max_spread)
+    batches = []
+    for items in groups.values():
+        items = sorted(items, key=lambda item: item.begin_date)
+        batch = []
+        for item in items:
+            if batch and (len(batch) >= batch_size or item.begin_date - batch[0].begin_date > spread_):
+                batches.append(batch)
+                batch = []
+            batch.append(item)
+        if batch:
+            batches.append(batch)
+    batches.sort(key=lambda batch: batch[0].begin_date)
+    return batches
+
+
+def fetch_batch(batch, data_format='par'):
+    """
+    One request for a batch, then store and book each element of the response, trimmed
+    to the rows after the element's LocalEndDate.
+
+    :return: number of elements with new data
+    """
+    element_lookup = dict((item.element.StationTriplet, item.element) for item in batch)
+    # elements far behind catch up one request window per cycle
+    end_date = min(max(item.end_date for item in batch),
+                   batch[0].begin_date + snotel.request_span(batch[0].element.Duration))
+    request = snotel.cast_update_element_request(batch[0].element, begin_date=batch[0].begin_date,
+                                                 end_date=end_date)
+    request['stationTriplets'] = list(element_lookup)
+    n_updated = 0
+    for data_result in snotel.fetch_data(request):
+        element = element_lookup.get(data_result.stationTriplet)
+        if element is None or 'values' not in data_result:
+            continue
+        # the request began at the stalest element of the batch, keep only what this element lacks
+        update_ = snotel.update_data(element, data_result, data_format=data_format, since=element.LocalEndDate)
+        if update_ is None:
+            continue
+        begin_date, end_date, data_frame = update_
+        snotel.commit_element_update(element, begin_date, end_date, data_frame=data_frame, data_format=data_format)
+        n_updated += 1
+    return n_updated
+
+
+def station_lag(station_list=None, now=None):
+    """
+    Time since the newest stored observation of every station, from one query.
+
+    :return: {station_triplet: lag in hours}
+    """
+    now = now or datetime.datetime.utcnow()
+    with session_scope() as session:
+        query = session.query(Element.StationTriplet, func.max(Element.LocalEndDate),
+                              Station.StationDataTimeZone). \
+            join(Station, Station.StationTriplet == Element.StationTriplet). \
+            filter(Element.Duration.in_(snotel.duration_toload)). \
+            filter(Element.ElementCd.in_(snotel.elementcd_toload))
+        if station_list is not None:
+            query = query.filter(Element.StationTriplet.in_(list(station_list)))
+        rows = query.group_by(Element.StationTriplet, Station.StationDataTimeZone).all()
+    lag = {}
+    for station_triplet, local_end, tz_offset in rows:
+        if local_end is None:
+            lag[station_triplet] = None
+        else:
+            utc_end = local_end - datetime.timedelta(hours=tz_offset or 0.)
+            lag[station_triplet] = (now - utc_end).total_seconds() / 3600.
+    return lag
+
+
+class IngestDaemon(object):
+    """
+    :param station_list: stations to keep current, all local stations if None
+    :param interval: seconds between cycle starts
+    :param jitter: random +/- seconds added to every sleep, spreads load over several daemons
+    :param budget: seconds a cycle may spend issuing requests, defaults to 80% of interval
+    :param status_path: optional json file rewritten after each cycle with per station lag
+    """
+
+    def __init__(self, station_list=None, interval=INTERVAL, jitter=JITTER, budget=None,
+                 batch_size=BATCH_SIZE, data_format='par', status_path=None):
+        self.station_list = station_list
+        self.interval = interval
+        self.jitter = jitter
+        self.budget = budget if budget is not None else 0.8 * interval
+        self.batch_size = batch_size
+        self.data_format = data_format
+        self.status_path = status_path
+        self.lag = {}
+        self.n_cycles = 0
+        self._stop = False
+
+    def cycle(self):
+        """
+        :return: cycle stats
+        """
+        # a degraded service pauses the schedule instead of failing every batch
+        snotel.client.breaker.wait()
+        start_ = time.time()
+        plan = snotel.plan_updates(station_list=self.station_list)
+        batches = batch_plan(plan, batch_size=self.batch_size)
+        stats = {'planned': len(plan), 'batches': len(batches), 'requests': 0, 'updated': 0, 'errors': 0,
+                 'deferred': 0}
+        for n_batch, batch in enumerate(batches):
+            if time.time() - start_ > self.budget:
+                stats['deferred'] = len(batches) - n_batch
+                logger.warning('Cycle budget spent, %s batches deferred', stats['deferred'])
+                break
+            try:
+                stats['updated'] += fetch_batch(batch, data_format=self.data_format)
+            except CircuitOpenError:
+                stats['deferred'] = len(batches) - n_batch
+                logger.warning('AWDB degraded, %s batches deferred', stats['deferred'])
+                break
+            except Exception:
+                logger.exception('Batch failed: %s', [item.element.ElementTriplet for item in batch])
+                stats['errors'] += 1
+            stats['requests'] += 1
+        self.lag = station_lag(self.station_list)
+        stats['seconds'] = time.time() - start_
+        stats['max_lag'] = max([lag for lag in self.lag.values() if lag is not None] or [None])
+        self.n_cycles += 1
+        if self.status_path:
+            with open(self.status_path, 'w') as status_file:
+                json.dump({'time': datetime.datetime.utcnow().isoformat(), 'cycle': stats, 'lag': self.lag},
+                          status_file, indent=1)
+        logger.info('Cycle %s: %s', self.n_cycles, stats)
+        return stats
+
+    def stop(self):
+        self._stop = True
+
+    def run(self, n_cycles=None):
+        """
+        :param n_cycles: stop after this many cycles, run forever if None
+        """
+        while not self._stop and (n_cycles is None or self.n_cycles < n_cycles):
+            start_ = time.time()
+            try:
+                self.cycle()
+            except Exception:
+                logger.exception('Cycle failed')
+                self.n_cycles += 1
+            if n_cycles is not None and self.n_cycles >= n_cycles:
+                break
+            sleep_ = self.interval - (time.time() - start_) + random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(sleep_, 0.))
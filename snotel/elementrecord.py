@@ -124,4 +124,6 @@ ELEMENTS = {
         'WSPD':  ('WIND SPEED OBSERVED', 'mph', False),
         }
 elementcd_toload = [name for name, (_,_,load) in ELEMENTS.items() if load]
-duration_toload = ['HOURLY']
\ No newline at end of file
+duration_toload = ['HOURLY']
+# durations stored by ingest, see snotel.set_durations
+DURATIONS = ['HOURLY', 'DAILY', 'SEMIMONTHLY']
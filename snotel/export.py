@@ -0,0 +1,438 @@
+''' Export
+    ~~~~~~
+    Stream station/element data for a selection and date window straight from
+    storage (parquet files or the data table) into CSV, parquet or Arrow IPC.
+
+    Work is split into chunks of one station and `chunk_days` of data; QC and
+    the optional daily aggregation run per chunk in a thread pool while a single
+    writer consumes the chunks in order, so at most `workers + prefetch` chunks
+    are in memory whatever the size of the region.
+
+    CSV output is one file per station (header block, then one column per
+    element, as written by bin/write_alaska_stations.py); parquet and Arrow IPC
+    output is a single long-format file with one row per element and time.
+
+        export('out', Collection(state='AK'), elements=['TOBS', ('SMS', -2.)],
+               begin_date=datetime.datetime(2007, 1, 1), end_date=datetime.datetime(2011, 1, 1),
+               daily=('mean', 'std'))
+'''
+
+__author__ = 'nsteiner'
+
+import sys
+import logging
+import datetime
+import argparse
+import itertools as it
+import pathlib
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import and_, or_
+
+from . import snotel
+from . import metrics
+from .snotel import Data, read_scope, local_to_utc, NS_PER_HOUR
+from .units import NATIVE, check_unit_system, convert_series
+
+logger = logging.getLogger(__name__)
+
+CHUNK_DAYS = 366
+STATION_GROUP = 100
+EXPORT_WORKERS = 4
+FORMATS = ('csv', 'parquet', 'arrow')
+STATS = ('mean', 'std', 'min', 'max', 'median', 'sum', 'count')
+HEADER_ATTRIBUTES = ['Name', 'StationTriplet', 'CountyName', 'Latitude',
+                     'Longitude', 'Elevation', 'StationDataTimeZone']
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+
+class ExportChunk(namedtuple('ExportChunk', ['station', 'elements', 'begin', 'end', 'first', 'last'])):
+    """ one station, [begin, end) UTC ns, first/last chunk of the station """
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<ExportChunk {} {} {}>'.format(self.station.StationTriplet,
+                                               pd.Timestamp(self.begin), pd.Timestamp(self.end))
+
+
+'''
+Selection
+~~~~~~~~~
+'''
+
+
+def _element_match(element, elements):
+    if elements is None:
+        return True
+    for element_ in elements:
+        if isinstance(element_, str):
+            if element.ElementCd == element_:
+                return True
+        elif element.ElementCd == element_[0] and element.HeightDepth == element_[1]:
+            return True
+    return False
+
+
+def _bounds(element_list, begin_date, end_date):
+    # station local dates, clipped to the element records; end is exclusive
+    now_ = snotel.station_now(element_list[0].StationTriplet)
+    begin_ = min(element.LocalBeginDate or element.BeginDate or datetime.datetime(1900, 1, 1)
+                 for element in element_list)
+    end_ = max(min(element.LocalEndDate or element.EndDate or now_, now_)
+               for element in element_list) + datetime.timedelta(hours=1)
+    begin_ = max(begin_, begin_date) if begin_date else begin_
+    end_ = min(end_, end_date) if end_date else end_
+    return begin_, end_
+
+
+def iter_chunks(station_triplets, elements=None, begin_date=None, end_date=None, tz='local',
+                chunk_days=CHUNK_DAYS):
+    """
+    Chunks of the selection, station by station; windows are cut at midnight of the
+    output time view so a day never spans two chunks.
+
+    :param elements: element codes or (element code, depth) pairs, loaded elements if None
+    """
+    for station_group in snotel.grouper(station_triplets, STATION_GROUP):
+        station_lookup = dict((station.StationTriplet, station) for station in snotel.load_stations(station_group))
+        for station_triplet in station_group:
+            for chunk in _station_chunks(station_lookup.get(station_triplet), station_triplet, elements,
+                                         begin_date, end_date, tz, chunk_days):
+                yield chunk
+
+
+def _station_chunks(station, station_triplet, elements, begin_date, end_date, tz, chunk_days):
+    if station is None:
+        logger.warning('Station not found %s', station_triplet)
+        return
+    element_list = [element for element in station.element_list if _element_match(element, elements)]
+    if not element_list:
+        return
+    tz_offset = station.StationDataTimeZone if tz == 'local' else 0.
+    begin_, end_ = _bounds(element_list, begin_date, end_date)
+    edges = pd.date_range(pd.Timestamp(begin_).floor('D'), pd.Timestamp(end_), freq='{}D'.format(chunk_days))
+    edges = local_to_utc(list(edges) + [pd.Timestamp(end_)], tz_offset)
+    edges[0] = local_to_utc([begin_], tz_offset)[0]
+    windows = [(lo, hi) for lo, hi in zip(edges[:-1], edges[1:]) if hi > lo] or [(edges[0], edges[0])]
+    for n, (lo, hi) in enumerate(windows):
+        yield ExportChunk(station, element_list, int(lo), int(hi), n == 0, n == len(windows) - 1)
+
+
+'''
+Chunk Processing
+~~~~~~~~~~~~~~~~
+'''
+
+
+def _par_range(par_file):
+    # aws_{element}_{YYYYmmddTHH}_{YYYYmmddTHH}.par, station local dates; None if not named so
+    try:
+        _, begin_, end_ = par_file.stem.rsplit('_', 2)
+        return pd.Timestamp(begin_).value, pd.Timestamp(end_).value
+    except ValueError:
+        return None
+
+
+def _par_overlaps(par_file, begin, end):
+    range_ = _par_range(par_file)
+    if range_ is None:
+        return True
+    begin_, end_ = range_
+    return begin_ - NS_PER_DAY <= end and end_ + NS_PER_DAY >= begin
+
+
+def read_element_window(element, begin, end, data_format='par'):
+    """
+    :param begin: UTC ns, inclusive
+    :param end: UTC ns, exclusive
+    :return: element frame (value, flag) indexed by UTC ns, only the window is kept
+    """
+    if data_format == 'sql':
+        snotel._ensure_data_table()
+        tz_offset = snotel.get_station_timezone(element.StationTriplet)
+        local_ = [pd.Timestamp(time_ + int(round(tz_offset * NS_PER_HOUR))).to_pydatetime() for time_ in (begin, end)]
+        with read_scope() as session:
+            rows = session.query(Data.TimeUTC, Data.DateTime, Data.Value, Data.Flag). \
+                filter(Data.ElementTriplet == element.ElementTriplet). \
+                filter(or_(Data.TimeUTC.between(begin, end - 1),
+                           and_(Data.TimeUTC.is_(None), Data.DateTime >= local_[0], Data.DateTime < local_[1]))).all()
+        utc_ = np.array([time_ if time_ is not None else local_to_utc([date_], tz_offset)[0]
+                         for time_, date_, _, _ in rows], dtype='i8')
+        element_data = pd.DataFrame({'value': [row[2] for row in rows], 'flag': [row[3] for row in rows]},
+                                    index=pd.Index(utc_, name='utc'))
+    else:
+        par_list = [element._read_par(par_file) for par_file in element.par_files
+                    if _par_overlaps(par_file, begin, end)]
+        par_list = [par_data[(par_data.index >= begin) & (par_data.index < end)] for par_data in par_list]
+        if par_list:
+            element_data = pd.concat(par_list)
+        else:
+            element_data = pd.DataFrame({'value': [], 'flag': []}, index=pd.Index([], dtype='i8', name='utc'))
+    element_data = element_data.sort_index()
+    return element_data[~element_data.index.duplicated(keep='last')]
+
+
+def apply_qc(element_data):
+    """
+    Valid flags only, outliers (beyond median + 3 std of the chunk) masked as in Station.get_data_frame.
+    """
+    value_ = element_data['value'].where(element_data['flag'] == 'V')
+    med_, std_ = value_.median(), value_.std()
+    return element_data.assign(value=value_.mask(value_.abs() > med_ + 3 * std_))
+
+
+def process_chunk(chunk, daily=None, qc=True, units=NATIVE, tz='local', data_format='par'):
+    """
+    :return: long frame of the chunk, one row per element and time (per element and day if daily)
+    """
+    tz_offset = chunk.station.StationDataTimeZone if tz == 'local' else 0.
+    frame_list = []
+    for element in chunk.elements:
+        element_data = read_element_window(element, chunk.begin, chunk.end, data_format=data_format)
+        if element_data.empty:
+            continue
+        if qc:
+            element_data = apply_qc(element_data)
+        value_ = convert_series(element_data['value'].astype('float64'), element.ElementCd, units)
+        time_ = (element_data.index.values + int(round(tz_offset * NS_PER_HOUR))).view('datetime64[ns]')
+        if daily:
+            day_ = time_.astype('datetime64[D]').astype('datetime64[ns]')
+            element_data = value_.groupby(day_).agg(list(daily))
+            element_data.index.name = 'datetime'
+            element_data = element_data.reset_index()
+        else:
+            element_data = pd.DataFrame({'datetime': time_, 'value': value_.values,
+                                         'flag': element_data['flag'].values})
+        element_data.insert(0, 'element_triplet', element.ElementTriplet)
+        element_data.insert(1, 'element_cd', element.ElementCd)
+        element_data.insert(2, 'depth', np.nan if element.HeightDepth is None else element.HeightDepth)
+        frame_list.append(element_data)
+    if not frame_list:
+        return None
+    chunk_frame = pd.concat(frame_list, ignore_index=True)
+    chunk_frame.insert(0, 'station_triplet', chunk.station.StationTriplet)
+    return chunk_frame
+
+
+def ordered_map(fn, items, workers=EXPORT_WORKERS, prefetch=None):
+    """
+    Map fn over items in a thread pool, yielding (item, result) in input order with at
+    most `workers + prefetch` results pending.
+    """
+    prefetch = prefetch or workers
+    item_iter = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque((item, executor.submit(fn, item)) for item in it.islice(item_iter, workers + prefetch))
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            for next_item in it.islice(item_iter, 1):
+                pending.append((next_item, executor.submit(fn, next_item)))
+            yield item, result
+
+
+'''
+Writers
+~~~~~~~
+'''
+
+
+def file_name(station):
+    return station.StationTriplet.replace(':', '_') + '.csv'
+
+
+def write_header(station, file):
+    file.write('--HEADERSTART--\n')
+    for meta in HEADER_ATTRIBUTES:
+        file.write('{} = {}\n'.format(meta, getattr(station, meta, None)))
+    file.write('--HEADEREND--\n')
+
+
+class CsvWriter(object):
+    """
+    One file per station: header block, then a wide frame indexed by date with one
+    column per element (and '<element>_flag'), or '<element>_<stat>' when aggregated.
+    """
+
+    def __init__(self, path, daily=None):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.daily = daily
+        self.files = []
+
+    def columns(self, chunk):
+        suffixes = ['_' + stat for stat in self.daily] if self.daily else ['', '_flag']
+        return [element.ElementTriplet + suffix for element in chunk.elements for suffix in suffixes]
+
+    def write(self, chunk, chunk_frame):
+        columns = self.columns(chunk)
+        if chunk_frame is None:
+            wide_ = pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='date'))
+        else:
+            values = list(self.daily) if self.daily else ['value', 'flag']
+            wide_ = chunk_frame.pivot(index='datetime', columns='element_triplet', values=values)
+            wide_.columns = [triplet if value == 'value' else '{}_{}'.format(triplet, value)
+                             for value, triplet in wide_.columns]
+            wide_ = wide_.reindex(columns=columns)
+            wide_.index.name = 'date'
+        file_path = self.path / file_name(chunk.station)
+        with open(file_path, 'w' if chunk.first else 'a') as file:
+            if chunk.first:
+                write_header(chunk.station, file)
+                self.files.append(file_path)
+            wide_.to_csv(file, header=chunk.first)
+
+    def close(self):
+        return self.files
+
+
+def export_schema(daily=None):
+    fields = [('station_triplet', pa.string()), ('element_triplet', pa.string()), ('element_cd', pa.string()),
+              ('depth', pa.float64()), ('datetime', pa.timestamp('ns'))]
+    if daily:
+        fields += [(stat, pa.int64() if stat == 'count' else pa.float64()) for stat in daily]
+    else:
+        fields += [('value', pa.float64()), ('flag', pa.string())]
+    return pa.schema(fields)
+
+
+class _TableWriter(object):
+
+    def __init__(self, path, daily=None, tz='local', units=NATIVE):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.schema = export_schema(daily).with_metadata({'tz': tz, 'unit_system': units})
+        self._writer = self._open()
+
+    def write(self, chunk, chunk_frame):
+        if chunk_frame is not None and len(chunk_frame):
+            self._writer.write_table(pa.Table.from_pandas(chunk_frame, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self._writer.close()
+        return [self.path]
+
+
+class ParquetWriter(_TableWriter):
+
+    def _open(self):
+        return pq.ParquetWriter(str(self.path), self.schema)
+
+
+class ArrowWriter(_TableWriter):
+    """ Arrow IPC file format (feather v2) """
+
+    def _open(self):
+        return pa.ipc.new_file(str(self.path), self.schema)
+
+
+def get_writer(out, fmt='csv', daily=None, tz='local', units=NATIVE):
+    if fmt == 'csv':
+        return CsvWriter(out, daily=daily)
+    if fmt == 'parquet':
+        return ParquetWriter(out, daily=daily, tz=tz, units=units)
+    if fmt == 'arrow':
+        return ArrowWriter(out, daily=daily, tz=tz, units=units)
+    raise ValueError('Unknown export format {}, choose from {}'.format(fmt, FORMATS))
+
+
+'''
+Export
+~~~~~~
+'''
+
+
+def export(out, stations, elements=None, begin_date=None, end_date=None, fmt='csv', daily=None, qc=True,
+           units=NATIVE, tz='local', chunk_days=CHUNK_DAYS, workers=EXPORT_WORKERS, data_format='par'):
+    """
+    :param out: output directory (csv) or file (parquet, arrow)
+    :param stations: station triplets or a Collection
+    :param elements: element codes or (element code, depth) pairs, loaded elements if None
+    :param begin_date: first date of the output time view
+    :param end_date: end date (exclusive) of the output time view
+    :param fmt: 'csv', 'parquet' or 'arrow'
+    :param daily: daily statistics, e.g. ('mean', 'std'), hourly values if None
+    :param qc: keep valid flags only and mask outliers, per chunk
+    :param tz: 'local' (station standard time) or 'utc'
+    :param data_format: read from 'par' files or the 'sql' data table
+    :return: written files
+    """
+    units = check_unit_system(units)
+    if tz not in ('local', 'utc'):
+        raise ValueError('Export time view must be local or utc')
+    if daily:
+        daily = tuple(daily)
+        unknown = [stat for stat in daily if stat not in STATS]
+        if unknown:
+            raise ValueError('Unknown statistics {}, choose from {}'.format(unknown, STATS))
+    if hasattr(stations, 'station_triplets'):
+        stations = stations.station_triplets
+    writer = get_writer(out, fmt=fmt, daily=daily, tz=tz, units=units)
+    chunks = iter_chunks(stations, elements=elements, begin_date=begin_date, end_date=end_date, tz=tz,
+                         chunk_days=chunk_days)
+
+    def _process(chunk):
+        with metrics.timer('stage_seconds', stage='export'):
+            return process_chunk(chunk, daily=daily, qc=qc, units=units, tz=tz, data_format=data_format)
+
+    n_rows = 0
+    try:
+        for chunk, chunk_frame in ordered_map(_process, chunks, workers=workers):
+            writer.write(chunk, chunk_frame)
+            n_rows += 0 if chunk_frame is None else len(chunk_frame)
+            if chunk.last:
+                logger.info('Exported %s', chunk.station.StationTriplet)
+    finally:
+        files = writer.close()
+    metrics.inc('rows_written_total', n_rows, format='export_' + fmt)
+    logger.info('Exported %s rows to %s', n_rows, out)
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export station data for a selection and date window')
+    parser.add_argument('out', help='output directory (csv) or file (parquet, arrow)')
+    parser.add_argument('--format', default='csv', choices=FORMATS)
+    parser.add_argument('--state', help='state code(s), comma separated')
+    parser.add_argument('--network', help='network code(s), comma separated')
+    parser.add_argument('--stations', help='station triplets, comma separated')
+    parser.add_argument('--bbox', help='lon_min,lat_min,lon_max,lat_max')
+    parser.add_argument('--elements', help='element codes or CODE@DEPTH, comma separated, e.g. TOBS,SMS@-2')
+    parser.add_argument('--begin', help='begin date, YYYY-MM-DD')
+    parser.add_argument('--end', help='end date, YYYY-MM-DD')
+    parser.add_argument('--daily', help='daily statistics, comma separated, e.g. mean,std')
+    parser.add_argument('--no-qc', action='store_true', help='keep every flag and outliers')
+    parser.add_argument('--units', default=NATIVE)
+    parser.add_argument('--tz', default='local', choices=('local', 'utc'))
+    parser.add_argument('--chunk-days', type=int, default=CHUNK_DAYS)
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS)
+    parser.add_argument('--data-format', default='par', choices=('par', 'sql'))
+    args = parser.parse_args(argv)
+
+    def _split(value):
+        return value.split(',') if value else None
+
+    def _element(value):
+        code, _, depth = value.partition('@')
+        return (code, float(depth)) if depth else code
+
+    def _date(value):
+        return datetime.datetime.strptime(value, '%Y-%m-%d') if value else None
+
+    collection = snotel.Collection(state=_split(args.state), network=_split(args.network),
+                                   station_triplets=_split(args.stations),
+                                   bbox=[float(value) for value in args.bbox.split(',')] if args.bbox else None)
+    elements = [_element(value) for value in _split(args.elements)] if args.elements else None
+    export(args.out, collection, elements=elements, begin_date=_date(args.begin), end_date=_date(args.end),
+           fmt=args.format, daily=_split(args.daily), qc=not args.no_qc, units=args.units, tz=args.tz,
+           chunk_days=args.chunk_days, workers=args.workers, data_format=args.data_format)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=snotel.LOG_FORMAT)
+    sys.exit(main())
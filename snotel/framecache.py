@@ -0,0 +1,149 @@
+''' Frame Cache
+    ~~~~~~~~~~~
+    Process-wide cache of station and element frames with a byte budget.
+    Entries are keyed by tuples starting with the object kind and triplet,
+    ('element', element_triplet, ...) or ('station', station_triplet, ...), and
+    are evicted least recently used first once the budget is exceeded, so fleet
+    jobs iterating thousands of stations run in a fixed memory envelope.
+
+    The budget is SNOTEL_FRAME_CACHE_MB (default 1024) or set_max_bytes().
+'''
+
+__author__ = 'nsteiner'
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from . import metrics
+
+MAX_BYTES = int(float(os.environ.get('SNOTEL_FRAME_CACHE_MB', 1024)) * 1024 ** 2)
+
+_MISSING = object()
+
+
+def nbytes(value):
+    """
+    :return: approximate memory held by a cached value
+    """
+    if value is None:
+        return 0
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class FrameCache(object):
+    """
+    :param max_bytes: byte budget of all entries
+    :param name: cache label of the frame_cache_total metric
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, name='frame'):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key: (value, nbytes), oldest first
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return '<FrameCache: {} entries {:.1f}/{:.1f} MB hits={} misses={}>'.format(
+            len(self._entries), self.n_bytes / 1024. ** 2, self.max_bytes / 1024. ** 2, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                metrics.inc('frame_cache_total', outcome='miss', cache=self.name)
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+        metrics.inc('frame_cache_total', outcome='hit', cache=self.name)
+        return entry[0]
+
+    def put(self, key, value):
+        """
+        Store a value; values larger than the whole budget are not kept.
+        """
+        size_ = nbytes(value)
+        with self._lock:
+            self._pop(key)
+            if size_ > self.max_bytes:
+                return value
+            self._entries[key] = (value, size_)
+            self.n_bytes += size_
+            self._evict()
+        return value
+
+    def get_or_load(self, key, loader):
+        """
+        :param loader: loader() -> value, called on a miss (outside the lock)
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.put(key, loader())
+        return value
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.n_bytes -= entry[1]
+
+    def _evict(self):
+        while self.n_bytes > self.max_bytes and self._entries:
+            _, (_, size_) = self._entries.popitem(last=False)
+            self.n_bytes -= size_
+            self.evictions += 1
+            metrics.inc('frame_cache_total', outcome='eviction', cache=self.name)
+
+    def invalidate(self, kind, triplet):
+        """
+        Drop every entry of one station or element, e.g. after new data was stored.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[:2] == (kind, triplet)]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'entries': len(self._entries), 'bytes': self.n_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / requests if requests else None}
+
+
+FRAME_CACHE = FrameCache()
+
+
+def set_max_bytes(max_bytes):
+    FRAME_CACHE.set_max_bytes(max_bytes)
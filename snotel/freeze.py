@@ -1,11 +1,17 @@
 __author__ = 'nsteiner'
 
 import os
+import logging
 import pandas as pd
 
 import snotel
 import socket
 
+from snotel.units import NATIVE, get_frame_conversion
+from snotel.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
 host_ = socket.gethostname()
 
 _PATH = os.path.dirname(os.path.realpath(__file__))
@@ -20,52 +26,65 @@ NEW_SET = [957]
 #              950, 963, 1094, 1089, 967, 2080, 1233]
 
 
-def freeze_stations(station_list, metric='mean', data_store=DATA_STORE):
+@profiled
+def freeze_stations(station_list, metric='mean', data_store=DATA_STORE, units=NATIVE):
     for station in station_list:
-        print('Freezing --> {}'.format(station))
-        data_frame = station.get_data_frame(frequency='D', apply_filter=True, how=metric)
-        _set_dataframe(station.StationTriplet, data_frame, metric=metric, data_store=data_store)
+        logger.info('Freezing --> %s', station)
+        data_frame = station.get_data_frame(frequency='D', apply_filter=True, how=metric, units=units)
+        _set_dataframe(station.StationTriplet, data_frame, metric=metric, data_store=data_store, units=units)
 
 
-def _set_dataframe(station_id, data_frame, metric='mean', data_store=DATA_STORE):
+def _index_key(station_id, metric='mean', units=NATIVE):
     if not metric.lower() == 'mean':
         metric_end = '_' + metric
     else:
         metric_end = ''
-    index_ = _index_fromtriplet(station_id) + metric_end
-    data_frame.to_hdf(data_store, index_, mode='a')
+    if not units.lower() == NATIVE:
+        metric_end += '_' + units.lower()
+    return _index_fromtriplet(station_id) + metric_end
 
 
-def _get_dataframe(station_id, metric='mean', data_store=DATA_STORE):
-    if not metric.lower() == 'mean':
-        metric_end = '_' + metric
-    else:
-        metric_end = ''
-    index_ = _index_fromtriplet(station_id) + metric_end
-    return pd.read_hdf(data_store, index_)
+def _set_dataframe(station_id, data_frame, metric='mean', data_store=DATA_STORE, units=NATIVE):
+    index_ = _index_key(station_id, metric=metric, units=units)
+    data_frame.to_hdf(data_store, key=index_, mode='a')
+
+
+def _get_dataframe(station_id, metric='mean', data_store=DATA_STORE, units=NATIVE):
+    index_ = _index_key(station_id, metric=metric, units=units)
+    return _with_units(pd.read_hdf(data_store, index_), units)
+
+
+def _with_units(data_frame, units):
+    # frozen frames are stored already converted, only the metadata needs restoring
+    unit_list, _, _ = get_frame_conversion(data_frame.columns, units)
+    data_frame.attrs['units'] = dict(zip(data_frame.columns, unit_list))
+    data_frame.attrs['unit_system'] = units
+    return data_frame
 
 
-def unfreeze_stations(station_list, metric='mean', data_store=DATA_STORE):
+@profiled
+def unfreeze_stations(station_list, metric='mean', data_store=DATA_STORE, units=NATIVE):
     for station in station_list:
-        data_frame = _get_dataframe(station.StationTriplet, metric=metric, data_store=data_store)
+        data_frame = _get_dataframe(station.StationTriplet, metric=metric, data_store=data_store, units=units)
         station.data_frame = data_frame
     return station_list
 
-def unfreeze_station(station_triplet, metric='mean', data_store=DATA_STORE):
+@profiled
+def unfreeze_station(station_triplet, metric='mean', data_store=DATA_STORE, units=NATIVE):
     station = snotel.get_station(station_triplet)
-    data_frame = _get_dataframe(station.StationTriplet, metric=metric, data_store=data_store)
+    data_frame = _get_dataframe(station.StationTriplet, metric=metric, data_store=data_store, units=units)
     station.data_frame = data_frame
     return station
 
 
-def freeze_alaska_stations(metric='mean', data_store=DATA_STORE):
+def freeze_alaska_stations(metric='mean', data_store=DATA_STORE, units=NATIVE):
     station_list = _get_station_list(ALASKA_SET)
-    freeze_stations(station_list, metric=metric, data_store=data_store)
+    freeze_stations(station_list, metric=metric, data_store=data_store, units=units)
 
 
-def unfreeze_alaska_stations(metric='mean', data_store=DATA_STORE):
+def unfreeze_alaska_stations(metric='mean', data_store=DATA_STORE, units=NATIVE):
     station_list = _get_station_list(ALASKA_SET)
-    return unfreeze_stations(station_list, metric=metric, data_store=data_store)
+    return unfreeze_stations(station_list, metric=metric, data_store=data_store, units=units)
 
 
 def _get_station_list(station_id_list):
@@ -0,0 +1,245 @@
+''' Job Journal
+    ~~~~~~~~~~~
+    Durable record of long refreshes.  Every planned unit of work (a station for
+    metadata and element updates, an element for data updates) is a row of the
+    job table with its status, attempts, timings and last error.  A run that
+    dies is resumed from the journal: finished units are skipped and failed
+    units are retried with exponential backoff.
+'''
+
+__author__ = 'nsteiner'
+
+import time
+import random
+import logging
+import datetime
+
+from sqlalchemy import and_, or_, func, select, types, Column
+
+from . import snotel
+from .snotel import Base, session_scope
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('stations', 'elements', 'data')
+
+
+class Job(Base):
+    """ One unit of work of a journaled run """
+
+    __tablename__ = 'job'
+    Run = Column(types.String, primary_key=True)  # refresh-20240101
+    Unit = Column(types.String, primary_key=True)  # station or element triplet
+    Kind = Column(types.String)  # stations | elements | data
+    Status = Column(types.String)  # planned | running | done | failed
+    Attempts = Column(types.Integer)
+    PlannedAt = Column(types.DateTime)
+    StartedAt = Column(types.DateTime)
+    FinishedAt = Column(types.DateTime)
+    Seconds = Column(types.Float)
+    NextAttemptAt = Column(types.DateTime)
+    Error = Column(types.String)
+
+    def __init__(self, *args, **kwargs):
+        for arg in args:
+            for key in arg:
+                setattr(self, key, arg[key])
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+    def __repr__(self):
+        return '<JOB: {Run} {Unit} {Status}>'.format(**self.__dict__)
+
+
+class Journal(object):
+    """
+    :param run: run name; reuse it to resume
+    :param kind: one of KINDS
+    :param max_attempts: failed units are retried until this many attempts
+    :param backoff: first retry delay, seconds; doubles per attempt with jitter
+    :param max_backoff: largest retry delay, seconds
+    """
+
+    def __init__(self, run, kind, max_attempts=5, backoff=30., max_backoff=3600.):
+        assert kind in KINDS
+        self.run_name = run
+        self.kind = kind
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._started = {}
+        Job.__table__.create(bind=snotel.ee, checkfirst=True)
+
+    def __repr__(self):
+        return '<Journal: {} {}>'.format(self.run_name, self.summary())
+
+    def _query(self, session):
+        return session.query(Job).filter(Job.Run == self.run_name)
+
+    def plan(self, unit_list):
+        """
+        Record units of work, units already in the journal keep their state.
+
+        :return: number of new units
+        """
+        now = datetime.datetime.utcnow()
+        jtable = Job.__table__
+
+        def write_jobs(conn):
+            existing = set(unit for unit, in conn.execute(
+                select([jtable.c.Unit]).where(jtable.c.Run == self.run_name)))
+            new_jobs = [dict(Run=self.run_name, Unit=unit, Kind=self.kind, Status='planned', Attempts=0,
+                             PlannedAt=now) for unit in dict.fromkeys(unit_list) if unit not in existing]
+            if new_jobs:
+                conn.execute(jtable.insert(), new_jobs)
+            return len(new_jobs)
+        return snotel.write_transaction(write_jobs, op='journal')
+
+    def _retryable(self):
+        return and_(Job.Status == 'failed', Job.Attempts < self.max_attempts)
+
+    def due(self, now=None):
+        """
+        Units to work on now: planned, left running by a dead process, or failed and past their backoff.
+        """
+        now = now or datetime.datetime.utcnow()
+        with session_scope() as session:
+            rows = self._query(session).with_entities(Job.Unit). \
+                filter(or_(Job.Status.in_(['planned', 'running']),
+                           and_(self._retryable(), Job.NextAttemptAt <= now))). \
+                order_by(Job.Attempts, Job.Unit).all()
+        return [unit for unit, in rows]
+
+    def next_retry(self):
+        """
+        :return: earliest NextAttemptAt of the failed units still to retry, None if there are none
+        """
+        with session_scope() as session:
+            return self._query(session).with_entities(func.min(Job.NextAttemptAt)). \
+                filter(self._retryable()).scalar()
+
+    def start(self, unit_list):
+        now = datetime.datetime.utcnow()
+        for unit in unit_list:
+            self._started[unit] = time.time()
+        jtable = Job.__table__
+        snotel.write_transaction(lambda conn: conn.execute(
+            jtable.update().where(and_(jtable.c.Run == self.run_name, jtable.c.Unit.in_(list(unit_list)))).
+            values(Status='running', StartedAt=now, Attempts=jtable.c.Attempts + 1)), op='journal')
+
+    def record(self, unit, error=None):
+        """
+        Finish a unit: done, or failed with the next attempt scheduled.
+        """
+        now = datetime.datetime.utcnow()
+        values_ = {'FinishedAt': now, 'Error': error,
+                   'Seconds': time.time() - self._started.pop(unit, time.time())}
+        jtable = Job.__table__
+        job_ = and_(jtable.c.Run == self.run_name, jtable.c.Unit == unit)
+
+        def write_record(conn):
+            if error:
+                attempts = conn.execute(select([jtable.c.Attempts]).where(job_)).scalar() or 0
+                delay = min(self.max_backoff, self.backoff * 2 ** max(attempts - 1, 0))
+                values_['Status'] = 'failed'
+                values_['NextAttemptAt'] = now + datetime.timedelta(seconds=delay * random.uniform(0.5, 1.5))
+            else:
+                values_['Status'] = 'done'
+                values_['NextAttemptAt'] = None
+            conn.execute(jtable.update().where(job_).values(values_))
+        snotel.write_transaction(write_record, op='journal')
+
+    def summary(self):
+        """
+        :return: {status: count}
+        """
+        with session_scope() as session:
+            rows = self._query(session).with_entities(Job.Status, func.count(Job.Unit)). \
+                group_by(Job.Status).all()
+        return dict(rows)
+
+    def failures(self):
+        """
+        :return: [(unit, attempts, error)] of failed units
+        """
+        with session_scope() as session:
+            rows = self._query(session).with_entities(Job.Unit, Job.Attempts, Job.Error). \
+                filter(Job.Status == 'failed').all()
+        return [tuple(row) for row in rows]
+
+    def run(self, fn, batch_size=1, max_wait=600.):
+        """
+        Work through the due units until the run is done or only retries further than max_wait are left.
+
+        :param fn: fn(unit_list) -> {unit: error} for the failed units of the batch; raising fails the batch
+        :param batch_size: units per fn call
+        :param max_wait: longest sleep for a scheduled retry, seconds
+        :return: summary
+        """
+        while True:
+            due_ = self.due()
+            if not due_:
+                next_ = self.next_retry()
+                if next_ is None:
+                    break
+                wait_ = (next_ - datetime.datetime.utcnow()).total_seconds()
+                if wait_ > max_wait:
+                    logger.info('%s: next retry in %.0f s, stopping', self, wait_)
+                    break
+                time.sleep(max(wait_, 0.))
+                continue
+            for batch in snotel.grouper(due_, batch_size):
+                self.start(batch)
+                try:
+                    errors = fn(batch) or {}
+                except Exception as e:
+                    logger.exception('%s: batch failed', self)
+                    errors = dict((unit, str(e)) for unit in batch)
+                for unit in batch:
+                    self.record(unit, errors.get(unit))
+        return self.summary()
+
+
+def run_data_journaled(run, plan, data_format='par', **kwargs):
+    """
+    Run a data update plan through the pipeline, one journal unit per element.
+
+    :param plan: plan from snotel.plan_updates
+    :return: journal summary
+    """
+    journal = Journal(run, 'data', **kwargs)
+    journal.plan([item.element.ElementTriplet for item in plan])
+    plan_lookup = dict((item.element.ElementTriplet, item) for item in plan)
+
+    def _update(element_triplets):
+        from .pipeline import UpdatePipeline
+        missing = [triplet for triplet in element_triplets if triplet not in plan_lookup]
+        if missing:
+            # retries and resumed runs plan from the current element table
+            plan_lookup.update((item.element.ElementTriplet, item)
+                               for item in snotel.plan_updates(element_triplets=missing))
+        errors = {}
+        UpdatePipeline(data_format=data_format,
+                       on_finish=lambda triplet, error: errors.__setitem__(triplet, error)).run(
+            [plan_lookup.pop(triplet) for triplet in element_triplets if triplet in plan_lookup])
+        return dict((triplet, error) for triplet, error in errors.items() if error)
+
+    return journal.run(_update, batch_size=snotel.GRPSIZE)
+
+
+def resume(run, **kwargs):
+    """
+    Continue a journaled run: finished units are skipped, failed ones are retried.
+
+    :return: journal summary
+    """
+    with session_scope() as session:
+        kind = session.query(Job.Kind).filter(Job.Run == run).limit(1).scalar()
+    if kind is None:
+        raise ValueError('No journal for run {}'.format(run))
+    journal = Journal(run, kind)
+    if kind == 'stations':
+        return snotel.update_station_list(journal.due(), journal_run=run)
+    if kind == 'elements':
+        return snotel.update_stationlist_elements(journal.due(), journal_run=run)
+    return run_data_journaled(run, [], **kwargs)
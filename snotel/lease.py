@@ -0,0 +1,291 @@
+''' Shard Leases
+    ~~~~~~~~~~~~
+    Split a full-network refresh over several processes or machines that share
+    one data volume and database.  Each unit of work (a station or an element,
+    a "shard") is a row in the lease table; workers claim a shard with an
+    expiring lease, heartbeat while they work and release it with stats when
+    done.  Leases of dead workers expire and are claimed again.
+'''
+
+__author__ = 'nsteiner'
+
+import os
+import json
+import time
+import socket
+import logging
+import importlib
+import datetime
+import threading
+from multiprocessing import Process
+
+from sqlalchemy import and_, or_, func, select, types, inspect, Column
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+from . import snotel
+from .snotel import Base, session_scope
+
+logger = logging.getLogger(__name__)
+
+JOBS = ('data', 'elements')
+SHARD_KINDS = ('station', 'element')
+LEASE_TTL = 600  # seconds
+HEARTBEAT = 60  # seconds
+SEED_BATCH = 100  # lease rows per insert
+
+
+class Lease(Base):
+    """ One shard of a distributed run """
+
+    __tablename__ = 'lease'
+    Run = Column(types.String, primary_key=True)  # refresh-20240101
+    Shard = Column(types.String, primary_key=True)  # 2213:AK:SCAN
+    Kind = Column(types.String)  # station | element
+    Job = Column(types.String)  # data | elements
+    Status = Column(types.String, default='pending')  # pending | leased | done | failed
+    Owner = Column(types.String)  # host:pid
+    ExpiresAt = Column(types.DateTime)
+    Attempts = Column(types.Integer, default=0)
+    StartedAt = Column(types.DateTime)
+    FinishedAt = Column(types.DateTime)
+    Stats = Column(types.String)  # json
+    Error = Column(types.String)
+
+    def __init__(self, *args, **kwargs):
+        for arg in args:
+            for key in arg:
+                setattr(self, key, arg[key])
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+    def __repr__(self):
+        return '<LEASE: {Run} {Shard} {Status}>'.format(**self.__dict__)
+
+
+def default_owner():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def seed_shards(run, shard_list, kind='station', job='data'):
+    """
+    Add the shards of a run, idempotent so every worker of the run may seed it.
+
+    :param run: run name, shared by all workers
+    :param shard_list: station or element triplets
+    :return: number of new shards
+    """
+    assert kind in SHARD_KINDS and job in JOBS
+    _ensure_table()
+    rows = [dict(Run=run, Shard=shard, Kind=kind, Job=job, Status='pending', Attempts=0)
+            for shard in dict.fromkeys(shard_list)]
+    n_new = 0
+    for group in range(0, len(rows), SEED_BATCH):
+        n_new += snotel.write_transaction(lambda conn: _insert_new(conn, rows[group:group + SEED_BATCH]),
+                                          op='seed_shards')
+    return n_new
+
+
+def _ensure_table():
+    try:
+        Lease.__table__.create(bind=snotel.ee, checkfirst=True)
+    except DBAPIError:
+        # created by a worker seeding at the same time
+        if not inspect(snotel.ee).has_table(Lease.__tablename__):
+            raise
+
+
+def _insert_new(conn, rows):
+    """
+    Insert lease rows, skipping shards already seeded (by this or a concurrent worker).
+
+    :return: number of inserted rows
+    """
+    if conn.dialect.name in ('sqlite', 'postgresql'):
+        insert_ = importlib.import_module('sqlalchemy.dialects.{}'.format(conn.dialect.name)).insert
+        return conn.execute(insert_(Lease.__table__).values(rows).on_conflict_do_nothing()).rowcount
+    n_new = 0
+    for row in rows:
+        try:
+            with conn.begin_nested():
+                conn.execute(Lease.__table__.insert().values(row))
+            n_new += 1
+        except IntegrityError:
+            pass
+    return n_new
+
+
+def claim_shard(run, owner, ttl=LEASE_TTL, max_attempts=3, now=None):
+    """
+    Claim the next free shard: pending, or leased with an expired lease.
+
+    :return: claimed Lease (detached) or None when the run has no free shards
+    """
+    ltable = Lease.__table__
+    while True:
+        now = now or datetime.datetime.utcnow()
+        free_ = and_(ltable.c.Run == run,
+                     ltable.c.Attempts < max_attempts,
+                     or_(ltable.c.Status == 'pending',
+                         and_(ltable.c.Status == 'leased', ltable.c.ExpiresAt < now)))
+
+        def write_claim(conn):
+            shard = conn.execute(select([ltable.c.Shard]).where(free_).
+                                 order_by(ltable.c.Attempts, ltable.c.Shard).limit(1)).scalar()
+            if shard is None:
+                return None, 0
+            # conditional update: only one of the competing workers wins the shard
+            n_rows = conn.execute(ltable.update().where(and_(free_, ltable.c.Shard == shard)).values(
+                Status='leased', Owner=owner, StartedAt=now, ExpiresAt=now + datetime.timedelta(seconds=ttl),
+                Attempts=ltable.c.Attempts + 1)).rowcount
+            return shard, n_rows
+        shard, n_rows = snotel.write_transaction(write_claim, op='lease')
+        if shard is None:
+            return None
+        if n_rows == 1:
+            with session_scope() as session:
+                lease = session.query(Lease).filter(Lease.Run == run, Lease.Shard == shard).one()
+                session.expunge(lease)
+            return lease
+        now = None
+
+
+def heartbeat(lease, owner, ttl=LEASE_TTL):
+    """
+    Extend a held lease.
+
+    :return: False if the lease was lost (expired and claimed by another worker)
+    """
+    ltable = Lease.__table__
+    n_rows = snotel.write_transaction(lambda conn: conn.execute(
+        ltable.update().where(and_(ltable.c.Run == lease.Run, ltable.c.Shard == lease.Shard,
+                                   ltable.c.Owner == owner, ltable.c.Status == 'leased')).
+        values(ExpiresAt=datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl))).rowcount, op='lease')
+    return n_rows == 1
+
+
+def release_shard(lease, owner, stats=None, error=None, max_attempts=3):
+    """
+    Finish a shard: done with stats, or after an error back to pending (failed once attempts run out).
+    """
+    if not error:
+        status = 'done'
+    else:
+        status = 'pending' if lease.Attempts < max_attempts else 'failed'
+    values_ = {'Owner': None, 'ExpiresAt': None, 'FinishedAt': datetime.datetime.utcnow(),
+               'Stats': json.dumps(stats, default=str) if stats is not None else None,
+               'Status': status, 'Error': error}
+    ltable = Lease.__table__
+    snotel.write_transaction(lambda conn: conn.execute(
+        ltable.update().where(and_(ltable.c.Run == lease.Run, ltable.c.Shard == lease.Shard,
+                                   ltable.c.Owner == owner)).values(values_)), op='lease')
+
+
+def run_status(run):
+    """
+    :return: {status: count} for a run
+    """
+    with session_scope() as session:
+        rows = session.query(Lease.Status, func.count(Lease.Shard)). \
+            filter(Lease.Run == run).group_by(Lease.Status).all()
+    return dict(rows)
+
+
+class ShardWorker(object):
+    """
+    Claim, process and release shards of a run until none are left.
+
+    :param run: run name
+    :param data_format: storage for data jobs
+    :param ttl: lease length, seconds
+    :param heartbeat_interval: seconds between lease extensions, well below ttl
+    """
+
+    def __init__(self, run, data_format='par', ttl=LEASE_TTL, heartbeat_interval=HEARTBEAT,
+                 max_attempts=3, owner=None):
+        self.run_name = run
+        self.data_format = data_format
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.owner = owner or default_owner()
+        self.n_shards = 0
+
+    def process(self, lease):
+        """
+        :return: stats for the shard
+        """
+        if lease.Job == 'elements':
+            snotel.update_stationlist_elements([lease.Shard])
+            return {'stations': 1}
+        if lease.Kind == 'station':
+            plan = snotel.plan_updates(station_list=[lease.Shard])
+        else:
+            plan = snotel.plan_updates(element_triplets=[lease.Shard])
+        stats = snotel.run_plan(plan, data_format=self.data_format) or {}
+        stats['planned'] = len(plan)
+        stats['est_rows'] = sum(item.est_rows for item in plan)
+        errors = stats.get('errors')
+        if errors:
+            raise RuntimeError('{} elements failed: {}'.format(len(errors), errors))
+        return stats
+
+    def _heartbeat(self, lease, stop):
+        while not stop.wait(self.heartbeat_interval):
+            if not heartbeat(lease, self.owner, ttl=self.ttl):
+                logger.warning('Lost lease %s', lease)
+                return
+
+    def run(self):
+        while True:
+            lease = claim_shard(self.run_name, self.owner, ttl=self.ttl, max_attempts=self.max_attempts)
+            if lease is None:
+                return self.n_shards
+            logger.info('%s claimed %s', self.owner, lease)
+            stop = threading.Event()
+            beat = threading.Thread(target=self._heartbeat, args=(lease, stop), daemon=True)
+            beat.start()
+            start_ = time.time()
+            try:
+                stats = self.process(lease)
+                stats['seconds'] = time.time() - start_
+                release_shard(lease, self.owner, stats=stats)
+            except Exception as e:
+                logger.exception('Shard %s failed', lease)
+                release_shard(lease, self.owner, stats={'seconds': time.time() - start_}, error=str(e),
+                              max_attempts=self.max_attempts)
+            finally:
+                stop.set()
+                beat.join()
+            self.n_shards += 1
+
+
+def run_distributed(run, shard_list, kind='station', job='data', **kwargs):
+    """
+    Seed the run and work on it in this process; start the same call on every node.
+
+    :return: number of shards processed here
+    """
+    seed_shards(run, shard_list, kind=kind, job=job)
+    return ShardWorker(run, **kwargs).run()
+
+
+def _worker_main(run, kwargs):
+    # forked workers must not share the parent's pooled connections
+    snotel.ee.dispose()
+    snotel._dispose_read_engine()
+    ShardWorker(run, **kwargs).run()
+
+
+def run_local_workers(run, shard_list, n_workers=4, kind='station', job='data', **kwargs):
+    """
+    Several worker processes on one machine against the same database, for local testing.
+
+    :return: run status after all workers finished
+    """
+    seed_shards(run, shard_list, kind=kind, job=job)
+    workers = [Process(target=_worker_main, args=(run, kwargs)) for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return run_status(run)
@@ -0,0 +1,224 @@
+''' Metrics
+    ~~~~~~~
+    Counters and histograms for the ingest and storage paths: request latency,
+    payload bytes, rows parsed and written, database transaction time, parquet
+    bytes and pipeline stage time.  Dumped as JSON or Prometheus text.
+
+    Disabled by default; every recording call returns immediately unless
+    metrics are enabled with SNOTEL_METRICS=1, enable() or the --metrics flag.
+'''
+
+__author__ = 'nsteiner'
+
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('SNOTEL_METRICS', '').lower() not in ('', '0', 'false', 'no')
+
+SECONDS_BUCKETS = (.001, .005, .01, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+BYTES_BUCKETS = tuple(4 ** i * 1024 for i in range(10))  # 1 kB .. 256 MB
+ROWS_BUCKETS = tuple(10 ** i for i in range(7))
+
+# name: (kind, help, buckets)
+METRICS = {
+    'awdb_request_seconds': ('histogram', 'AWDB call latency, retries included', SECONDS_BUCKETS),
+    'awdb_requests_total': ('counter', 'AWDB calls by outcome', None),
+    'awdb_payload_bytes': ('histogram', 'AWDB response size', BYTES_BUCKETS),
+    'rows_parsed': ('histogram', 'Data rows parsed per response', ROWS_BUCKETS),
+    'rows_written_total': ('counter', 'Data rows stored', None),
+    'db_transaction_seconds': ('histogram', 'Database transaction time', SECONDS_BUCKETS),
+    'parquet_bytes_total': ('counter', 'Parquet bytes written and read', None),
+    'stage_seconds': ('histogram', 'Update pipeline time per unit and stage', SECONDS_BUCKETS),
+    'frame_cache_total': ('counter', 'Frame and response cache hits, misses and evictions', None),
+    'service_requests_total': ('counter', 'Data service requests by route and status', None),
+    'service_request_seconds': ('histogram', 'Data service response time', SECONDS_BUCKETS),
+    'write_group_size': ('histogram', 'Write requests per sqlite group commit', ROWS_BUCKETS),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self, name, help_=''):
+        self.name = name
+        self.help = help_
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key_ = _label_key(labels)
+        with self._lock:
+            self.values[key_] = self.values.get(key_, 0) + value
+
+    def to_dict(self):
+        return [{'labels': dict(key_), 'value': value} for key_, value in self.values.items()]
+
+    def to_prometheus(self):
+        return ['{}{} {}'.format(self.name, _prom_labels(key_), value) for key_, value in self.values.items()]
+
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_='', buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.buckets = tuple(buckets)
+        # label key: [bucket counts (non cumulative, last is +Inf), sum, count]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key_ = _label_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key_ not in self.values:
+                self.values[key_] = [[0] * (len(self.buckets) + 1), 0., 0]
+            counts, _, _ = entry = self.values[key_]
+            counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def to_dict(self):
+        return [{'labels': dict(key_), 'count': count, 'sum': sum_,
+                 'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], _cumulative(counts)))}
+                for key_, (counts, sum_, count) in self.values.items()]
+
+    def to_prometheus(self):
+        lines = []
+        for key_, (counts, sum_, count) in self.values.items():
+            for bound, cumulative in zip(list(self.buckets) + ['+Inf'], _cumulative(counts)):
+                lines.append('{}_bucket{} {}'.format(self.name, _prom_labels(key_ + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _prom_labels(key_), sum_))
+            lines.append('{}_count{} {}'.format(self.name, _prom_labels(key_), count))
+        return lines
+
+
+def _cumulative(counts):
+    total, out = 0, []
+    for count in counts:
+        total += count
+        out.append(total)
+    return out
+
+
+def _prom_labels(key_):
+    if not key_:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in key_) + '}'
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        metric = self.metrics.get(name)
+        if metric is None:
+            kind, help_, buckets = METRICS.get(name, ('counter', '', None))
+            with self._lock:
+                if name not in self.metrics:
+                    self.metrics[name] = Histogram(name, help_, buckets) if kind == 'histogram' \
+                        else Counter(name, help_)
+                metric = self.metrics[name]
+        return metric
+
+    def reset(self):
+        with self._lock:
+            self.metrics = {}
+
+    def to_dict(self):
+        return dict((name, {'type': metric.kind, 'help': metric.help, 'values': metric.to_dict()})
+                    for name, metric in sorted(self.metrics.items()))
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=1)
+
+    def to_prometheus(self):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            lines.extend(metric.to_prometheus())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+'''
+Recording
+~~~~~~~~~
+'''
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    REGISTRY.get(name).inc(value, **labels)
+
+
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    REGISTRY.get(name).observe(value, **labels)
+
+
+@contextmanager
+def _timed(name, labels):
+    start_ = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.get(name).observe(time.perf_counter() - start_, **labels)
+
+
+@contextmanager
+def _untimed():
+    yield
+
+
+def timer(name, **labels):
+    """
+    with metrics.timer('db_transaction_seconds', op='add_data'): ...
+    """
+    if not ENABLED:
+        return _untimed()
+    return _timed(name, labels)
+
+
+def dump(path=None, fmt=None):
+    """
+    :param path: output file, returns the text if None
+    :param fmt: 'json' or 'prometheus', from the file extension if None ('.prom' / '.txt' -> prometheus)
+    """
+    if fmt is None:
+        fmt = 'prometheus' if path and str(path).endswith(('.prom', '.txt')) else 'json'
+    text = REGISTRY.to_prometheus() if fmt == 'prometheus' else REGISTRY.to_json()
+    if path is None:
+        return text
+    with open(path, 'w') as out_file:
+        out_file.write(text)
+    return path
@@ -0,0 +1,333 @@
+''' Update Pipeline
+    ~~~~~~~~~~~~~~~
+    Staged element updates: fetch -> parse -> write -> commit.
+    Stages run in their own worker threads and are joined by bounded queues, so a
+    slow stage blocks its producers (backpressure) and memory stays bounded.  Every
+    request window of an element moves through the stages as its own unit: fetch
+    passes a response downstream before requesting the next window, so a long
+    backfill holds a few windows at a time, not the whole element.  The commit
+    stage has a single worker which owns the database: element bookkeeping and sql
+    data inserts are serialized there (and group committed by the sqlite writer
+    thread, writer.py), window by window in request order.  Backends taking
+    concurrent writers (postgres, snotel.concurrent_writes) load sql data in the
+    write stage instead, through the pooled connections of snotel.ee.
+'''
+
+__author__ = 'nsteiner'
+
+import time
+import queue
+import logging
+import threading
+
+from . import snotel
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class ElementUpdate(object):
+    """ One element whose request windows move through the pipeline """
+
+    def __init__(self, element, windows):
+        self.element = element
+        self.windows = windows
+        self.error = None
+        self.n_units = 0
+        self.n_open = 0
+        self.n_committed = 0
+        self.fetched = False
+        self.next_commit = 0
+        self.failed_at = None
+        self.pending = {}
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<ElementUpdate: {}>'.format(self.element.ElementTriplet)
+
+
+class UpdateUnit(object):
+    """ One response (request window) of an element moving through the pipeline """
+
+    def __init__(self, update, sequence, data_result):
+        self.update = update
+        self.element = update.element
+        self.sequence = sequence
+        self.data_result = data_result
+        self.data_frame = None
+        self.begin_date = None
+        self.end_date = None
+        self.tz_offset = None
+        self.error = None
+
+    def __repr__(self):
+        return '<UpdateUnit: {} #{}>'.format(self.element.ElementTriplet, self.sequence)
+
+
+class Stage(object):
+    """
+    Pool of worker threads reading from an input queue and writing to an output queue.
+
+    :param name: stage name, used in logs and stats
+    :param fn: fn(unit) -> unit to pass downstream, or None to drop it
+    :param workers: number of worker threads
+    :param on_error: on_error(unit) called after fn raised, unit.error is set
+    :param fan_out: fn(unit) yields the units to pass downstream, each is queued as soon as
+                    it is yielded
+    """
+
+    def __init__(self, name, fn, workers=1, in_queue=None, out_queue=None, on_error=None, fan_out=False):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.fan_out = fan_out
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.on_error = on_error
+        self.n_done = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._work, name='{}-{}'.format(self.name, i), daemon=True)
+                         for i in range(self.workers)]
+        for thread_ in self._threads:
+            thread_.start()
+
+    def join(self):
+        for thread_ in self._threads:
+            thread_.join()
+        # all workers finished, pass a single end marker downstream
+        if self.out_queue is not None:
+            self.out_queue.put(_DONE)
+
+    def _work(self):
+        while True:
+            unit = self.in_queue.get()
+            if unit is _DONE:
+                # let the sibling workers see the end marker too
+                self.in_queue.put(_DONE)
+                return
+            start_ = time.perf_counter()
+            try:
+                if self.fan_out:
+                    for unit_ in self.fn(unit):
+                        self.out_queue.put(unit_)
+                    unit_ = None
+                else:
+                    unit_ = self.fn(unit)
+            except Exception as e:
+                logger.exception('%s failed for %s', self.name, unit)
+                unit.error = '{}: {}'.format(self.name, e)
+                with self._lock:
+                    self.errors.append(unit)
+                if self.on_error is not None:
+                    self.on_error(unit)
+                continue
+            metrics.observe('stage_seconds', time.perf_counter() - start_, stage=self.name)
+            with self._lock:
+                self.n_done += 1
+            if unit_ is not None and self.out_queue is not None:
+                self.out_queue.put(unit_)
+
+
+class UpdatePipeline(object):
+    """
+    :param data_format: 'par' or 'sql' storage
+    :param fetch_workers: concurrent web service requests
+    :param parse_workers: response -> columnar frame workers
+    :param write_workers: parquet writers, or 'sql' writers on a backend with concurrent writes
+                          (on sqlite 'sql' data is written by the commit stage)
+    :param queue_size: bound of every inter-stage queue
+    :param on_finish: on_finish(element_triplet, error) called once per element when it leaves the
+                      pipeline: committed or without new data (error None), or failed
+    """
+
+    def __init__(self, data_format='par', fetch_workers=4, parse_workers=2, write_workers=2, queue_size=8,
+                 on_finish=None):
+        self.data_format = data_format
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+        self.on_finish = on_finish
+        self.stages = []
+        self.committed = []
+        self.errors = []
+        self._lock = threading.Lock()
+
+    # Stages
+    # ======
+    def fetch(self, update):
+        """ Request the windows of an element in order, stops at the first failing window """
+        try:
+            for begin_date, end_date in update.windows:
+                request = snotel.cast_update_element_request(update.element, begin_date=begin_date, end_date=end_date)
+                logger.debug('REQUESTING: %s', request)
+                # fetch workers pause while the service is degraded
+                snotel.client.breaker.wait()
+                try:
+                    data_result = snotel.fetch_data(request)
+                except Exception as e:
+                    if not update.n_units:
+                        raise
+                    logger.warning('Stopping %s after failed window %s: %s', update, begin_date, e)
+                    break
+                assert len(data_result) == 1
+                if 'values' in data_result[0]:
+                    with update.lock:
+                        unit = UpdateUnit(update, update.n_units, data_result[0])
+                        update.n_units += 1
+                        update.n_open += 1
+                    yield unit
+        finally:
+            with update.lock:
+                update.fetched = True
+        if not update.n_units:
+            logger.info('No new data found for %s', update)
+        self._settle(update)
+
+    def parse(self, unit):
+        if self._after_failure(unit):
+            return self._drop(unit)
+        unit.tz_offset = snotel.get_station_timezone(unit.element.StationTriplet)
+        unit.data_frame = snotel.parse_data_frame(unit.element, unit.data_result, tz_offset=unit.tz_offset)
+        unit.begin_date, unit.end_date = snotel.result_dates(unit.element, unit.data_result, unit.data_frame,
+                                                             unit.tz_offset)
+        unit.data_result = None
+        return unit
+
+    def write(self, unit):
+        if self._after_failure(unit):
+            return self._drop(unit)
+        if self.data_format == 'par':
+            snotel.write_par_frame(unit.element, unit.data_frame, unit.begin_date, unit.end_date)
+        elif self.data_format == 'sql' and snotel.concurrent_writes():
+            self._write_sql(unit)
+        return unit
+
+    def commit(self, unit):
+        """
+        Single worker: the only stage that writes element bookkeeping.  Windows that
+        arrive early wait in update.pending, so LocalEndDate and the element summary
+        advance in request order; windows after a failed window are dropped.
+        """
+        update = unit.update
+        with update.lock:
+            update.pending[unit.sequence] = unit
+        while True:
+            with update.lock:
+                if update.failed_at is not None and update.next_commit >= update.failed_at:
+                    break
+                unit = update.pending.pop(update.next_commit, None)
+                if unit is None:
+                    break
+            try:
+                if self.data_format == 'sql' and not snotel.concurrent_writes():
+                    self._write_sql(unit)
+                snotel.commit_element_update(unit.element, unit.begin_date, unit.end_date,
+                                             data_frame=unit.data_frame, data_format=self.data_format)
+            except Exception as e:
+                # the failed window is not the unit this call was given, book it here
+                logger.exception('commit failed for %s', unit)
+                unit.error = 'commit: {}'.format(e)
+                self._failed(unit)
+                break
+            unit.data_frame = None
+            with update.lock:
+                update.next_commit += 1
+                update.n_committed += 1
+                update.n_open -= 1
+        self._settle(update)
+        return None
+
+    @staticmethod
+    def _write_sql(unit):
+        snotel.delete_data(unit.element.ElementTriplet, unit.begin_date, unit.end_date)
+        snotel.add_data_frame(unit.data_frame, unit.tz_offset)
+
+    @staticmethod
+    def _after_failure(unit):
+        failed_at = unit.update.failed_at
+        return failed_at is not None and unit.sequence >= failed_at
+
+    def _drop(self, unit):
+        with unit.update.lock:
+            unit.update.n_open -= 1
+        self._settle(unit.update)
+        return None
+
+    def _failed(self, unit):
+        """ on_error of every stage: unit is an ElementUpdate (fetch) or an UpdateUnit """
+        update = getattr(unit, 'update', unit)
+        with self._lock:
+            self.errors.append((unit.element.ElementTriplet, unit.error))
+        with update.lock:
+            update.error = update.error or unit.error
+            sequence = getattr(unit, 'sequence', update.n_units)
+            update.failed_at = sequence if update.failed_at is None else min(update.failed_at, sequence)
+            if unit is not update:
+                update.n_open -= 1
+        self._settle(update)
+
+    def _settle(self, update):
+        """ Finish the element once it is fetched and every window is committed or dropped """
+        with update.lock:
+            if update.failed_at is not None:
+                for sequence in [sequence for sequence in update.pending if sequence >= update.failed_at]:
+                    del update.pending[sequence]
+                    update.n_open -= 1
+            if update.finished or not update.fetched or update.n_open:
+                return
+            update.finished = True
+        if update.error is None and update.n_committed:
+            with self._lock:
+                self.committed.append(update.element.ElementTriplet)
+        if self.on_finish is not None:
+            self.on_finish(update.element.ElementTriplet, update.error)
+
+    # Running
+    # =======
+    def _updates(self, work):
+        for item in work:
+            if isinstance(item, snotel.Element):
+                windows = [(None, None)]
+                element = item
+            else:
+                windows = list(item.windows())
+                element = item.element
+            yield ElementUpdate(element, windows)
+
+    def run(self, work):
+        """
+        :param work: update plan (list of WorkItem) or list of Element
+        :return: stats dict
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(4)]
+        spec = [('fetch', self.fetch, self.fetch_workers),
+                ('parse', self.parse, self.parse_workers),
+                ('write', self.write, self.write_workers),
+                ('commit', self.commit, 1)]
+        self.committed = []
+        self.errors = []
+        self.stages = [Stage(name, fn, workers, in_queue=queues[i], out_queue=queues[i + 1] if i < 3 else None,
+                             on_error=self._failed, fan_out=name == 'fetch')
+                       for i, (name, fn, workers) in enumerate(spec)]
+        for stage in self.stages:
+            stage.start()
+        for update in self._updates(work):
+            queues[0].put(update)
+        queues[0].put(_DONE)
+        for stage in self.stages:
+            stage.join()
+        return self.stats(self.committed)
+
+    def stats(self, committed):
+        stats = dict((stage.name, stage.n_done) for stage in self.stages)
+        stats['committed'] = committed
+        stats['errors'] = self.errors
+        return stats
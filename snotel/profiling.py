@@ -0,0 +1,150 @@
+''' Profiling
+    ~~~~~~~~~
+    Opt-in profiling of the update and load entry points.  A sampled call runs
+    under cProfile and tracemalloc; its call stats (.prof, readable with pstats
+    or snakeviz) and a text report of the top functions and allocations are
+    written to a per-run directory, with one line per call in index.jsonl.
+
+    Enable with SNOTEL_PROFILE=<sample rate> (e.g. 1 or 0.01), enable() or the
+    --profile flag; SNOTEL_PROFILE_DIR sets where runs are written.  When
+    disabled a wrapped call costs one flag check.
+'''
+
+__author__ = 'nsteiner'
+
+import io
+import os
+import json
+import time
+import pstats
+import random
+import logging
+import cProfile
+import datetime
+import functools
+import threading
+import tracemalloc
+import pathlib
+
+logger = logging.getLogger(__name__)
+
+_PATH = pathlib.Path(__file__).parent
+
+PROFILE_DIR = os.environ.get('SNOTEL_PROFILE_DIR', str(_PATH / 'profiles'))
+try:
+    RATE = float(os.environ.get('SNOTEL_PROFILE', 0.))
+except ValueError:
+    RATE = 1.
+ENABLED = RATE > 0.
+TOP_STATS = 40
+TOP_ALLOCATIONS = 20
+
+# one profiler can be active at a time, calls made while it is busy are not sampled
+_BUSY = threading.Lock()
+_RUN = {}
+
+
+def enable(rate=1., profile_dir=None):
+    """
+    :param rate: fraction of calls profiled
+    """
+    global ENABLED, RATE, PROFILE_DIR
+    RATE = float(rate)
+    ENABLED = RATE > 0.
+    if profile_dir:
+        PROFILE_DIR = profile_dir
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def run_dir():
+    """
+    :return: directory of this process' run, created on first use
+    """
+    if 'path' not in _RUN:
+        run_id = '{}_{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid())
+        path_ = pathlib.Path(PROFILE_DIR) / run_id
+        path_.mkdir(parents=True, exist_ok=True)
+        _RUN.update(path=path_, n_calls=0, lock=threading.Lock())
+    return _RUN['path']
+
+
+def _report(name, seconds, profile, snapshot):
+    out_ = io.StringIO()
+    out_.write('{} {:.3f} s\n\n'.format(name, seconds))
+    pstats.Stats(profile, stream=out_).sort_stats('cumulative').print_stats(TOP_STATS)
+    out_.write('\nTop allocations\n')
+    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        out_.write('{}\n'.format(stat))
+    return out_.getvalue()
+
+
+def _write(name, seconds, peak, profile, snapshot, call_info):
+    path_ = run_dir()
+    with _RUN['lock']:
+        _RUN['n_calls'] += 1
+        n_call = _RUN['n_calls']
+    stem_ = '{:05d}_{}'.format(n_call, name)
+    profile.dump_stats(str(path_ / (stem_ + '.prof')))
+    with open(path_ / (stem_ + '.txt'), 'w') as report_file:
+        report_file.write(_report(name, seconds, profile, snapshot))
+    with _RUN['lock'], open(path_ / 'index.jsonl', 'a') as index_file:
+        index_file.write(json.dumps(dict(call=n_call, name=name, seconds=seconds, peak_bytes=peak,
+                                         time=datetime.datetime.now().isoformat(), **call_info)) + '\n')
+
+
+def _describe(args):
+    # first argument is the station / element for the wrapped methods
+    return repr(args[0])[:200] if args else ''
+
+
+def _profile_call(name, fn, args, kwargs):
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another profiler is active in this process
+        return fn(*args, **kwargs)
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    else:
+        tracemalloc.reset_peak()
+    start_ = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profile.disable()
+        seconds = time.perf_counter() - start_
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            _write(name, seconds, peak, profile, snapshot, {'args': _describe(args)})
+        except OSError as e:
+            logger.warning('Could not write profile of %s: %s', name, e)
+
+
+def profiled(fn=None, name=None):
+    """
+    Decorator profiling a sampled fraction of calls when profiling is enabled.
+    Nested wrapped calls are part of the outer call's profile.
+    """
+    if fn is None:
+        return functools.partial(profiled, name=name)
+    name = name or fn.__qualname__
+
+    @functools.wraps(fn)
+    def _wrapped(*args, **kwargs):
+        if not ENABLED or random.random() >= RATE or not _BUSY.acquire(blocking=False):
+            return fn(*args, **kwargs)
+        try:
+            return _profile_call(name, fn, args, kwargs)
+        finally:
+            _BUSY.release()
+
+    return _wrapped
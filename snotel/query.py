@@ -0,0 +1,499 @@
+''' Query
+    ~~~~~
+    Analytical queries over the observation store.  A Query takes filters on
+    station attributes, element code, depth, duration and time, a projection and
+    an aggregation, and turns them into a QueryPlan:
+
+        - station and element predicates run as one SQL statement joining the
+          station and element tables
+        - the time window prunes the element parquet files by name, and time and
+          flag predicates are pushed into the parquet scan (row group statistics);
+          files with overlapping windows are merged keeping the row of the last
+          file, as the element readers do, before the flag predicate
+        - elements without parquet files are read from the data table (sql storage)
+        - batches are aggregated in Arrow as they are scanned (partial sums,
+          counts, extrema), partial results are merged, so memory follows the
+          number of groups, not the number of observations
+
+        Query(state='AK', network='SNTL', element_cd='STO', depth=-2.,
+              begin_date=datetime.datetime(2018, 12, 1), end_date=datetime.datetime(2019, 3, 1),
+              bucket='day', group_by=['station_triplet'], agg=['max']).to_frame()
+'''
+
+__author__ = 'nsteiner'
+
+import sys
+import logging
+import datetime
+import argparse
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from . import snotel
+from .snotel import Collection, Data, Element, Station, read_scope, NS_PER_HOUR
+from .elementrecord import duration_toload
+from .export import ordered_map, read_element_window, _par_overlaps, _par_range, EXPORT_WORKERS
+from .units import NATIVE, check_unit_system, get_conversion, native_unit
+
+logger = logging.getLogger(__name__)
+
+STATION_COLUMNS = ('Name', 'CountyName', 'Latitude', 'Longitude', 'Elevation', 'StationDataTimeZone')
+ELEMENT_COLUMNS = ('station_triplet', 'element_triplet', 'element_cd', 'depth', 'duration')
+COLUMNS = ELEMENT_COLUMNS + STATION_COLUMNS + ('datetime', 'value', 'flag')
+META_TYPES = dict([(name, pa.string()) for name in ELEMENT_COLUMNS + ('Name', 'CountyName')] +
+                  [(name, pa.float64()) for name in ('depth', 'Latitude', 'Longitude', 'Elevation',
+                                                     'StationDataTimeZone')])
+AGGREGATES = ('count', 'sum', 'min', 'max', 'mean', 'std')
+BUCKETS = ('hour', 'day', 'month', 'year')
+# partial aggregate column: how partials combine
+PARTIALS = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max', 'sq_sum': 'sum'}
+NEEDS = {'count': ('count',), 'sum': ('sum',), 'min': ('min',), 'max': ('max',),
+         'mean': ('sum', 'count'), 'std': ('sum', 'count', 'sq_sum')}
+COMBINE_ROWS = 10 ** 6
+DATA_FORMATS = ('par', 'sql')
+SCAN_SCHEMA = pa.schema([('utc', pa.int64()), ('value', pa.float64()), ('flag', pa.string())])
+# time bounds of open windows in data table scans
+OPEN_BEGIN = pd.Timestamp('1900-01-01').value
+OPEN_END = pd.Timestamp('2200-01-01').value
+
+
+def _file_groups(files):
+    """
+    :param files: parquet files of an element, in reader order
+    :return: lists of files whose windows overlap, in reader order
+    """
+    ranges = [_par_range(par_file) for par_file in files]
+    if any(range_ is None for range_ in ranges):
+        return [list(files)] if files else []
+    groups, group_end = [], None
+    for par_file, (begin_, end_) in sorted(zip(files, ranges), key=lambda item: item[1][0]):
+        if groups and begin_ <= group_end:
+            groups[-1].append(par_file)
+            group_end = max(group_end, end_)
+        else:
+            groups.append([par_file])
+            group_end = end_
+    order_ = dict((par_file, i) for i, par_file in enumerate(files))
+    return [sorted(group, key=order_.get) for group in groups]
+
+
+def _last_per_time(table):
+    """ one row per utc, the last one of the table """
+    order_ = pa.array(np.arange(table.num_rows, dtype='i8'))
+    last_ = table.append_column('order', order_).group_by('utc').aggregate([('order', 'max')])
+    return table.take(last_.column('order_max'))
+
+
+class ElementScan(object):
+    """
+    One element of the plan: metadata row, parquet files in the window (or the data table)
+    and the pushed-down filter.
+    """
+
+    def __init__(self, element, station, files, begin, end, qc=True, units=NATIVE, data_format='par'):
+        self.element = element
+        self.data_format = data_format
+        self.meta = {'station_triplet': element.StationTriplet, 'element_triplet': element.ElementTriplet,
+                     'element_cd': element.ElementCd, 'depth': element.HeightDepth, 'duration': element.Duration}
+        self.meta.update((key, getattr(station, key)) for key in STATION_COLUMNS)
+        self.tz_offset = station.StationDataTimeZone or 0.
+        self.files = files
+        self.begin = begin
+        self.end = end
+        self.qc = qc
+        _, self.scale, self.offset = get_conversion(native_unit(element.ElementCd), units)
+
+    def __repr__(self):
+        if self.data_format == 'sql':
+            return '<ElementScan {} sql>'.format(self.element.ElementTriplet)
+        return '<ElementScan {} files={}>'.format(self.element.ElementTriplet, len(self.files))
+
+    @property
+    def time_filter(self):
+        expression = None
+        if self.begin is not None:
+            expression = ds.field('utc') >= self.begin
+        if self.end is not None:
+            end_ = ds.field('utc') < self.end
+            expression = end_ if expression is None else expression & end_
+        return expression
+
+    @property
+    def filter(self):
+        expression = self.time_filter
+        if self.qc:
+            valid_ = ds.field('flag') == 'V'
+            expression = valid_ if expression is None else expression & valid_
+        return expression
+
+    def batches(self):
+        """ filtered (utc, value, flag) record batches, one row per time """
+        if self.data_format == 'sql':
+            element_data = read_element_window(self.element, OPEN_BEGIN if self.begin is None else self.begin,
+                                               OPEN_END if self.end is None else self.end, data_format='sql')
+            table = pa.Table.from_pandas(element_data.reset_index(), schema=SCAN_SCHEMA, preserve_index=False)
+            for batch in (table.filter(self.filter) if self.filter is not None else table).to_batches():
+                yield batch
+            return
+        for group in _file_groups(self.files):
+            if len(group) == 1:
+                for batch in self._file_batches(group[0], self.filter):
+                    yield batch
+                continue
+            # overlapping windows: the last file wins, then the flag filter
+            tables = [pa.Table.from_batches([batch]).cast(SCAN_SCHEMA)
+                      for par_file in group for batch in self._file_batches(par_file, self.time_filter)]
+            if not tables:
+                continue
+            table = _last_per_time(pa.concat_tables(tables))
+            if self.qc:
+                table = table.filter(pc.equal(table.column('flag'), 'V'))
+            for batch in table.to_batches():
+                if batch.num_rows:
+                    yield batch
+
+    def _file_batches(self, par_file, filter_):
+        dataset = ds.dataset(str(par_file), format='parquet')
+        utc_field = dataset.schema.field('utc') if 'utc' in dataset.schema.names else None
+        if utc_field is not None and pa.types.is_integer(utc_field.type):
+            for batch in dataset.to_batches(columns=['utc', 'value', 'flag'], filter=filter_):
+                if batch.num_rows:
+                    yield batch
+        else:
+            # files written before UTC storage, converted by the element reader
+            table = pa.Table.from_pandas(self.element._read_par(par_file)[['value', 'flag']].reset_index(),
+                                         preserve_index=False)
+            table = table.filter(filter_) if filter_ is not None else table
+            for batch in table.to_batches():
+                yield batch
+
+
+'''
+Plan
+~~~~
+'''
+
+
+class QueryPlan(object):
+
+    def __init__(self, query, scans, sql):
+        self.query = query
+        self.scans = scans
+        self.sql = sql
+
+    def __repr__(self):
+        return '<QueryPlan: {} elements {} files>'.format(len(self.scans), self.n_files)
+
+    @property
+    def n_files(self):
+        return sum(len(scan.files) for scan in self.scans)
+
+    @property
+    def n_sql(self):
+        return sum(scan.data_format == 'sql' for scan in self.scans)
+
+    def explain(self):
+        query = self.query
+        lines = ['Metadata (station x element):', '  ' + ' '.join(self.sql.split()),
+                 'Elements: {}  Files: {}  Data table: {}'.format(len(self.scans), self.n_files, self.n_sql),
+                 'Scan filter: {}'.format(self.scans[0].filter if self.scans else None),
+                 'Time view: {}  Units: {}'.format(query.tz, query.units)]
+        if query.agg:
+            lines.append('Aggregate: {} by {}'.format(', '.join(query.agg), ', '.join(query.keys) or '()'))
+            lines.append('  partials: {}'.format(', '.join(sorted(query.partials))))
+        else:
+            lines.append('Project: {}'.format(', '.join(query.projection)))
+        return '\n'.join(lines)
+
+
+class Query(object):
+    """
+    :param state: state code(s), see Collection
+    :param network: network code(s)
+    :param station_triplets: explicit station triplets
+    :param bbox: (lon_min, lat_min, lon_max, lat_max)
+    :param station_filter: Station column filters, e.g. {'FipsStateNumber': '02'}
+    :param element_cd: element code(s)
+    :param depth: HeightDepth value(s), any depth if None
+    :param duration: element duration(s); if None one loaded duration per sensor, the coarsest
+                     stored one that resolves the bucket (snotel.choose_durations)
+    :param begin_date: first time, in the `tz` view
+    :param end_date: end time (exclusive), in the `tz` view
+    :param columns: projection, see COLUMNS; ignored when aggregating
+    :param group_by: grouping columns when aggregating
+    :param bucket: 'hour', 'day', 'month' or 'year', adds the floored 'datetime' to the groups
+    :param agg: aggregates of value, see AGGREGATES
+    :param qc: valid flags only
+    :param units: unit system of value
+    :param tz: 'utc' or 'local' (station standard time) for time filters and output
+    :param data_format: 'par' or 'sql' storage to scan; if None parquet files, and the data table
+                        for elements without any
+    """
+
+    def __init__(self, state=None, network=None, station_triplets=None, bbox=None, station_filter=None,
+                 element_cd=None, depth=None, duration=None, begin_date=None, end_date=None, columns=None,
+                 group_by=None, bucket=None, agg=None, qc=True, units=NATIVE, tz='utc', workers=EXPORT_WORKERS,
+                 data_format=None):
+        if data_format is not None and data_format not in DATA_FORMATS:
+            raise ValueError('Unknown data format {}, choose from {}'.format(data_format, DATA_FORMATS))
+        self.data_format = data_format
+        self.collection = Collection(state=state, network=network, station_triplets=station_triplets, bbox=bbox)
+        self.station_filter = station_filter or {}
+        self.element_cd = snotel._as_list(element_cd)
+        if depth is not None:
+            depth = [float(value) for value in ([depth] if isinstance(depth, (int, float)) else depth)]
+        self.depth = depth
+        self.auto_duration = duration is None
+        self.duration = snotel._as_list(duration) or list(duration_toload)
+        self.begin_date = begin_date
+        self.end_date = end_date
+        self.units = check_unit_system(units)
+        if tz not in ('utc', 'local'):
+            raise ValueError('Query time view must be utc or local')
+        self.tz = tz
+        self.qc = qc
+        self.workers = workers
+        self.agg = snotel._as_list(agg) or []
+        unknown = [name for name in self.agg if name not in AGGREGATES]
+        if unknown:
+            raise ValueError('Unknown aggregates {}, choose from {}'.format(unknown, AGGREGATES))
+        if bucket is not None and bucket not in BUCKETS:
+            raise ValueError('Unknown bucket {}, choose from {}'.format(bucket, BUCKETS))
+        self.bucket = bucket
+        self.group_by = snotel._as_list(group_by) or []
+        self.projection = snotel._as_list(columns) or list(COLUMNS)
+        unknown = [name for name in self.group_by + self.projection if name not in COLUMNS]
+        if unknown:
+            raise ValueError('Unknown columns {}, choose from {}'.format(unknown, COLUMNS))
+
+    @property
+    def keys(self):
+        keys = [key for key in self.group_by if key != 'datetime']
+        return keys + ['datetime'] if self.bucket or 'datetime' in self.group_by else keys
+
+    @property
+    def partials(self):
+        return set(partial for name in self.agg for partial in NEEDS[name])
+
+    # Planning
+    # ========
+    def element_query(self, session):
+        station_ = self.collection.query(session).subquery()
+        query = session.query(Element, Station).join(Station, Station.StationTriplet == Element.StationTriplet). \
+            filter(Element.StationTriplet.in_(session.query(station_.c.StationTriplet))). \
+            filter(Element.Duration.in_(self.duration))
+        if self.station_filter:
+            query = query.filter(*[getattr(Station, key) == value for key, value in self.station_filter.items()])
+        if self.element_cd:
+            query = query.filter(Element.ElementCd.in_(self.element_cd))
+        if self.depth:
+            query = query.filter(Element.HeightDepth.in_(self.depth))
+        return query.order_by(Element.ElementTriplet)
+
+    def _utc_bound(self, date_, tz_offset):
+        if date_ is None:
+            return None
+        offset_ = int(round(tz_offset * NS_PER_HOUR)) if self.tz == 'local' else 0
+        return pd.Timestamp(date_).value - offset_
+
+    def plan(self):
+        scans = []
+        with read_scope() as session:
+            query = self.element_query(session)
+            sql = str(query.statement.compile(compile_kwargs={'literal_binds': True}))
+            rows = query.all()
+            session.expunge_all()
+        if self.auto_duration:
+            chosen = set(element.ElementTriplet for element in
+                         snotel.choose_durations([element for element, _ in rows], self.bucket or 'hour'))
+            rows = [(element, station) for element, station in rows if element.ElementTriplet in chosen]
+        par_files = dict((element.ElementTriplet, element.par_files if self.data_format != 'sql' else [])
+                         for element, _ in rows)
+        sql_triplets = self._sql_triplets([triplet for triplet, files in par_files.items() if not files])
+        for element, station in rows:
+            tz_offset = station.StationDataTimeZone or 0.
+            begin_ = self._utc_bound(self.begin_date, tz_offset)
+            end_ = self._utc_bound(self.end_date, tz_offset)
+            files = [par_file for par_file in par_files[element.ElementTriplet]
+                     if _par_overlaps(par_file, -2 ** 63 if begin_ is None else begin_,
+                                      2 ** 63 - 1 if end_ is None else end_)]
+            if files:
+                scans.append(ElementScan(element, station, files, begin_, end_, qc=self.qc, units=self.units))
+            elif element.ElementTriplet in sql_triplets:
+                scans.append(ElementScan(element, station, [], begin_, end_, qc=self.qc, units=self.units,
+                                         data_format='sql'))
+        return QueryPlan(self, scans, sql)
+
+    def _sql_triplets(self, element_triplets):
+        """ elements with rows in the data table """
+        if self.data_format == 'par' or not element_triplets:
+            return set()
+        snotel._ensure_data_table()
+        with read_scope() as session:
+            return set(triplet for triplet, in session.query(Data.ElementTriplet).
+                       filter(Data.ElementTriplet.in_(element_triplets)).distinct())
+
+    def explain(self):
+        return self.plan().explain()
+
+    # Execution
+    # =========
+    def _batch_table(self, scan, batch):
+        value_ = batch.column('value')
+        if scan.scale != 1. or scan.offset:
+            value_ = pc.add(pc.multiply(value_, scan.scale), scan.offset)
+        utc_ = batch.column('utc')
+        if self.tz == 'local':
+            utc_ = pc.add(utc_, int(round(scan.tz_offset * NS_PER_HOUR)))
+        datetime_ = utc_.cast(pa.int64()).cast(pa.timestamp('ns'))
+        if self.bucket:
+            datetime_ = pc.floor_temporal(datetime_, unit=self.bucket)
+        columns = {'datetime': datetime_, 'value': value_, 'flag': batch.column('flag')}
+        if self.agg:
+            columns['value_sq'] = pc.multiply(value_, value_)
+            names = self.keys + ['value'] + (['value_sq'] if 'sq_sum' in self.partials else [])
+        else:
+            names = self.projection
+        arrays = [columns[name] if name in columns else
+                  pa.array([scan.meta[name]] * batch.num_rows, type=META_TYPES[name]) for name in names]
+        return pa.Table.from_arrays(arrays, names=names)
+
+    def _partial(self, table):
+        aggregations = [('value_sq' if partial == 'sq_sum' else 'value',
+                         'sum' if partial == 'sq_sum' else partial) for partial in sorted(self.partials)]
+        partial_ = table.group_by(self.keys).aggregate(aggregations)
+        names = dict(('{}_{}'.format(column, how), partial)
+                     for (column, how), partial in zip(aggregations, sorted(self.partials)))
+        return partial_.rename_columns([names.get(name, name) for name in partial_.column_names])
+
+    def _combine(self, partial_list):
+        table = pa.concat_tables(partial_list)
+        partials = sorted(self.partials)
+        combined = table.group_by(self.keys).aggregate([(partial, PARTIALS[partial]) for partial in partials])
+        names = dict(('{}_{}'.format(partial, PARTIALS[partial]), partial) for partial in partials)
+        return combined.rename_columns([names.get(name, name) for name in combined.column_names])
+
+    def _finalize(self, table):
+        arrays, names = [table.column(key) for key in self.keys], list(self.keys)
+        for name in self.agg:
+            if name in ('count', 'sum', 'min', 'max'):
+                array_ = table.column(name)
+            elif name == 'mean':
+                array_ = pc.divide(table.column('sum'), pc.cast(table.column('count'), pa.float64()))
+            else:
+                count_ = pc.cast(table.column('count'), pa.float64())
+                mean_sq = pc.divide(pc.multiply(table.column('sum'), table.column('sum')), count_)
+                var_ = pc.divide(pc.subtract(table.column('sq_sum'), mean_sq), pc.subtract(count_, 1.))
+                array_ = pc.sqrt(pc.max_element_wise(var_, 0.))
+            arrays.append(array_)
+            names.append(name)
+        result = pa.Table.from_arrays(arrays, names=names)
+        return result.sort_by([(key, 'ascending') for key in self.keys]) if self.keys else result
+
+    def _scan(self, scan):
+        tables = [self._batch_table(scan, batch) for batch in scan.batches()]
+        if not tables:
+            return None
+        if self.agg:
+            return self._partial(pa.concat_tables(tables))
+        return pa.concat_tables(tables)
+
+    def _empty(self):
+        if not self.agg:
+            return pa.table(dict((name, pa.array([])) for name in self.projection))
+        return pa.table(dict((name, pa.array([])) for name in self.keys + self.agg))
+
+    def execute(self, plan=None):
+        """
+        :return: Arrow table, one row per observation (projection) or per group (aggregation)
+        """
+        plan = plan or self.plan()
+        logger.info('Query: %s', plan)
+        results, n_rows = [], 0
+        for _, table in ordered_map(self._scan, plan.scans, workers=self.workers):
+            if table is None:
+                continue
+            results.append(table)
+            n_rows += table.num_rows
+            if self.agg and n_rows > COMBINE_ROWS:
+                results = [self._combine(results)]
+                n_rows = results[0].num_rows
+        if not results:
+            return self._empty()
+        if self.agg:
+            return self._finalize(self._combine(results))
+        return pa.concat_tables(results)
+
+    def to_table(self):
+        return self.execute()
+
+    def to_frame(self):
+        return self.execute().to_pandas()
+
+
+def write_result(table, path):
+    path = pathlib.Path(path)
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, str(path))
+    elif path.suffix in ('.arrow', '.feather'):
+        with pa.ipc.new_file(str(path), table.schema) as writer:
+            writer.write_table(table)
+    else:
+        table.to_pandas().to_csv(path, index=False)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the local observation store')
+    parser.add_argument('--state', help='state code(s), comma separated')
+    parser.add_argument('--network', help='network code(s), comma separated')
+    parser.add_argument('--stations', help='station triplets, comma separated')
+    parser.add_argument('--bbox', help='lon_min,lat_min,lon_max,lat_max')
+    parser.add_argument('--element', help='element code(s), comma separated')
+    parser.add_argument('--depth', help='depth(s), comma separated')
+    parser.add_argument('--duration', help='duration(s), comma separated')
+    parser.add_argument('--begin', help='begin time, ISO format')
+    parser.add_argument('--end', help='end time (exclusive), ISO format')
+    parser.add_argument('--columns', help='projection, comma separated, from ' + ','.join(COLUMNS))
+    parser.add_argument('--group-by', help='grouping columns, comma separated')
+    parser.add_argument('--bucket', choices=BUCKETS)
+    parser.add_argument('--agg', help='aggregates, comma separated, from ' + ','.join(AGGREGATES))
+    parser.add_argument('--no-qc', action='store_true', help='keep every flag')
+    parser.add_argument('--units', default=NATIVE)
+    parser.add_argument('--tz', default='utc', choices=('utc', 'local'))
+    parser.add_argument('--data-format', choices=DATA_FORMATS, help='storage to scan, both if not given')
+    parser.add_argument('--explain', action='store_true', help='print the plan only')
+    parser.add_argument('--out', help='result file (.csv, .parquet, .arrow), printed if not given')
+    args = parser.parse_args(argv)
+
+    def _split(value, type_=str):
+        return [type_(item) for item in value.split(',')] if value else None
+
+    def _date(value):
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    query = Query(state=_split(args.state), network=_split(args.network), station_triplets=_split(args.stations),
+                  bbox=_split(args.bbox, float), element_cd=_split(args.element), depth=_split(args.depth, float),
+                  duration=_split(args.duration), begin_date=_date(args.begin), end_date=_date(args.end),
+                  columns=_split(args.columns), group_by=_split(args.group_by), bucket=args.bucket,
+                  agg=_split(args.agg), qc=not args.no_qc, units=args.units, tz=args.tz,
+                  data_format=args.data_format)
+    if args.explain:
+        print(query.explain())
+        return
+    table = query.execute()
+    if args.out:
+        write_result(table, args.out)
+    else:
+        print(table.to_pandas().to_string())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=snotel.LOG_FORMAT)
+    sys.exit(main())
@@ -0,0 +1,375 @@
+''' Data Service
+    ~~~~~~~~~~~~
+    Local read-only HTTP service over the storage and metadata layer, so one warm
+    process (frame cache, database connections) serves every consumer.
+
+        GET /stations?state=AK&network=SNTL&element=STO&bbox=lon_min,lat_min,lon_max,lat_max
+        GET /stations/<station triplet>
+        GET /stations/<station triplet>/elements
+        GET /elements/<element triplet>/series?begin=2019-01-01&end=2019-04-01&tz=local&units=metric
+        GET /elements/<element triplet>/daily?stats=mean,max&begin=...&end=...
+
+    Responses are JSON, or an Arrow IPC stream for series and daily with
+    format=arrow (or Accept: application/vnd.apache.arrow.stream).  ETags follow
+    the element's LocalEndDate (the station and element tables for searches), so
+    conditional requests get a 304 after one metadata query, and hot responses
+    are kept in a byte-bounded LRU.  Only the standard library HTTP server is
+    used; requests are handled in threads.
+
+        python -m snotel.service --port 8089
+'''
+
+__author__ = 'nsteiner'
+
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+import datetime
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import func
+
+from . import snotel
+from . import metrics
+from .snotel import Collection, Element, Station, read_scope
+from .framecache import FrameCache
+from .units import NATIVE, check_unit_system
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_BYTES = int(float(os.environ.get('SNOTEL_SERVICE_CACHE_MB', 64)) * 1024 ** 2)
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+JSON = 'application/json'
+STATION_FIELDS = ('StationTriplet', 'Name', 'CountyName', 'Latitude', 'Longitude', 'Elevation',
+                  'StationDataTimeZone', 'BeginDate', 'EndDate')
+ELEMENT_FIELDS = ('ElementTriplet', 'StationTriplet', 'ElementCd', 'HeightDepth', 'Duration', 'StoredUnitCd',
+                  'BeginDate', 'EndDate', 'LocalBeginDate', 'LocalEndDate')
+DAILY_STATS = ('mean', 'std', 'min', 'max', 'median', 'sum', 'count')
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, pd.Timestamp)):
+        return value.isoformat()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _record(obj, fields):
+    return dict((field, _json_value(getattr(obj, field))) for field in fields)
+
+
+def _etag(*parts):
+    return '"{}"'.format(hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20])
+
+
+def _date(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return pd.Timestamp(value)
+    except ValueError:
+        raise HTTPError(400, 'Bad {} date {}'.format(name, value))
+
+
+def _window(series_, begin, end):
+    index_ = series_.index
+    bounds = []
+    for date_ in (begin, end):
+        if date_ is not None and getattr(index_, 'tz', None) is not None and date_.tz is None:
+            date_ = date_.tz_localize(index_.tz)
+        bounds.append(date_)
+    mask = np.ones(len(series_), dtype=bool)
+    if bounds[0] is not None:
+        mask &= index_ >= bounds[0]
+    if bounds[1] is not None:
+        mask &= index_ < bounds[1]
+    return series_[mask]
+
+
+'''
+Resources
+~~~~~~~~~
+Each resource returns (etag, builder); the builder runs only on a cache miss and
+returns (content type, body).
+'''
+
+
+def _metadata_version():
+    with read_scope() as session:
+        return session.query(func.count(Station.StationTriplet)).scalar(), \
+            session.query(func.count(Element.ElementTriplet), func.max(Element.LocalEndDate)).one()
+
+
+def station_search(params):
+    def _split(name):
+        return params[name].split(',') if params.get(name) else None
+
+    bbox = [float(value) for value in params['bbox'].split(',')] if params.get('bbox') else None
+    collection = Collection(state=_split('state'), network=_split('network'), element_cd=_split('element'),
+                            station_triplets=_split('stations'), bbox=bbox,
+                            begin_date=_date(params, 'begin'), end_date=_date(params, 'end'))
+
+    def _build():
+        return JSON, {'stations': [_record(station, STATION_FIELDS) for station in collection.stations]}
+
+    return _etag('stations', _metadata_version()), _build
+
+
+def _get_station(station_triplet):
+    with read_scope() as session:
+        station = session.query(Station).filter(Station.StationTriplet == station_triplet).first()
+        element_list = session.query(Element).filter(Element.StationTriplet == station_triplet). \
+            order_by(Element.ElementTriplet).all()
+        session.expunge_all()
+    if station is None:
+        raise HTTPError(404, 'Unknown station {}'.format(station_triplet))
+    return station, element_list
+
+
+def station_detail(station_triplet, params):
+    station, element_list = _get_station(station_triplet)
+    version = [(element.ElementTriplet, element.LocalEndDate) for element in element_list]
+
+    def _build():
+        return JSON, _record(station, STATION_FIELDS)
+
+    return _etag('station', _record(station, STATION_FIELDS), version), _build
+
+
+def station_elements(station_triplet, params):
+    station, element_list = _get_station(station_triplet)
+
+    def _build():
+        return JSON, {'station': station_triplet,
+                      'elements': [_record(element, ELEMENT_FIELDS) for element in element_list]}
+
+    return _etag('elements', [_record(element, ELEMENT_FIELDS) for element in element_list]), _build
+
+
+def _get_element(element_triplet):
+    with read_scope() as session:
+        element = session.query(Element).filter(Element.ElementTriplet == element_triplet).first()
+        if element is not None:
+            session.expunge(element)
+    if element is None:
+        raise HTTPError(404, 'Unknown element {}'.format(element_triplet))
+    return element
+
+
+def _series_params(params):
+    try:
+        units = check_unit_system(params.get('units', NATIVE))
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    tz = params.get('tz', 'local')
+    if tz not in ('local', 'utc'):
+        raise HTTPError(400, 'Time view must be local or utc')
+    return units, tz, _date(params, 'begin'), _date(params, 'end')
+
+
+def _frame_body(element, data_frame, fmt, extra):
+    if fmt == 'arrow':
+        table = pa.Table.from_pandas(data_frame.rename_axis('datetime').reset_index(), preserve_index=False)
+        table = table.replace_schema_metadata(dict((key, str(value)) for key, value in extra.items()))
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return ARROW_STREAM, sink.getvalue()
+    body = dict(extra, element_triplet=element.ElementTriplet,
+                datetime=[value.isoformat() for value in data_frame.index])
+    for column in data_frame.columns:
+        body[column] = [None if pd.isnull(value) else value for value in data_frame[column].tolist()]
+    return JSON, body
+
+
+def element_series(element_triplet, params, fmt='json'):
+    element = _get_element(element_triplet)
+    units, tz, begin, end = _series_params(params)
+
+    def _build():
+        series_ = _window(element.to_series(units=units, tz=tz), begin, end)
+        return _frame_body(element, series_.to_frame('value'), fmt,
+                           {'units': series_.attrs.get('units'), 'unit_system': units, 'tz': tz})
+
+    return _etag('series', element_triplet, _json_value(element.LocalEndDate), units, tz, begin, end, fmt), _build
+
+
+def element_daily(element_triplet, params, fmt='json'):
+    element = _get_element(element_triplet)
+    units, tz, begin, end = _series_params(params)
+    stats = params.get('stats', 'mean').split(',')
+    unknown = [stat for stat in stats if stat not in DAILY_STATS]
+    if unknown:
+        raise HTTPError(400, 'Unknown statistics {}, choose from {}'.format(unknown, DAILY_STATS))
+
+    def _build():
+        series_ = _window(element.to_series(units=units, tz=tz), begin, end)
+        daily_ = series_.resample('D').agg(stats) if len(series_) else pd.DataFrame(columns=stats)
+        return _frame_body(element, daily_, fmt, {'units': series_.attrs.get('units'), 'unit_system': units,
+                                                  'tz': tz})
+
+    return _etag('daily', element_triplet, _json_value(element.LocalEndDate), units, tz, begin, end, stats,
+                 fmt), _build
+
+
+def route(path, params, fmt='json'):
+    """
+    :return: (route name, cache kind, triplet, etag, builder)
+    """
+    parts = [unquote(part) for part in path.strip('/').split('/')]
+    if parts == ['stations']:
+        return ('stations', 'search', None) + station_search(params)
+    if len(parts) == 2 and parts[0] == 'stations':
+        return ('station', 'station', parts[1]) + station_detail(parts[1], params)
+    if len(parts) == 3 and parts[0] == 'stations' and parts[2] == 'elements':
+        return ('elements', 'station', parts[1]) + station_elements(parts[1], params)
+    if len(parts) == 3 and parts[0] == 'elements' and parts[2] == 'series':
+        return ('series', 'element', parts[1]) + element_series(parts[1], params, fmt=fmt)
+    if len(parts) == 3 and parts[0] == 'elements' and parts[2] == 'daily':
+        return ('daily', 'element', parts[1]) + element_daily(parts[1], params, fmt=fmt)
+    raise HTTPError(404, 'Unknown resource {}'.format(path))
+
+
+'''
+Server
+~~~~~~
+'''
+
+
+class DataService(object):
+    """
+    :param cache_bytes: byte budget of the response LRU
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, cache_bytes=RESPONSE_CACHE_BYTES):
+        self.cache = FrameCache(max_bytes=cache_bytes, name='response')
+        self.n_requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    def __repr__(self):
+        return '<DataService: {}>'.format(self.url)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, path, query, if_none_match=None, accept=''):
+        """
+        :return: (route name, status, headers, body bytes)
+        """
+        with self._lock:
+            self.n_requests += 1
+        params = dict((key, values[-1]) for key, values in parse_qs(query).items())
+        fmt = params.pop('format', 'arrow' if ARROW_STREAM in (accept or '') else 'json')
+        if fmt not in ('json', 'arrow'):
+            raise HTTPError(400, 'Unknown format {}'.format(fmt))
+        name, kind, triplet, etag, builder = route(path, params, fmt=fmt)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return name, 304, headers, b''
+        key_ = (kind, triplet, name, tuple(sorted(params.items())), fmt, etag)
+        cached = self.cache.get(key_)
+        if cached is None:
+            content_type, body = builder()
+            if content_type == JSON:
+                body = json.dumps(body, default=_json_value).encode('utf-8')
+            cached = self.cache.put(key_, (content_type, body))
+            headers['X-Cache'] = 'miss'
+        else:
+            headers['X-Cache'] = 'hit'
+        headers['Content-Type'] = cached[0]
+        return name, 200, headers, cached[1]
+
+
+def _make_handler(service):
+
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+        def _send(self, status, headers, body):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            start_ = time.perf_counter()
+            url_ = urlsplit(self.path)
+            name = 'error'
+            try:
+                name, status, headers, body = service.handle(url_.path, url_.query,
+                                                             if_none_match=self.headers.get('If-None-Match'),
+                                                             accept=self.headers.get('Accept'))
+            except HTTPError as e:
+                status, headers, body = e.status, {'Content-Type': JSON}, json.dumps({'error': str(e)}).encode()
+            except Exception as e:
+                logger.exception('Service error %s', self.path)
+                status, headers, body = 500, {'Content-Type': JSON}, json.dumps({'error': str(e)}).encode()
+            self._send(status, headers, body)
+            metrics.inc('service_requests_total', route=name, status=status)
+            metrics.observe('service_request_seconds', time.perf_counter() - start_, route=name)
+
+    return _Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local SNOTEL data service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--cache-mb', dest='cache_mb', type=float, default=RESPONSE_CACHE_BYTES / 1024. ** 2,
+                        help='response cache budget')
+    args = parser.parse_args(argv)
+    service = DataService(host=args.host, port=args.port, cache_bytes=int(args.cache_mb * 1024 ** 2))
+    logger.info('Serving %s', service.url)
+    try:
+        service.server.serve_forever()
+    except KeyboardInterrupt:
+        service.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=snotel.LOG_FORMAT)
+    main()
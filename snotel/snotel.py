@@ -9,7 +9,10 @@ __email__ = 'nick@nicksteiner.com'
 __version__ = '0r9'
 
 import os
+import io
 import sys
+import hashlib
+import threading
 import copy
 import logging
 import datetime
@@ -17,6 +20,8 @@ import argparse
 import socket
 import itertools as it
 from multiprocessing import Pool
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 import pytz
@@ -24,14 +29,22 @@ import numpy as np
 import pandas as pd
 import sqlite3 as sql
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import MetaData, engine
+from sqlalchemy.orm import sessionmaker, relationship, selectinload, foreign
+from sqlalchemy import MetaData, engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import and_, or_, types, Column, create_engine, distinct, desc, asc
-
-from .elementrecord import elementcd_toload, duration_toload
+from sqlalchemy import and_, or_, types, Column, Index, create_engine, distinct, desc, asc, inspect, text, select, \
+    bindparam
+
+from .elementrecord import elementcd_toload, duration_toload, DURATIONS
+from . import metrics
+from .profiling import profiled
+from .framecache import FRAME_CACHE
+from .units import NATIVE, convert_frame, convert_series, check_unit_system
+from .client import AWDBClient
+from .cache import ResponseCache
+from .writer import GroupCommitWriter
 import pathlib
-from suds.client import Client
 
 '''
 Database Engines
@@ -41,9 +54,64 @@ _PATH = pathlib.Path(__file__).parent
 _DAT_PATH = _PATH / 'dat'
 _SQL_PATH = _PATH / 'snotel.sqlite'
 
-engine_str = 'sqlite:///{}'.format(_SQL_PATH.absolute())
+# SNOTEL_DB_URL selects the storage backend, e.g. postgresql://snotel@localhost/snotel
+engine_str = os.environ.get('SNOTEL_DB_URL', 'sqlite:///{}'.format(_SQL_PATH.absolute()))
+# connections of a server backend are pooled and shared by the threads of a process
+# (update pipeline workers, collections); keep DB_POOL_SIZE above the pipeline's write workers
+DB_POOL_SIZE = int(os.environ.get('SNOTEL_DB_POOL_SIZE', 8))
+DB_MAX_OVERFLOW = int(os.environ.get('SNOTEL_DB_MAX_OVERFLOW', 8))
+
+
+# SNOTEL_SQLITE_MODE=wal (default): WAL journal and the pragmas below, a pool of read-only
+# connections for readers (read_scope) and one writer thread batching data and element writes
+# into group commits (writer.py); 'legacy' keeps the sqlite defaults
+SQLITE_MODE = os.environ.get('SNOTEL_SQLITE_MODE', 'wal')
+SQLITE_READERS = int(os.environ.get('SNOTEL_SQLITE_READERS', 4))
+SQLITE_BUSY_TIMEOUT = 30.  # seconds
+SQLITE_PRAGMAS = [('synchronous', 'NORMAL'),  # WAL is still consistent, fsync at checkpoints
+                  ('cache_size', -65536),  # kB
+                  ('mmap_size', 256 * 1024 ** 2),
+                  ('temp_store', 'MEMORY')]
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA {}={}'.format(pragma, value))
+    cursor.close()
+
+
+def _sqlite_wal(dbapi_connection, connection_record):
+    _sqlite_connect(dbapi_connection, connection_record)
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
+def create_db_engine(url):
+    if url.startswith('sqlite'):
+        if SQLITE_MODE != 'wal' or url.rstrip('/') in ('sqlite:', 'sqlite:///:memory:'):
+            return engine.create_engine(url)
+        sqlite_engine = engine.create_engine(url, poolclass=QueuePool, pool_size=DB_POOL_SIZE,
+                                             max_overflow=DB_MAX_OVERFLOW,
+                                             connect_args={'check_same_thread': False,
+                                                           'timeout': SQLITE_BUSY_TIMEOUT})
+        event.listen(sqlite_engine, 'connect', _sqlite_wal)
+        return sqlite_engine
+    return engine.create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
+
+
+def create_writer(db_engine):
+    """
+    :return: GroupCommitWriter of a sqlite engine in WAL mode, None for other engines
+    """
+    if db_engine.dialect.name == 'sqlite' and isinstance(db_engine.pool, QueuePool):
+        return GroupCommitWriter(db_engine)
+    return None
+
 
-ee = engine.create_engine(engine_str)
+ee = create_db_engine(engine_str)
+writer = create_writer(ee)
 
 metadata = MetaData(bind=ee)
 Session = sessionmaker(bind=ee)
@@ -53,13 +121,21 @@ Base = declarative_base(metadata=metadata)
 collection_engine = ee  # reate_engine('sqlite:///{}'.format(os.path.join(_PATH, 'collection.sqlite')))
 
 
+_BATCH = threading.local()
+
+
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
+    if getattr(_BATCH, 'session', None) is not None:
+        # inside batch_scope: reuse its session, the batch commits
+        yield _BATCH.session
+        return
     session = Session()
     try:
         yield session
-        session.commit()
+        with metrics.timer('db_transaction_seconds', op='session'):
+            session.commit()
     except:
         session.rollback()
         raise
@@ -67,15 +143,49 @@ def session_scope():
         session.close()
 
 
+@contextmanager
+def read_scope():
+    """
+    Session for queries only, never committed; on sqlite in WAL mode its connection
+    comes from the read-only pool (read_engine), so readers never wait for writers.
+    """
+    if getattr(_BATCH, 'session', None) is not None:
+        yield _BATCH.session
+        return
+    session = Session(bind=read_engine())
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@contextmanager
+def batch_scope():
+    """
+    One session (and transaction) for every session_scope and write_transaction in the block
+    on this thread, e.g. the lookups and writes of a station group.  On sqlite in WAL mode the
+    writes of the block are group committed by the writer thread instead, and the block has
+    no session of its own.
+    """
+    if getattr(_BATCH, 'session', None) is not None:
+        yield _BATCH.session
+        return
+    if writer is not None:
+        yield None
+        return
+    with session_scope() as session:
+        _BATCH.session = session
+        try:
+            yield session
+        finally:
+            _BATCH.session = None
+
+
 # LOGGING
 # =======
-logging.basicConfig(level=logging.INFO,
-                    filename='snotel.log',
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%m-%d %H:%M')
-
-# output logging to stdout
-VERBOSE = True
+# handlers are left to the application, main() logs to stderr
+logger = logging.getLogger(__name__)
+LOG_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
 
 # SOAP Client Configuration
 # =========================
@@ -89,15 +199,150 @@ except AttributeError:
 else:
     ssl._create_default_https_context = _create_unverified_https_context
 
-URL = 'http://www.wcc.nrcs.usda.gov/awdbWebService/services?wsdl'
+# SNOTEL_AWDB_URL points the package at another service, e.g. a local stand-in (standin.py)
+URL = os.environ.get('SNOTEL_AWDB_URL', 'http://www.wcc.nrcs.usda.gov/awdbWebService/services?wsdl')
+
+# metadata responses are cached on disk, SNOTEL_CACHE_MODE=record|replay for recorded sessions
+CACHE_PATH = os.environ.get('SNOTEL_CACHE', str(_PATH / 'cache'))
+CACHE_MODE = os.environ.get('SNOTEL_CACHE_MODE', 'normal')
+
+client = AWDBClient(URL, cache=ResponseCache(CACHE_PATH, mode=CACHE_MODE))
+
+
+MAX_TZ_OFFSET = 14  # hours, largest UTC offset of a station local time
+
+# SNOTEL_DURATIONS=HOURLY,DAILY,SEMIMONTHLY also ingests daily and semimonthly elements
+def set_durations(durations):
+    """
+    Element durations stored by ingest, e.g. set_durations(['HOURLY', 'DAILY']).  DAILY and
+    SEMIMONTHLY data come from getData (a value per period) and live in their own partitions.
+    """
+    durations = [duration.upper() for duration in durations]
+    unknown = set(durations) - set(DURATIONS)
+    if unknown:
+        raise ValueError('Unknown durations {}, choose from {}'.format(sorted(unknown), DURATIONS))
+    # the list is shared by every module that imported it
+    duration_toload[:] = durations
+
+
+if os.environ.get('SNOTEL_DURATIONS'):
+    set_durations(os.environ['SNOTEL_DURATIONS'].split(','))
+
+
+def set_service_url(url):
+    """
+    Switch the AWDB service of this process, e.g. set_service_url(standin.url).
+    """
+    global URL
+    URL = url
+    client.set_url(url)
+
+
+def set_engine(url):
+    """
+    Switch the database of this process, e.g. set_engine('postgresql://snotel@localhost/snotel').
+    """
+    global ee, engine_str, collection_engine, writer
+    if writer is not None:
+        writer.stop()
+    _dispose_read_engine()
+    ee.dispose()
+    engine_str = url
+    ee = create_db_engine(url)
+    writer = create_writer(ee)
+    metadata.bind = ee
+    Session.configure(bind=ee)
+    collection_engine = ee
+    del _CHANGE_TABLE[:]
+    del _DATA_TABLE[:]
+    del _STATION_CODES[:]
+    _DATA_PARTITIONS.clear()
+    _TZ_CACHE.clear()
+    return ee
+
+
+def write_transaction(fn, op='write'):
+    """
+    Run fn(connection) in a write transaction, on sqlite in WAL mode as part of a
+    group commit of the writer thread.
+
+    :param op: transaction label of the db_transaction_seconds metric
+    :return: result of fn
+    """
+    if writer is not None:
+        return writer.write(fn)
+    if getattr(_BATCH, 'session', None) is not None:
+        # inside batch_scope: part of the batch transaction
+        return fn(_BATCH.session.connection())
+    with metrics.timer('db_transaction_seconds', op=op), ee.begin() as conn:
+        return fn(conn)
+
+
+def row_values(obj):
+    """
+    :return: {column: value} of a mapped object, unset attributes as None
+    """
+    return dict((column.name, getattr(obj, column.name, None)) for column in obj.__table__.columns)
+
+
+def replace_rows(conn, obj_list):
+    """
+    Insert mapped objects, replacing the rows with the same primary key; the write_transaction
+    counterpart of session.merge.
+    """
+    for obj in obj_list:
+        table_ = obj.__table__
+        conn.execute(table_.delete().where(and_(*[column == getattr(obj, column.name)
+                                                  for column in table_.primary_key.columns])))
+        conn.execute(table_.insert().values(row_values(obj)))
+
 
-client = Client(URL, timeout=900)
+_READ_ENGINE = []
+_READ_LOCK = threading.Lock()
+
+
+def read_engine():
+    """
+    :return: engine of read-only, pooled connections on sqlite in WAL mode, else the engine
+    """
+    if writer is None:
+        return ee
+    with _READ_LOCK:
+        if not _READ_ENGINE:
+            path = ee.url.database
+            if not os.path.exists(path):
+                # nothing written yet
+                return ee
+            uri = 'file:{}?mode=ro'.format(pathlib.Path(path).absolute().as_posix())
+            reader = engine.create_engine(
+                'sqlite://', poolclass=QueuePool, pool_size=SQLITE_READERS, max_overflow=SQLITE_READERS,
+                creator=lambda: sql.connect(uri, uri=True, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT))
+            event.listen(reader, 'connect', _sqlite_connect)
+            _READ_ENGINE.append(reader)
+        return _READ_ENGINE[0]
+
+
+def _dispose_read_engine():
+    with _READ_LOCK:
+        for reader in _READ_ENGINE:
+            reader.dispose()
+        del _READ_ENGINE[:]
+
+
+def concurrent_writes():
+    """
+    :return: True if the backend takes data inserts from several connections at once (not sqlite)
+    """
+    return ee.dialect.name != 'sqlite'
 
 '''
     Lazy Property Init
     ~~~~~~~~~~~~~~~~~~
     Lazy initialization of data intensive and readonly object properties
     NOTE: requires unique _get_+attrname function to initialize
+    Values live in the shared, byte-bounded frame cache (framecache.py) under the
+    object's cache_key and cache_options; objects without a key, or with options
+    None, keep the value on the instance.
 '''
 
 
@@ -107,6 +352,10 @@ def lazy_init(fn):
     @property
     def _lazy_init(self):
         attr_setter = getattr(self, '_get_' + fn.__name__)
+        cache_key = getattr(self, 'cache_key', None)
+        cache_options = getattr(self, 'cache_options', ())
+        if cache_key is not None and cache_options is not None:
+            return FRAME_CACHE.get_or_load(cache_key + (fn.__name__,) + cache_options, attr_setter)
         if not hasattr(self, attr_name):
             setattr(self, attr_name, attr_setter())
         return getattr(self, attr_name)
@@ -126,6 +375,8 @@ lowerCamel = lambda name: name[0].lower() + name[1:]
 
 DATE_FORMAT_TO = lambda x: x.strftime('%Y-%m-%d %H:%M')
 DATE_FORMAT_FROM = lambda x: datetime.datetime.strptime(x, '%Y-%m-%d %H:%M')
+# getData (daily, semimonthly) takes dates
+DAY_FORMAT_TO = lambda x: x.strftime('%Y-%m-%d')
 DATA_REQUEST_FMT = {
     'stationTriplets': str,
     'elementCd': str,
@@ -134,6 +385,73 @@ DATA_REQUEST_FMT = {
     'beginDate': DATE_FORMAT_TO,
     'endDate': DATE_FORMAT_TO}
 
+'''
+Time Functions
+~~~~~~~~~~~~~~
+Stored timestamps are UTC, int64 nanoseconds since epoch. AWDB reports station
+local (standard) time, converted at ingest with the station StationDataTimeZone.
+'''
+
+NS_PER_HOUR = 3600 * 10 ** 9
+TIME_VIEWS = ('local', 'utc', 'int')
+_TZ_CACHE = {}
+
+
+def get_station_timezone(station_triplet):
+    """
+    :param station_triplet: station triplet
+    :return: StationDataTimeZone, hours offset from UTC
+    """
+    if station_triplet not in _TZ_CACHE:
+        with session_scope() as session:
+            tz_offset = session.query(Station.StationDataTimeZone). \
+                filter(Station.StationTriplet == station_triplet).scalar()
+        if tz_offset is None:
+            tz_offset = get_station_meta(station_triplet).stationDataTimeZone
+        _TZ_CACHE[station_triplet] = float(tz_offset)
+    return _TZ_CACHE[station_triplet]
+
+
+def station_now(station_triplet, utc_now=None, tz_offset=None):
+    """
+    :param utc_now: reference time, UTC, defaults to now
+    :param tz_offset: StationDataTimeZone, looked up if None
+    :return: the reference time in station local (standard) time, comparable with LocalEndDate
+    """
+    if tz_offset is None:
+        tz_offset = get_station_timezone(station_triplet)
+    return (utc_now or datetime.datetime.utcnow()) + datetime.timedelta(hours=tz_offset)
+
+
+def local_to_utc(date_times, tz_offset):
+    """
+    :param date_times: station local date strings or datetimes
+    :param tz_offset: StationDataTimeZone, hours
+    :return: int64 array, UTC ns since epoch
+    """
+    local_ns = pd.to_datetime(np.asarray(date_times)).values.astype('datetime64[ns]').view('i8')
+    return local_ns - int(round(tz_offset * NS_PER_HOUR))
+
+
+def time_index(utc_index, tz_offset=0., tz='local'):
+    """
+    Build a datetime view of a UTC int64 index. Only the index is rebuilt, data is untouched.
+
+    :param utc_index: int64 UTC ns index
+    :param tz_offset: StationDataTimeZone, hours; used for the 'local' view
+    :param tz: 'local' (fixed station offset), 'utc' or 'int' (stored int64)
+    :return: index
+    """
+    if tz not in TIME_VIEWS:
+        raise ValueError('Unknown time view {}, choose from {}'.format(tz, TIME_VIEWS))
+    if tz == 'int':
+        return utc_index
+    index_ = pd.DatetimeIndex(np.asarray(utc_index, dtype='i8').view('datetime64[ns]'), name='DateTime')
+    index_ = index_.tz_localize('UTC')
+    if tz == 'local':
+        index_ = index_.tz_convert(pytz.FixedOffset(int(round(tz_offset * 60))))
+    return index_
+
 '''
 Query Functions
 ~~~~~~~~~~~~~~~
@@ -188,20 +506,62 @@ def find_stationtriplet_byid(id_number, state_abbr):
 
 def get_station_list_byelement(element_str, fips_number='02'):
     with session_scope() as session:
-        '''
-        select distinct s."StationTriplet" from station s, element e
-          where e."StationTriplet" = s."StationTriplet" and
-          e."ElementTriplet" like '%STO%' and
-          s."FipsStateNumber" like '02';
-
-        '''  # ^ example
-        results = session.query(Station, Element). \
-            filter(and_(Element.StationTriplet == Station.StationTriplet,
-                        Station.FipsStateNumber == fips_number,
-                        Element.ElementCd == element_str)).all()
+        results = session.query(Station.StationTriplet). \
+            filter(Station.FipsStateNumber == fips_number). \
+            filter(Station.elements.any(Element.ElementCd == element_str)).all()
+    return [station_triplet for station_triplet, in results]
+
+
+def load_stations(station_triplets=None, filters=('duration', 'elementcd'), query=None):
+    """
+    Stations with their elements in two queries (select-in), instead of one query per station.
+
+    :param station_triplets: stations to load, all local stations if None
+    :param filters: element filters applied in the element query, see filter_elements
+    :param query: station query to load instead, e.g. Collection.query(session) of triplets
+    :return: detached Station objects, station.elements and station.element_list loaded
+    """
+    element_criteria = []
+    for filter_ in filters or ():
+        if filter_.lower() == 'duration':
+            element_criteria.append(Element.Duration.in_(duration_toload))
+        if filter_.lower() == 'elementcd':
+            element_criteria.append(Element.ElementCd.in_(elementcd_toload))
+    elements_ = Station.elements.and_(*element_criteria) if element_criteria else Station.elements
+    with session_scope() as session:
+        station_query = session.query(Station).options(selectinload(elements_))
+        if query is not None:
+            station_query = station_query.filter(Station.StationTriplet.in_(query.subquery()))
+        if station_triplets is not None:
+            station_query = station_query.filter(Station.StationTriplet.in_(list(station_triplets)))
+        station_list = station_query.order_by(Station.StationTriplet).all()
         session.expunge_all()
-    station_triplet_set = set([ntuple.Station.StationTriplet for ntuple in results])
-    return list(station_triplet_set)
+    for station in station_list:
+        station._element_list = list(station.elements)
+        if station.StationDataTimeZone is not None:
+            _TZ_CACHE.setdefault(station.StationTriplet, float(station.StationDataTimeZone))
+    return station_list
+
+
+def get_stations_data_frame(station_list, units=NATIVE, tz='utc', **kwargs):
+    """
+    Join station frames on the common UTC axis.
+
+    :param station_list: list of Station objects
+    :param tz: time view of the joined index, 'utc' or 'int'
+    :return: frame with the element triplet columns of all stations
+    """
+    if tz == 'local':
+        raise ValueError('Stations do not share a local time, use tz="utc" or tz="int"')
+    frame_list = [station.get_data_frame(units=units, tz='int', **kwargs) for station in station_list]
+    data_frame = pd.concat(frame_list, axis=1, sort=True)
+    units_ = {}
+    for frame_ in frame_list:
+        units_.update(frame_.attrs.get('units', {}))
+    data_frame.index = time_index(data_frame.index, tz=tz)
+    data_frame.attrs['units'] = units_
+    data_frame.attrs['unit_system'] = check_unit_system(units)
+    return data_frame
 
 
 def get_station_objects(filters=STATION_FILTER):
@@ -209,7 +569,7 @@ def get_station_objects(filters=STATION_FILTER):
 
 
 def get_station_list(local=True):
-    print('Getting station list ...')
+    logger.info('Getting station list ...')
     if local:
         with session_scope() as session:
             station_tuples = session.query(Station.StationTriplet).all()
@@ -255,49 +615,71 @@ def get_station_meta(station_triplet=None, station_list=None):
 
 
 def add_station(station):
-    with session_scope() as session:
-        session.merge(station)
-    session.commit()
+    write_transaction(lambda conn: replace_rows(conn, [station]), op='station')
 
 
-def update_station_list(station_list):
+@profiled
+def update_station_list(station_list, journal_run=None):
     """
 
     Update all stations METADATA from NWCC webservice.
+
+    :param journal_run: record progress in the job journal under this run name (see journal.py),
+                        stations finished by an earlier attempt of the run are skipped
     """
-    metadata.create_all()
+    create_indexes()
     n_stations = len(station_list)
-    print('Station retrieved, {} total ...'.format(n_stations))
-    print(','.join(station_list[:10] + ['...']))
-    print('Getting station metadata, will take ~{:.2g} minutes ... '.format(n_stations * METMIN))
-    station_meta_list = []
+    logger.info('Station retrieved, %s total ...', n_stations)
+    logger.debug(','.join(station_list[:10] + ['...']))
+    logger.info('Getting station metadata, will take ~%.2g minutes ... ', n_stations * METMIN)
+    if journal_run:
+        from .journal import Journal
+        journal = Journal(journal_run, 'stations')
+        journal.plan(station_list)
+        return journal.run(update_station_group, batch_size=GRPSIZE)
     ct = 0
     n_groups = n_stations / GRPSIZE
     for station_group in grouper(station_list, GRPSIZE):
-        station_meta_list.extend(get_station_meta(station_list=station_group))
+        update_station_group(station_group)
         ct += 1
-        print('Retrieved station meta group {}/{}...'.format(ct, n_groups))
-    print('Station metadata retrieved ...')
+        logger.info('Retrieved station meta group %s/%s...', ct, n_groups)
+    logger.info('Update complete ...')
+
+
+def update_station_group(station_group):
+    """
+    Fetch and store metadata for up to GRPSIZE stations with one request.
+
+    :return: {station_triplet: error} for the stations that failed
+    """
+    errors = dict((station_triplet, 'No metadata returned') for station_triplet in station_group)
+    station_meta_list = get_station_meta(station_list=station_group)
+    with batch_scope():
+        _add_station_group(station_meta_list, errors)
+    return errors
+
+
+def _add_station_group(station_meta_list, errors):
     for station_meta in station_meta_list:
         try:
             station = construct_station(station_meta)
-            print('Adding: ' + station.__str__())
+            logger.debug('Adding: %s', station)
         except Exception as e:
-            print(e)
             station = None
-            print('Error Getting: {}'.format(station_meta['stationTriplet']))
+            logger.error('Error Getting: %s (%s)', station_meta['stationTriplet'], e)
+            errors[station_meta['stationTriplet']] = 'Error Getting: {}'.format(e)
 
         if station:
             try:
                 add_station(station)
+                errors.pop(station.StationTriplet, None)
             except Exception as e:
-                print(e)
-                print('Error Adding: {}'.format(station.StationTriplet))
-    print('Update complete ...')
+                logger.error('Error Adding: %s (%s)', station.StationTriplet, e)
+                errors[station.StationTriplet] = 'Error Adding: {}'.format(e)
 
 
 def update_station_elements(station):
-    print('Updating station {}'.format(station.StationTriplet))
+    logger.info('Updating station %s', station.StationTriplet)
     try:
         element_meta_list = get_element_bystationtriplet(station.StationTriplet, local=False)
         for el in element_meta_list:
@@ -307,8 +689,7 @@ def update_station_elements(station):
             except Exception as e:
                 raise (e('Error adding getting element for - {}'.format(station.StationTriplet)))
     except Exception as e:
-        print(e)
-        print('Error getting element list: {}'.format(station.StationTriplet))
+        logger.error('Error getting element list: %s (%s)', station.StationTriplet, e)
         add_elements(element_meta_list)
         try:
             add_elements(element_meta_list)
@@ -316,35 +697,55 @@ def update_station_elements(station):
             raise (e('Error adding getting element for - {}'.format(station.StationTriplet)))
 
 
-def update_stationlist_elements(station_list=None):
+def update_stationlist_elements(station_list=None, lease_run=None, journal_run=None):
     """
 
+    :param lease_run: distributed mode, claim station shards of this run through the lease table
+                      (see lease.py); start the same call on every worker node
+    :param journal_run: record progress in the job journal under this run name (see journal.py),
+                        stations finished by an earlier attempt of the run are skipped
     :rtype : None
     """
     if not station_list:
         station_list = get_station_list(local=True)
+    create_indexes()
+    if lease_run:
+        from .lease import run_distributed
+        return run_distributed(lease_run, station_list, kind='station', job='elements')
+    if journal_run:
+        from .journal import Journal
+        journal = Journal(journal_run, 'elements')
+        journal.plan(station_list)
+        return journal.run(_update_elements_journaled)
     n_stations = len(station_list)
     ct = 1
     for station_triplet in station_list:
-        print('Updating station {};  {}/{}'.format(station_triplet, ct, n_stations))
+        logger.info('Updating station %s;  %s/%s', station_triplet, ct, n_stations)
         try:
             element_meta_list = get_element_bystationtriplet(station_triplet, local=False)
-            for el in element_meta_list:
-                assert isinstance(el, Element)
-                add_element(el)
+            with batch_scope():
+                for el in element_meta_list:
+                    assert isinstance(el, Element)
+                    add_element(el)
         except Exception as e:
-            print(e)
-            print('Error getting element list: {}'.format(station_triplet))
+            logger.error('Error getting element list: %s (%s)', station_triplet, e)
             ct += 1
             add_elements(element_meta_list)
             try:
                 add_elements(element_meta_list)
             except Exception as e:
-                print(e)
-                Exception('Error adding elements for: {}'.format(station_triplet))
+                logger.error('Error adding elements for: %s (%s)', station_triplet, e)
         ct += 1
 
 
+def _update_elements_journaled(station_group):
+    for station_triplet in station_group:
+        element_list = get_element_bystationtriplet(station_triplet, local=False)
+        with batch_scope():
+            for el in element_list:
+                add_element(el)
+
+
 def update_station_data(station, inpool=False):
     update_station_elements(station)
     if inpool:
@@ -402,24 +803,33 @@ def get_element_bystationtriplet(station_triplet, local=True, filters=('duration
     return station_elements
 
 
-def cast_update_element_request(element):
+def cast_update_element_request(element, begin_date=None, end_date=None):
     """
     See details for data request: http://www.wcc.nrcs.usda.gov/web_service/AWDB_Web_Service_Reference.htm#getHourlyData
     :param element: instance of Element class
-    :return: getHourlyData Request dictionary
+    :param begin_date: start of the requested window, defaults to the hour after LocalEndDate
+    :param end_date: end of the requested window, defaults to now
+    :return: getHourlyData Request dictionary, getData for daily and semimonthly elements
     """
     assert isinstance(element, Element)
     request = {}
     data_request_fmt = copy.deepcopy(DATA_REQUEST_FMT)
     data_request_fmt.pop('stationTriplets')
+    date_format = DATE_FORMAT_TO if element.Duration == 'HOURLY' else DAY_FORMAT_TO
 
     request['stationTriplets'] = element.StationTriplet
     # SET TO BEGIN AND END
-    request['endDate'] = DATE_FORMAT_TO(datetime.datetime.now())
-    if element.LocalEndDate is None:
-        request['beginDate'] = DATE_FORMAT_TO(element.BeginDate)
+    request['endDate'] = date_format(end_date or station_now(element.StationTriplet))
+    if begin_date is not None:
+        request['beginDate'] = date_format(begin_date)
+    elif element.LocalEndDate is None:
+        request['beginDate'] = date_format(element.BeginDate)
     else:
-        request['beginDate'] = DATE_FORMAT_TO(element.LocalEndDate + datetime.timedelta(hours=1))
+        request['beginDate'] = date_format(element.LocalEndDate + duration_step(element.Duration))
+    if element.Duration != 'HOURLY':
+        request['duration'] = element.Duration
+        request['getFlags'] = True
+        request['alwaysReturnDailyFeb29'] = False
     # get the rest from the element
     for key, fun in data_request_fmt.items():
         if key not in request:
@@ -457,11 +867,17 @@ def filter_elements(element_list, filters=('duration', 'elementcd')):
     return element_list
 
 
-def add_element(element):
-    with session_scope() as session:
-        session.merge(element)
-        session.commit()
-    print('Added element: {}'.format(element))
+def add_element(element, change=None):
+    """
+    :param change: Change row committed in the same transaction as the element
+    """
+    def write_element(conn):
+        replace_rows(conn, [element])
+        if change is not None:
+            lock_change_feed(conn)
+            conn.execute(Change.__table__.insert().values(change.values()))
+    write_transaction(write_element, op='element')
+    logger.debug('Added element: %s', element)
 
 
 def add_elements(element_meta_list):
@@ -470,31 +886,23 @@ def add_elements(element_meta_list):
         add_element(element)
 
 
-def add_element_inpool(element):
-    print('Attempting update element {} ...'.format(element))
-    etable = metadata.tables['element']
-    print('Deleting element {} ...'.format(element))
-    with ee.begin() as conn:
-        conn.execute(etable.delete().where(etable.c.ElementTriplet == element.ElementTriplet))
-    print('Reading element {} ...'.format(element))
-    with ee.begin() as conn:
-        values_ = (element.BeginDate, element.DataPrecision,
-                   element.DataSource, element.Duration, element.ElementCd,
-                   element.EndDate, element.Ordinal, element.OriginalUnitCd,
-                   element.StationTriplet, element.StoredUnitCd,
-                   element.HeightDepth, element.ElementTriplet, element.LocalBeginDate,
-                   element.LocalEndDate)
-        conn.execute(etable.insert().values(values_))
-    print('Updated element {} ...'.format(element))
+def add_element_inpool(element, change=None):
+    """
+    add_element for concurrent updaters: element writes go through write_transaction, so
+    on sqlite in WAL mode they are group committed by the writer thread.
+    """
+    logger.debug('Updating element %s ...', element)
+    add_element(element, change=change)
+    logger.debug('Updated element %s ...', element)
 
 
-def update_element_data_list_inpool(element_list):
+def update_element_data_list_inpool(element_list, data_format='par'):
+    """
+    Update elements concurrently through the staged pipeline; a single writer owns the database.
+    """
     if element_list:
-        pool = Pool(maxtasksperchild=1)
-        args = [(e, True) for e in element_list]
-        pool.starmap(update_element_data, args)
-        pool.terminate()
-        pool.join()
+        from .pipeline import UpdatePipeline
+        return UpdatePipeline(data_format=data_format).run(element_list)
 
 
 def update_element_data_list_series(element_list):
@@ -503,29 +911,49 @@ def update_element_data_list_series(element_list):
             update_element_data(element, in_pool=False)
 
 
-def update_element_data(element, in_pool=False, data_format='par', overwrite=False):
+@profiled
+def update_element_data(element, in_pool=False, data_format='par', overwrite=False, begin_date=None, end_date=None):
     """
 
+    :param begin_date: optional start of the window to fetch, see cast_update_element_request
+    :param end_date: optional end of the window to fetch
     :rtype : None
     """
-    request = cast_update_element_request(element)
-    print('REQUESTING: {}'.format(request))
-    data_result = get_data_hourly(request)
-    print('Done ...')
+    request = cast_update_element_request(element, begin_date=begin_date, end_date=end_date)
+    logger.debug('REQUESTING: %s', request)
+    data_result = fetch_data(request)
     assert len(data_result) == 1
     data_result = data_result[0]
     if 'values' in data_result:
-        begin_date, end_date = update_data(element, data_result, data_format=data_format)
+        begin_date, end_date, data_frame = update_data(element, data_result, data_format=data_format)
+        commit_element_update(element, begin_date, end_date, in_pool=in_pool, data_frame=data_frame,
+                              data_format=data_format)
+    else:
+        logger.debug('No new data found for %s', element)
+
+
+def commit_element_update(element, begin_date, end_date, in_pool=False, data_frame=None, data_format='par'):
+    """
+    Element table bookkeeping after new data has been stored, with the change feed row
+    (changes.py) in the same transaction, then the element summary (summary.py).
+
+    :param data_frame: stored frame (parse_data_frame), for the change row count, content hash and summary
+    """
+    if element.LocalBeginDate is None or begin_date < element.LocalBeginDate:
         element.LocalBeginDate = begin_date
+    if element.LocalEndDate is None or end_date > element.LocalEndDate:
         element.LocalEndDate = end_date
-        print('Updating element table ...')
-        # add_element(element)
-        if in_pool:
-            add_element_inpool(element)
-        else:
-            add_element(element)
+    FRAME_CACHE.invalidate('element', element.ElementTriplet)
+    FRAME_CACHE.invalidate('station', element.StationTriplet)
+    change = Change.from_update(element, begin_date, end_date, data_frame=data_frame, data_format=data_format)
+    logger.debug('Updating element table ...')
+    if in_pool:
+        add_element_inpool(element, change=change)
     else:
-        print('No new data found ...')
+        add_element(element, change=change)
+    if data_frame is not None:
+        from .summary import update_summary
+        update_summary(element, data_frame)
 
 
 '''
@@ -548,13 +976,13 @@ def delete_data(element_triplet, start_date, end_date):
     :param start_date: start of data to delete
     :param end_date: end of data to delete
     """
+    _ensure_data_table()
     dtable = metadata.tables['data']
-    with ee.begin() as conn:
-        conn.execute(
-            dtable.delete().where(dtable.c.ElementTriplet == element_triplet). \
-                where(dtable.c.DateTime >= start_date). \
-                where(dtable.c.DateTime <= end_date)
-        )
+    write_transaction(lambda conn: conn.execute(
+        dtable.delete().where(dtable.c.ElementTriplet == element_triplet). \
+            where(dtable.c.DateTime >= start_date). \
+            where(dtable.c.DateTime <= end_date)
+    ), op='delete_data')
     return
 
 
@@ -578,11 +1006,16 @@ def parse_data_response_hourly(hourly_data, num_stations=1):
     return data_out
 
 
-def parse_data_values(element, data_result):
+def parse_data_values(element, data_result, tz_offset=None):
+    if tz_offset is None:
+        tz_offset = get_station_timezone(element.StationTriplet)
+    date_times = [data_row.dateTime for data_row in data_result.values]
+    utc_list = local_to_utc(date_times, tz_offset).tolist() if date_times else []
     data_list = []
-    for data_row in data_result.values:
+    for data_row, utc_ in zip(data_result.values, utc_list):
         data_list.append((element.ElementTriplet, element.StationTriplet,
-                          DATE_FORMAT_FROM(data_row.dateTime), data_row.flag, data_row.value))
+                          DATE_FORMAT_FROM(data_row.dateTime), data_row.flag, data_row.value, utc_))
+    metrics.observe('rows_parsed', len(data_list), format='sql')
     return list(set(data_list))
 
 
@@ -593,9 +1026,13 @@ def parse_data_objects(data_list):
 
 
 def add_data(data_list):
+    _ensure_data_table()
     dtable = metadata.tables['data']
-    with ee.begin() as conn:
-        conn.execute(dtable.insert().values(data_list))  # with conn.cursor() as cur:
+    if ee.dialect.name == 'postgresql' and data_list:
+        local_ = [row[2] for row in data_list]
+        ensure_data_partitions(min(local_), max(local_))
+    write_transaction(lambda conn: conn.execute(dtable.insert().values(data_list)), op='add_data')
+    metrics.inc('rows_written_total', len(data_list), format='sql')  # with conn.cursor() as cur:
         # sql = 'INSERT INTO data VALUES (%s, %s, %s, %s, %s)'
         # conn.executemany(sql, data_list)
         # conn.commit()
@@ -603,7 +1040,8 @@ def add_data(data_list):
     '''
         Data Updates
         ~~~~~~~~~~~~
-        Returns hourly data from NRCS, stores in Postgres tables
+        Returns hourly (getHourlyData) or daily and semimonthly (getData) data from NRCS,
+        stores in the data table (sqlite or postgres, see engine_str) or parquet files
         NOTE: Set THREADS variable to control number threads used
     '''
 
@@ -614,61 +1052,441 @@ def get_data_hourly(request):
     return client.service.getHourlyData(**request)
 
 
+def get_data(request):
+    """
+    Daily or semimonthly data (request['duration']), one value per period.
+    """
+    return client.service.getData(**request)
+
+
+def fetch_data(request):
+    """
+    :param request: from cast_update_element_request, the duration picks the endpoint
+    """
+    if 'duration' in request:
+        return get_data(request)
+    return get_data_hourly(request)
+
+
 def get_data_byelement(element_triplet):
+    _ensure_data_table()
     return _get_object_filter(Data, {'ElementTriplet': element_triplet, 'Flag': 'V'})
 
 
-def update_data_bystations(station_list):
-    for station_triplet in station_list:
-        try:
-            print('Updating data from station {}'.format(station_triplet))
-            element_list = get_element_bystationtriplet(station_triplet, local=True, filters=['duration', 'elementcd'])
-            # update_element_data_list_inpool(element_list)
-            update_element_data_list_series(element_list)
-        except Exception as e:
-            print(e)
-            Exception('Error updating station {}:'.format(station_triplet))
+def update_data_bystations(station_list, dry_run=False, lease_run=None, shard_kind='station'):
+    """
+
+    :param lease_run: distributed mode, claim shards of this run through the lease table
+                      (see lease.py); start the same call on every worker node
+    :param shard_kind: 'station' or 'element' shards in distributed mode
+    """
+    if lease_run and not dry_run:
+        from .lease import run_distributed
+        if shard_kind == 'element':
+            shard_list = [item.element.ElementTriplet for item in plan_updates(station_list=station_list)]
+        else:
+            shard_list = station_list
+        return run_distributed(lease_run, shard_list, kind=shard_kind, job='data')
+    plan = plan_updates(station_list=station_list)
+    if dry_run:
+        print_plan(plan)
+    else:
+        run_plan(plan)
+    return plan
+
 
+def update_data_all(dry_run=False, journal_run=None):
+    """
 
-def update_data_all():
-    station_list = get_station_list(local=True)
-    update_data_bystations(station_list)
+    :param dry_run: print the plan, fetch nothing
+    :param journal_run: record progress in the job journal under this run name (see journal.py);
+                        resume a dead run with journal.resume(journal_run)
+    """
+    plan = plan_updates()
+    if dry_run:
+        print_plan(plan)
+    elif journal_run:
+        from .journal import run_data_journaled
+        return run_data_journaled(journal_run, plan)
+    else:
+        run_plan(plan)
+    return plan
 
 
-def update_data(element, data_result, data_format='sql'):
+'''
+    Update Planner
+    ~~~~~~~~~~~~~~
+    One query over the element table decides which elements need data and for
+    what window; decommissioned sensors that are fully fetched are skipped.
+'''
+
+MAX_REQUEST_HOURS = 24 * 366
+# getData windows, a year of hourly data is ~18 years of daily values
+MAX_REQUEST_DAYS = {'DAILY': 366 * 20, 'SEMIMONTHLY': 366 * 100}
+# lower fetches first
+ELEMENT_PRIORITY = {'SNWD': 0, 'WTEQ': 0, 'TOBS': 1, 'STO': 1, 'SMS': 1}
+DURATION_HOURS = {'HOURLY': 1, 'DAILY': 24, 'SEMIMONTHLY': 365}
+
+
+FREQUENCY_HOURS = {'hour': 1, 'day': 24, 'month': 24 * 28, 'year': 24 * 365}
+
+
+def frequency_name(frequency):
+    """
+    :param frequency: pandas frequency of a load, e.g. 'h', 'D', 'W' or 'MS', or a FREQUENCY_HOURS name
+    :return: the coarsest FREQUENCY_HOURS name within one period, e.g. 'day' for 'D' and 'W'
+    """
+    if frequency is None:
+        return 'hour'
+    if frequency in FREQUENCY_HOURS:
+        return frequency
+    # mean period over a year, months and years are not fixed offsets
+    dates_ = pd.date_range('2001-01-01', periods=13, freq=frequency)
+    hours_ = (dates_[-1] - dates_[0]) / pd.Timedelta(hours=1) / 12
+    resolved = [name for name in FREQUENCY_HOURS if FREQUENCY_HOURS[name] <= hours_] or ['hour']
+    return max(resolved, key=FREQUENCY_HOURS.get)
+
+
+def choose_durations(element_list, frequency='hour'):
+    """
+    One element per sensor (station, element code, ordinal, depth): the coarsest stored duration
+    that still resolves `frequency`, e.g. daily values for daily loads instead of 24x the hourly
+    rows; the finest stored duration if none does.
+
+    :param frequency: 'hour', 'day', 'month' or 'year'
+    """
+    hours_ = FREQUENCY_HOURS[frequency]
+    sensors = {}
+    for element in element_list:
+        key_ = (element.StationTriplet, element.ElementCd, element.Ordinal, element.HeightDepth)
+        sensors.setdefault(key_, []).append(element)
+    chosen = []
+    for sensor_elements in sensors.values():
+        stored = [element for element in sensor_elements if element.LocalEndDate is not None] or sensor_elements
+        stored.sort(key=lambda element: DURATION_HOURS.get(element.Duration, 1))
+        resolving = [element for element in stored if DURATION_HOURS.get(element.Duration, 1) <= hours_]
+        chosen.append(resolving[-1] if resolving else stored[0])
+    return sorted(chosen, key=lambda element: element.ElementTriplet)
+
+
+def duration_step(duration):
+    """
+    :return: time from the last stored value to the start of the next request
+    """
+    return datetime.timedelta(hours=1) if duration == 'HOURLY' else datetime.timedelta(days=1)
+
+
+def request_span(duration):
+    """
+    :return: longest window of one data request
+    """
+    if duration in MAX_REQUEST_DAYS:
+        return datetime.timedelta(days=MAX_REQUEST_DAYS[duration])
+    return datetime.timedelta(hours=MAX_REQUEST_HOURS)
+
+
+class WorkItem(namedtuple('WorkItem', ['element', 'begin_date', 'end_date', 'staleness', 'priority'])):
+    """ Planned update for one element: window to fetch, ranking and size estimates. """
+    __slots__ = ()
+
+    @property
+    def hours(self):
+        return max((self.end_date - self.begin_date).total_seconds() / 3600., 0.)
+
+    @property
+    def n_requests(self):
+        return max(int(np.ceil(self.hours * 3600. / request_span(self.element.Duration).total_seconds())), 1)
+
+    @property
+    def est_rows(self):
+        return int(self.hours / DURATION_HOURS.get(self.element.Duration, 1)) + 1
+
+    def windows(self):
+        """ Request windows of at most request_span, oldest first """
+        begin_ = self.begin_date
+        span_ = request_span(self.element.Duration)
+        while begin_ <= self.end_date:
+            end_ = min(begin_ + span_, self.end_date)
+            yield begin_, end_
+            begin_ = end_ + duration_step(self.element.Duration)
+
+    def __repr__(self):
+        return '<WorkItem: {} {}:{} requests={} rows~{}>'.format(
+            self.element.ElementTriplet, self.begin_date, self.end_date, self.n_requests, self.est_rows)
+
+
+def plan_updates(station_list=None, now=None, min_age=datetime.timedelta(hours=1),
+                 filters=('duration', 'elementcd'), element_triplets=None):
+    """
+    Work plan for a refresh, computed with one query over the element table.
+
+    :param station_list: restrict to these station triplets, all local stations if None
+    :param element_triplets: restrict to these element triplets
+    :param now: reference time, UTC, defaults to now; compared with each element in station local time
+    :param min_age: skip elements with data newer than now - min_age
+    :param filters: element filters, as in filter_elements
+    :return: list of WorkItem, live sensors first, then by priority and staleness
+    """
+    now = now or datetime.datetime.utcnow()
+    with session_scope() as session:
+        # station local times are at most MAX_TZ_OFFSET hours ahead of UTC, exact check below
+        query = session.query(Element, Station.StationDataTimeZone). \
+            outerjoin(Station, Station.StationTriplet == Element.StationTriplet). \
+            filter(or_(Element.LocalEndDate.is_(None),
+                       and_(Element.LocalEndDate < Element.EndDate,
+                            Element.LocalEndDate < now + datetime.timedelta(hours=MAX_TZ_OFFSET) - min_age)))
+        for filter_ in filters:
+            if filter_.lower() == 'duration':
+                query = query.filter(Element.Duration.in_(duration_toload))
+            if filter_.lower() == 'elementcd':
+                query = query.filter(Element.ElementCd.in_(elementcd_toload))
+        if station_list is not None:
+            query = query.filter(Element.StationTriplet.in_(list(station_list)))
+        if element_triplets is not None:
+            query = query.filter(Element.ElementTriplet.in_(list(element_triplets)))
+        element_list = query.all()
+        session.expunge_all()
+    plan = []
+    for element, tz_offset in element_list:
+        now_ = station_now(element.StationTriplet, now, tz_offset)
+        if element.LocalEndDate is None:
+            begin_date = element.BeginDate
+        elif element.LocalEndDate >= now_ - min_age:
+            continue
+        else:
+            begin_date = element.LocalEndDate + duration_step(element.Duration)
+        end_date = min(element.EndDate or now_, now_)
+        if begin_date is None or begin_date > end_date:
+            continue
+        live = element.EndDate is None or element.EndDate >= now_
+        priority = (0 if live else 1, ELEMENT_PRIORITY.get(element.ElementCd, 2))
+        plan.append(WorkItem(element, begin_date, end_date, now_ - begin_date, priority))
+    plan.sort(key=lambda item: (item.priority, -item.staleness.total_seconds()))
+    return plan
+
+
+def print_plan(plan):
+    """
+    Dry run: print the plan with expected request counts and row estimates.
+    """
+    for item in plan:
+        print(item)
+    n_requests = sum(item.n_requests for item in plan)
+    est_rows = sum(item.est_rows for item in plan)
+    n_stations = len(set(item.element.StationTriplet for item in plan))
+    print('PLAN: {} elements at {} stations, {} requests, ~{} rows'.format(
+        len(plan), n_stations, n_requests, est_rows))
+    return n_requests, est_rows
+
+
+def run_plan(plan, data_format='par', in_pool=True):
+    """
+    :param in_pool: run through the staged pipeline (pipeline.UpdatePipeline), else one request at a time
+    """
+    if in_pool:
+        from .pipeline import UpdatePipeline
+        return UpdatePipeline(data_format=data_format).run(plan)
+    for item in plan:
+        for begin_date, end_date in item.windows():
+            try:
+                update_element_data(item.element, in_pool=False, data_format=data_format,
+                                    begin_date=begin_date, end_date=end_date)
+            except Exception:
+                logger.exception('Error updating element %s', item.element.ElementTriplet)
+                break
+
+
+def update_data(element, data_result, data_format='sql', since=None):
+    """
+    :param since: station local time, rows at or before it are dropped, e.g. the element's
+                  LocalEndDate when a multi-station request began before it
+    :return: (begin date, end date, stored frame) of the response, None when no rows are left
+             after since
+    """
     assert element.StationTriplet == data_result.stationTriplet
-    begin_date = DATE_FORMAT_FROM(data_result.beginDate)
-    end_date = DATE_FORMAT_FROM(data_result.endDate)
+    tz_offset = get_station_timezone(element.StationTriplet)
+    data_frame = parse_data_frame(element, data_result, tz_offset=tz_offset)
+    if since is not None:
+        data_frame = data_frame[data_frame.index > local_to_utc([since], tz_offset)[0]]
+        if not len(data_frame):
+            return None
+    begin_date, end_date = result_dates(element, data_result, data_frame, tz_offset)
+    if since is not None:
+        begin_date = max(begin_date, since + duration_step(element.Duration))
 
     if data_format == 'sql':
-        print('DELETING from data ...')
         delete_data(element.ElementTriplet, begin_date, end_date)
-        data_list = parse_data_values(element, data_result)
-        print('ADDING into data {} values ...'.format(len(data_list)))
-        add_data(data_list)
+        data_frame = data_frame[~data_frame.index.duplicated(keep='last')]
+        logger.debug('ADDING into data %s values ...', len(data_frame))
+        add_data_frame(data_frame, tz_offset)
     if data_format == 'par':
-        write_par(element, data_result)
-    return begin_date, end_date
+        write_par_frame(element, data_frame, begin_date, end_date)
+    return begin_date, end_date, data_frame
+
+
+def content_digest(data_frame):
+    """
+    :param data_frame: frame from parse_data_frame
+    :return: (row count, sha1 of the utc, value and flag columns)
+    """
+    sha_ = hashlib.sha1()
+    sha_.update(np.ascontiguousarray(data_frame.index.values, dtype='i8').tobytes())
+    values_ = np.ascontiguousarray(data_frame['value'].values, dtype='f8')
+    sha_.update(np.where(np.isnan(values_), np.nan, values_).tobytes())
+    sha_.update('\x00'.join(data_frame['flag'].astype(str)).encode('utf-8'))
+    return len(data_frame), sha_.hexdigest()
 
 
-def write_par(element, data_result):
+def parse_data_frame(element, data_result, tz_offset=None):
+    """
+    Columnar parse of one data response.
+
+    :return: frame of flag, value, ElementTriplet, StationTriplet indexed by UTC int64 ns ('utc')
+    """
+    if tz_offset is None:
+        tz_offset = get_station_timezone(element.StationTriplet)
+    if element.Duration != 'HOURLY':
+        return parse_period_frame(element, data_result, tz_offset)
+    values_ = data_result.values
+    date_times = np.array([data_row.dateTime for data_row in values_], dtype='str')
+    result_df = pd.DataFrame({'flag': [data_row.flag for data_row in values_],
+                              'value': np.array([data_row.value for data_row in values_], dtype='double')},
+                             index=pd.Index(local_to_utc(date_times, tz_offset), name='utc'))
+    result_df['ElementTriplet'] = element.ElementTriplet
+    result_df['StationTriplet'] = element.StationTriplet
+    metrics.observe('rows_parsed', len(result_df), format='frame')
+    return result_df
+
+
+PERIOD_FREQ = {'DAILY': 'D', 'SEMIMONTHLY': 'SMS-16'}
+
+
+def parse_period_frame(element, data_result, tz_offset):
+    """
+    Parse a getData response: a value per period (day or half month) from beginDate,
+    stamped at the station local period start; missing periods are dropped.
+    """
+    values_ = np.array([np.nan if value is None else float(value) for value in data_result.values],
+                       dtype='double')
+    flags_ = list(getattr(data_result, 'flags', None) or [None] * len(values_))
+    periods = pd.date_range(pd.Timestamp(str(data_result.beginDate)).floor('D'), periods=len(values_),
+                            freq=PERIOD_FREQ[element.Duration])
+    present = ~np.isnan(values_)
+    result_df = pd.DataFrame({'flag': np.array(flags_, dtype=object)[present], 'value': values_[present]},
+                             index=pd.Index(local_to_utc(periods[present], tz_offset), name='utc'))
+    result_df['ElementTriplet'] = element.ElementTriplet
+    result_df['StationTriplet'] = element.StationTriplet
+    metrics.observe('rows_parsed', len(result_df), format='frame')
+    return result_df
+
+
+def result_dates(element, data_result, data_frame=None, tz_offset=None):
+    """
+    :return: (begin date, end date) of a response, station local; responses end at their last
+             reported value, not at the requested end, so hours not yet reported are requested
+             again; daily and semimonthly responses end at their last complete period, so the
+             period in progress is fetched again by the next update
+    """
+    if element.Duration == 'HOURLY':
+        begin_ = pd.Timestamp(DATE_FORMAT_FROM(data_result.beginDate))
+    else:
+        begin_ = pd.Timestamp(str(data_result.beginDate)).floor('D')
+    if data_frame is None:
+        data_frame = parse_data_frame(element, data_result, tz_offset=tz_offset)
+    if not len(data_frame):
+        # nothing reported: the stored end date stays where it was
+        return begin_.to_pydatetime(), (begin_ - duration_step(element.Duration)).to_pydatetime()
+    if tz_offset is None:
+        tz_offset = get_station_timezone(element.StationTriplet)
+    end_ = pd.Timestamp(int(data_frame.index.max()) + int(round(tz_offset * NS_PER_HOUR)))
+    if element.Duration == 'HOURLY':
+        return begin_.to_pydatetime(), end_.to_pydatetime()
+    current_ = pd.tseries.frequencies.to_offset(PERIOD_FREQ[element.Duration]).rollback(
+        pd.Timestamp(station_now(element.StationTriplet, tz_offset=tz_offset)).floor('D'))
+    if end_ >= current_:
+        end_ = current_ - pd.Timedelta(days=1)
+    return begin_.to_pydatetime(), end_.to_pydatetime()
+
+
+def data_rows_fromframe(data_frame, tz_offset):
+    """
+    :param data_frame: frame from parse_data_frame
+    :return: list of data table rows
+    """
+    utc_ = data_frame.index.values.astype('i8')
+    local_ = pd.DatetimeIndex((utc_ + int(round(tz_offset * NS_PER_HOUR))).view('datetime64[ns]'))
+    return list(zip(data_frame.ElementTriplet, data_frame.StationTriplet, local_.to_pydatetime(),
+                    data_frame.flag, data_frame.value.where(data_frame.value.notnull(), None), utc_.tolist()))
+
+
+def add_data_frame(data_frame, tz_offset):
+    """
+    Insert a frame from parse_data_frame into the data table.  Postgres loads the
+    columns with COPY FROM STDIN, other backends insert data_rows_fromframe rows.
+    """
+    if not len(data_frame):
+        return
+    if ee.dialect.name != 'postgresql':
+        return add_data(data_rows_fromframe(data_frame, tz_offset))
+    _ensure_data_table()
+    utc_ = data_frame.index.values.astype('i8')
+    local_ = pd.DatetimeIndex((utc_ + int(round(tz_offset * NS_PER_HOUR))).view('datetime64[ns]'))
+    ensure_data_partitions(local_.min(), local_.max())
+    copy_frame = pd.DataFrame({'ElementTriplet': data_frame.ElementTriplet.values,
+                               'StationTriplet': data_frame.StationTriplet.values,
+                               'DateTime': local_, 'Flag': data_frame.flag.values,
+                               'Value': data_frame.value.values, 'TimeUTC': utc_})
+    buffer_ = io.StringIO()
+    # unquoted empty fields are NULL in COPY csv
+    copy_frame.to_csv(buffer_, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+    copy_sql = 'COPY "data" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        ', '.join('"{}"'.format(column) for column in copy_frame.columns))
+    connection = ee.raw_connection()
+    try:
+        with metrics.timer('db_transaction_seconds', op='copy_data'):
+            cursor = connection.cursor()
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                buffer_.seek(0)
+                cursor.copy_expert(copy_sql, buffer_)
+            else:
+                # psycopg 3
+                with cursor.copy(copy_sql) as copy_:
+                    copy_.write(buffer_.getvalue())
+            cursor.close()
+            connection.commit()
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    metrics.inc('rows_written_total', len(copy_frame), format='sql')
+
+
+def write_par(element, data_result, tz_offset=None):
+    """
+    Write one response to a parquet file in the station data path, indexed by UTC int64 ns ('utc').
+    """
+    result_df = parse_data_frame(element, data_result, tz_offset=tz_offset)
+    write_par_frame(element, result_df, *result_dates(element, data_result, result_df, tz_offset))
+
+
+def write_par_frame(element, result_df, begin_date, end_date):
+    """
+    :return: path of the written parquet file
+    """
     fmt_ = {'element_code': element.trip,
-            'begin_date': DATE_FORMAT_FROM(data_result.beginDate).strftime('%Y%m%dT%H%'),
-            'end_date': DATE_FORMAT_FROM(data_result.endDate).strftime('%Y%m%dT%H')}
+            'begin_date': begin_date.strftime('%Y%m%dT%H'),
+            'end_date': end_date.strftime('%Y%m%dT%H')}
     par_filename = 'aws_{element_code}_{begin_date}_{end_date}.par'.format(**fmt_)
 
-    element.data_path.mkdir(exist_ok=True)
+    element.data_path.mkdir(parents=True, exist_ok=True)
     par_file = element.data_path / par_filename
-    data_list = []
-    for data_row in data_result.values:
-        data_dict = dict(data_row)
-        data_dict['ElementTriplet'] = element.ElementTriplet
-        data_dict['StationTriplet'] = element.StationTriplet
-        data_list.append(data_dict)
-    result_df = pd.DataFrame.from_dict(data_list)
-    result_df.index = pd.DatetimeIndex(result_df.dateTime.values.astype('str'))
-    del result_df['dateTime']
     result_df.to_parquet(par_file, engine='pyarrow')
+    if metrics.ENABLED:
+        metrics.inc('rows_written_total', len(result_df), format='par')
+        metrics.inc('parquet_bytes_total', par_file.stat().st_size, op='write')
+    return par_file
 
 '''
 OO Objects
@@ -685,6 +1503,7 @@ def parse_station_meta(meta):
     return dict((CamelCase(key), value) for key, value in dict(meta).items())
 
 
+STATION_CODE_COLUMNS = ('StationId', 'StateCode', 'NetworkCode')
 _dt_parser = lambda x: datetime.datetime.strptime(x, '%Y-%m-%d %M:%H:%S')
 _Station_lookup = {'BeginDate': _dt_parser, 'CountyName': str, 'Elevation': int, 'EndDate': _dt_parser,
                    'FipsCountryCd': str, 'FipsCountyCd': str, 'FipsStateNumber': str, 'Huc': int,
@@ -697,9 +1516,17 @@ def construct_station(station_meta):
     for k, fun in _Station_lookup.items():
         if k in meta_dict:
             meta_dict[k] = fun(meta_dict[k])
+    meta_dict.update(station_codes(meta_dict['StationTriplet']))
     return Station(**meta_dict)
 
 
+def station_codes(station_triplet):
+    """
+    :return: StationId, StateCode and NetworkCode columns of a station triplet, e.g. 2213:AK:SCAN
+    """
+    return dict(zip(STATION_CODE_COLUMNS, station_triplet.split(':')))
+
+
 class Station(Base):
     '''    
     Snotel/SCAN automated weather station data abstraction.
@@ -720,11 +1547,19 @@ class Station(Base):
     Name = Column(types.String)  # UPTON 13 SW
     StationDataTimeZone = Column(types.Float)  # -7.0
     StationTriplet = Column(types.String, primary_key=True)  # 9207:WY:COOP
+    # parts of the triplet, indexed for collection queries (see create_indexes)
+    StationId = Column(types.String)  # 9207
+    StateCode = Column(types.String)  # WY
+    NetworkCode = Column(types.String)  # COOP
+    # elements of the station; load many stations with their elements through load_stations
+    elements = relationship('Element', primaryjoin='Station.StationTriplet == foreign(Element.StationTriplet)',
+                            order_by='Element.ElementTriplet', viewonly=True)
 
     _how = 'median'
     _freq = 'D'
+    _units = NATIVE
 
-    def __init__(self, freq='D', how='median', filter=True, *args, **kwargs):
+    def __init__(self, freq='D', how='median', filter=True, units=NATIVE, *args, **kwargs):
         for arg in args:
             for key in arg:
                 setattr(self, key, arg[key])
@@ -734,6 +1569,7 @@ class Station(Base):
         self.freq = freq
         self.how = how
         self.filter = filter
+        self.units = units
 
     def __str__(self):
         return '<Snotel Station: {Name} {StationTriplet}>'.format(**self.__dict__)
@@ -742,8 +1578,8 @@ class Station(Base):
         return self.__str__()
 
     def load(self):
-        kwargs = dict(frequency=self.freq, apply_filter=self.filter, how=self.how)
-        self.data_frame = self.get_data_frame(**kwargs)
+        kwargs = dict(frequency=self.freq, apply_filter=self.filter, how=self.how, units=self.units)
+        return self.get_data_frame(**kwargs)
 
     # Properties
     # ==========
@@ -763,6 +1599,17 @@ class Station(Base):
     def station_id(self):
         return self.StationTriplet
 
+    @property
+    def cache_key(self):
+        return 'station', self.StationTriplet
+
+    @property
+    def cache_options(self):
+        # derived values of an assigned frame belong to this instance only
+        if getattr(self, '_data_frame', None) is not None:
+            return None
+        return self.freq, self.how, self.units
+
     @property
     def freq(self):
         return self._freq
@@ -779,137 +1626,201 @@ class Station(Base):
     def how(self, val):
         self._how = val
 
+    @property
+    def units(self):
+        return self._units
+
+    @units.setter
+    def units(self, val):
+        self._units = check_unit_system(val)
+
     # Data Frame
     # ==========
     @property
     def data_frame(self):
-        if not hasattr(self, '_data_frame'):
-            self._data_frame = self.get_data_frame(frequency=self.freq, apply_filter=True, how=self.how)
-        return self._data_frame
+        # a frame assigned to the station (e.g. unfrozen) is kept, computed frames live in the frame cache
+        if getattr(self, '_data_frame', None) is not None:
+            return self._data_frame
+        return self.get_data_frame(frequency=self.freq, apply_filter=True, how=self.how, units=self.units)
 
     @data_frame.setter
     def data_frame(self, data_frame):
         self._data_frame = data_frame
 
-    def get_data_frame(self, frequency='D', apply_filter=True, how='median'):
-        raw_data_frame = self.get_raw_data_frame()
+    @profiled
+    def get_data_frame(self, frequency='D', apply_filter=True, how='median', units=NATIVE, tz='local'):
+        """
+        :param units: unit system of the returned frame, see units.UNIT_SYSTEMS; converted
+                      frames are cached (framecache.py) so repeated requests don't re-convert
+        :param tz: time view of the index, see TIME_VIEWS; frames are held on the UTC int64
+                   axis and only the index is rebuilt for a view
+        :return: station frame, unit metadata in data_frame.attrs['units']
+        """
+        units = check_unit_system(units)
+        key_ = self.cache_key + ('frame', frequency, apply_filter, how)
+
+        def _native():
+            return convert_frame(self._get_native_data_frame(apply_filter=apply_filter, frequency=frequency), NATIVE)
+
+        def _converted():
+            return convert_frame(FRAME_CACHE.get_or_load(key_ + (NATIVE, 'int'), _native), units)
+
+        def _view():
+            return self._time_view(FRAME_CACHE.get_or_load(key_ + (units, 'int'), _converted), tz)
+
+        return FRAME_CACHE.get_or_load(key_ + (units, tz), _view)
+
+    def _time_view(self, data_frame, tz):
+        if tz == 'int':
+            return data_frame
+        view_ = data_frame.set_axis(time_index(data_frame.index, self.StationDataTimeZone, tz))
+        view_.attrs.update(data_frame.attrs)
+        return view_
+
+    def _get_native_data_frame(self, apply_filter=True, frequency='h'):
+        raw_data_frame = self.get_raw_data_frame(tz='int', frequency=frequency)
         if apply_filter:
             for col in raw_data_frame.columns:
                 med_, std_ = raw_data_frame[col].median(), raw_data_frame[col].std()
                 # mask_ = raw_data_frame[col].abs() > pd.rolling_std(raw_data_frame[col], window=48) * 3
                 raw_data_frame[col] = raw_data_frame[col].mask(raw_data_frame[col].abs() > med_ + 3 * std_)
-        raw_data_frame = raw_data_frame.apply(lambda x: x.tz_localize(pytz.FixedOffset(self.StationDataTimeZone)))
         return raw_data_frame
 
-    def get_raw_data_frame(self):
-        data_frame_list = dict([(element.ElementTriplet, element.to_series()) for element in self.element_list])
-        return pd.DataFrame(data_frame_list)
+    def get_raw_data_frame(self, tz='local', frequency='h'):
+        """
+        :param frequency: resolution of the load, each sensor is read from its coarsest stored duration that resolves it
+        """
+        data_frame_list = dict([(element.ElementTriplet, element.to_series(tz='int'))
+                                for element in self.elements_at(frequency)])
+        return self._time_view(pd.DataFrame(data_frame_list), tz)
+
+    def elements_at(self, frequency='h'):
+        """
+        :return: element_list, one element per sensor (choose_durations)
+        """
+        return choose_durations(self.element_list, frequency_name(frequency))
 
     @property
+    def hourly_data_frame(self):
+        # the day / night splits need hourly values whatever the station frequency
+        if getattr(self, '_data_frame', None) is not None:
+            return self._data_frame
+        return self.get_data_frame(frequency='h', apply_filter=True, how=self.how, units=self.units)
+
+    @lazy_init
     def soil_day(self):
-        if not hasattr(self, '_soil_day'):
+        pass
+
+    def _get_soil_day(self):
+        try:
+            element = find_element_bydepth(self.station_id, 'STO', depth='MIN')
+            element_triplet = element.ElementTriplet
+        except:
+            logger.warning('database not found -- guessing depth')
             try:
-                element = find_element_bydepth(self.station_id, 'STO', depth='MIN')
-                element_triplet = element.ElementTriplet
+                element_triplet = [key for key in self.hourly_data_frame.keys() if key.endswith('STO:HOURLY:-2.0')][0]
             except:
-                print('database not found -- guessing depth')
-                try:
-                    element_triplet = [key for key in self.data_frame.keys() if key.endswith('STO:HOURLY:-2.0')][0]
-                except:
-                    element_triplet = None
-            if element_triplet:
-                self._soil_day = self.data_frame[element_triplet]. \
-                    between_time(start_time='12:00', end_time='23:59').resample('D').mean()
-            else:
-                self._soil_day = None
-
-        return self._soil_day
+                element_triplet = None
+        if element_triplet:
+            return self.hourly_data_frame[element_triplet]. \
+                between_time(start_time='12:00', end_time='23:59').resample('D').mean()
+        else:
+            return None
 
-    @property
+    @lazy_init
     def soil_night(self):
-        if not hasattr(self, '_soil_night'):
-            try:
-                element = find_element_bydepth(self.station_id, 'STO', depth='MIN')
-                element_triplet = element.ElementTriplet
-            except:
-                print('database not found -- guessing depth')
-                try:
-                    element_triplet = [key for key in self.data_frame.keys() if key.endswith('STO:HOURLY:-2.0')][0]
-                except:
-                    element_triplet = None
-            if element_triplet:
-                self._soil_night = self.data_frame[element_triplet]. \
-                    between_time(start_time='00:00', end_time='12:00').resample('D').mean()
-            else:
-                self._soil_night = None
-        return self._soil_night
+        pass
 
-    @property
-    def air_day(self):
-        if not hasattr(self, '_air_day'):
+    def _get_soil_night(self):
+        try:
+            element = find_element_bydepth(self.station_id, 'STO', depth='MIN')
+            element_triplet = element.ElementTriplet
+        except:
+            logger.warning('database not found -- guessing depth')
             try:
-                element_triplet = [key for key in self.data_frame.keys() if key.endswith('TOBS:HOURLY:None')][0]
-                # element = find_element_bydepth(self.station_id, 'TOBS', depth='MIN')
+                element_triplet = [key for key in self.hourly_data_frame.keys() if key.endswith('STO:HOURLY:-2.0')][0]
             except:
                 element_triplet = None
-            if element_triplet:
-                self._air_day = self.data_frame[element_triplet]. \
-                    between_time(start_time='12:00', end_time='23:59').resample('D').mean()
-            else:
-                self._air_day = None
-        return self._air_day
+        if element_triplet:
+            return self.hourly_data_frame[element_triplet]. \
+                between_time(start_time='00:00', end_time='12:00').resample('D').mean()
+        else:
+            return None
 
-    @property
+    @lazy_init
+    def air_day(self):
+        pass
+
+    def _get_air_day(self):
+        try:
+            element_triplet = [key for key in self.hourly_data_frame.keys() if key.endswith('TOBS:HOURLY:None')][0]
+            # element = find_element_bydepth(self.station_id, 'TOBS', depth='MIN')
+        except:
+            element_triplet = None
+        if element_triplet:
+            return self.hourly_data_frame[element_triplet]. \
+                between_time(start_time='12:00', end_time='23:59').resample('D').mean()
+        else:
+            return None
+
+    @lazy_init
     def air_night(self):
-        if not hasattr(self, '_air_night'):
-            try:
-                element_triplet = [key for key in self.data_frame.keys() if key.endswith('TOBS:HOURLY:None')][0]
-                # element = find_element_bydepth(self.station_id, 'TOBS', depth='MIN')
-            except:
-                element_triplet = None
-            if element_triplet:
-                # element = find_element_bydepth(self.station_id, 'TOBS', depth='MIN')
-                self._air_night = self.data_frame[element_triplet]. \
-                    between_time(start_time='00:00', end_time='12:00').resample('D').mean()
-            else:
-                self._air_night = None
-        return self._air_night
+        pass
 
-    @property
+    def _get_air_night(self):
+        try:
+            element_triplet = [key for key in self.hourly_data_frame.keys() if key.endswith('TOBS:HOURLY:None')][0]
+            # element = find_element_bydepth(self.station_id, 'TOBS', depth='MIN')
+        except:
+            element_triplet = None
+        if element_triplet:
+            # element = find_element_bydepth(self.station_id, 'TOBS', depth='MIN')
+            return self.hourly_data_frame[element_triplet]. \
+                between_time(start_time='00:00', end_time='12:00').resample('D').mean()
+        else:
+            return None
+
+    @lazy_init
     def sd_day(self):
-        if not hasattr(self, '_sd_day'):
-            try:
-                element_triplet = [k for k in self.data_frame.keys() if 'SNWD' in k][0]
-                self._sd_day = self.data_frame[element_triplet].resample('D').median()
-            except:
-                self._sd_day = None
-        return self._sd_day
+        pass
 
-    @property
+    def _get_sd_day(self):
+        try:
+            element_triplet = [k for k in self.hourly_data_frame.keys() if 'SNWD' in k][0]
+            return self.hourly_data_frame[element_triplet].resample('D').median()
+        except:
+            return None
+
+    @lazy_init
     def sm_day(self):
-        if not hasattr(self, '_sm_day'):
-            element = find_element_bydepth(self.station_id, 'SMS', depth='MIN')
-            if element:
-                self._sm_day = self.data_frame[element.ElementTriplet]. \
-                    between_time(start_time='12:00', end_time='23:59').resample('D').mean()
-            else:
-                self._sm_day = None
-        return self._sm_day
+        pass
 
-    @property
+    def _get_sm_day(self):
+        element = find_element_bydepth(self.station_id, 'SMS', depth='MIN')
+        if element:
+            return self.hourly_data_frame[element.ElementTriplet]. \
+                between_time(start_time='12:00', end_time='23:59').resample('D').mean()
+        else:
+            return None
+
+    @lazy_init
     def sm_night(self):
-        if not hasattr(self, '_sm_night'):
-            element = find_element_bydepth(self.station_id, 'SMS', depth='MIN')
-            if element:
-                self._sm_night = self.data_frame[element.ElementTriplet]. \
-                    between_time(start_time='00:00', end_time='12:00').resample('D').mean()
-            else:
-                self._sm_night = None
-        return self._sm_night
+        pass
+
+    def _get_sm_night(self):
+        element = find_element_bydepth(self.station_id, 'SMS', depth='MIN')
+        if element:
+            return self.hourly_data_frame[element.ElementTriplet]. \
+                between_time(start_time='00:00', end_time='12:00').resample('D').mean()
+        else:
+            return None
 
     @property
     def element_list(self):
         if not hasattr(self, '_element_list'):
+            if 'elements' not in inspect(self).unloaded:
+                self._element_list = filter_elements(list(self.elements))
+                return self._element_list
             element_list = get_element_bystationtriplet(self.StationTriplet)
             if element_list:
                 self._element_list = filter_elements(element_list)
@@ -940,6 +1851,8 @@ class Element(Base):
     ElementTriplet = Column(types.String, primary_key=True)  #
     LocalBeginDate = Column(types.DateTime)
     LocalEndDate = Column(types.DateTime)
+    station = relationship('Station', primaryjoin='foreign(Element.StationTriplet) == Station.StationTriplet',
+                           viewonly=True)
 
     def __init__(self, *args, **kwargs):
         for arg in args:
@@ -957,52 +1870,102 @@ class Element(Base):
 
     @property
     def data_path(self):
-        return _DAT_PATH / self.StationTriplet.replace(':', '_')
+        station_path = _DAT_PATH / self.StationTriplet.replace(':', '_')
+        # daily and semimonthly files are kept apart from the hourly files
+        return station_path if self.Duration in (None, 'HOURLY') else station_path / self.Duration.lower()
 
     @property
-    def data_frame(self):
-        if not hasattr(self, '_data_frame'):
-            self.set_dataframe()
-        return self._data_frame
+    def cache_key(self):
+        return 'element', self.ElementTriplet
 
-    def to_series(self):
-        series_ = self.data_frame['value'].where(self.data_frame['flag'] == 'V')
-        return series_
+    @property
+    def par_files(self):
+        return sorted(self.data_path.glob('aws_{}_*.par'.format(self.trip)))
+
+    def _read_par(self, par_file):
+        element_data = pd.read_parquet(par_file, engine='pyarrow')
+        if metrics.ENABLED:
+            metrics.inc('parquet_bytes_total', par_file.stat().st_size, op='read')
+        if not pd.api.types.is_integer_dtype(element_data.index):
+            # files written before UTC storage are indexed by station local time
+            element_data.index = pd.Index(
+                local_to_utc(element_data.index.values, get_station_timezone(self.StationTriplet)), name='utc')
+        return element_data
+
+    @property
+    def data_frame(self):
+        return FRAME_CACHE.get_or_load(self.cache_key + ('frame',), self._load_dataframe)
+
+    def to_series(self, units=NATIVE, tz='local'):
+        """
+        :param units: unit system of the returned series, see units.UNIT_SYSTEMS
+        :param tz: time view of the index, see TIME_VIEWS; 'int' returns the stored UTC int64 index
+        :return: valid-flag values, unit metadata in series.attrs['units']
+        """
+        units = check_unit_system(units)
+
+        def _series():
+            data_frame = self.data_frame
+            return convert_series(data_frame['value'].where(data_frame['flag'] == 'V'), self.ElementCd, units)
+
+        series_ = FRAME_CACHE.get_or_load(self.cache_key + ('series', units), _series)
+        if tz == 'int':
+            return series_
+        tz_offset = get_station_timezone(self.StationTriplet) if tz == 'local' else 0.
+        view_ = series_.set_axis(time_index(series_.index, tz_offset, tz))
+        view_.attrs.update(series_.attrs)
+        return view_
 
     def set_dataframe(self, data_format='par'):
-        print('LOADING DATA {}, '.format(self.ElementTriplet)),
+        """
+        (Re)load the element frame into the frame cache, dropping views of the previous frame.
+        """
+        FRAME_CACHE.invalidate(*self.cache_key)
+        FRAME_CACHE.invalidate('station', self.StationTriplet)
+        FRAME_CACHE.put(self.cache_key + ('frame',), self._load_dataframe(data_format=data_format))
+
+    @profiled
+    def _load_dataframe(self, data_format='par'):
+        logger.debug('LOADING DATA %s', self.ElementTriplet)
         if data_format == 'sql': # probably not going to fix this
+            _ensure_data_table()
             element_data = pd.read_sql(
-                """ SELECT "DateTime","Value"  FROM "data"
-                    WHERE "ElementTriplet" LIKE '{}' AND
-                    "StationTriplet" LIKE '{}' AND
-                    "Flag" = 'V' """.format(self.ElementTriplet, self.StationTriplet), ee, index_col='DateTime')
-            element_data.columns = [self.ElementTriplet]
+                """ SELECT "TimeUTC" AS utc, "DateTime", "Value" AS value, "Flag" AS flag FROM "data"
+                    WHERE "ElementTriplet" = '{}' """.format(self.ElementTriplet), read_engine())
+            missing = element_data.utc.isnull()
+            if missing.any():
+                # rows written before UTC storage
+                element_data.loc[missing, 'utc'] = local_to_utc(
+                    element_data.DateTime[missing], get_station_timezone(self.StationTriplet))
+            element_data.index = pd.Index(element_data.pop('utc').astype('i8'), name='utc')
+            del element_data['DateTime']
         elif data_format == 'par':
-            element_data = pd.read_parquet(self.data_path, engine='pyarrow')
-            element_data = element_data.where(element_data.ElementTriplet == self.ElementTriplet).dropna(how='all')
+            par_list = [self._read_par(par_file) for par_file in self.par_files]
+            if par_list:
+                element_data = pd.concat(par_list)
+            else:
+                element_data = pd.DataFrame({'value': [], 'flag': []}, index=pd.Index([], dtype='i8', name='utc'))
         element_data = element_data.sort_index()
-        self._data_frame = element_data
-        print('DONE')
+        return element_data[~element_data.index.duplicated(keep='last')]
 
-    @property
+    @lazy_init
     def data_list(self):
-        if not hasattr(self, '_data_list'):
-            data_list = get_data_byelement(self.ElementTriplet)
-            if data_list:
-                self._data_list = data_list
-            else:
-                return None
-        return self._data_list
+        pass
+
+    def _get_data_list(self):
+        return get_data_byelement(self.ElementTriplet) or None
 
 
 class Data(Base):
     __tablename__ = 'data'
+    # yearly range partitions on postgres, see ensure_data_partitions; ignored by sqlite
+    __table_args__ = {'postgresql_partition_by': 'RANGE ("DateTime")'}
     ElementTriplet = Column(types.String, primary_key=True)
     StationTriplet = Column(types.String)
-    DateTime = Column(types.DateTime, primary_key=True)
+    DateTime = Column(types.DateTime, primary_key=True)  # station local time
     Flag = Column(types.String(1))
     Value = Column(types.Float)
+    TimeUTC = Column(types.BigInteger)  # UTC, ns since epoch
 
     def __init__(self, *args, **kwargs):
         for arg in args:
@@ -1015,6 +1978,117 @@ class Data(Base):
         return '<SNOTELDATA:{StationTriplet}:{ElementTriplet}>'.format(**self.__dict__)
 
 
+class Change(Base):
+    """ Append-only change feed, one row per stored response, see changes.py """
+
+    __tablename__ = 'change'
+    Offset = Column(types.Integer, primary_key=True, autoincrement=True)
+    ElementTriplet = Column(types.String, index=True)
+    StationTriplet = Column(types.String)
+    BeginDate = Column(types.DateTime)  # station local time
+    EndDate = Column(types.DateTime)
+    BeginUTC = Column(types.BigInteger)  # UTC, ns since epoch
+    EndUTC = Column(types.BigInteger)
+    NRows = Column(types.Integer)
+    ContentHash = Column(types.String)
+    DataFormat = Column(types.String)
+    CreatedAt = Column(types.DateTime)  # UTC
+
+    def __init__(self, *args, **kwargs):
+        for arg in args:
+            for key in arg:
+                setattr(self, key, arg[key])
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+    def __repr__(self):
+        return '<CHANGE:{}:{}:{}-{}>'.format(self.Offset, self.ElementTriplet, self.BeginDate, self.EndDate)
+
+    @classmethod
+    def from_update(cls, element, begin_date, end_date, data_frame=None, data_format='par'):
+        _ensure_change_table()
+        utc_ = local_to_utc([begin_date, end_date], get_station_timezone(element.StationTriplet))
+        n_rows, content_hash = content_digest(data_frame) if data_frame is not None else (None, None)
+        return cls(ElementTriplet=element.ElementTriplet, StationTriplet=element.StationTriplet,
+                   BeginDate=begin_date, EndDate=end_date, BeginUTC=int(utc_[0]), EndUTC=int(utc_[1]),
+                   NRows=n_rows, ContentHash=content_hash, DataFormat=data_format,
+                   CreatedAt=datetime.datetime.utcnow())
+
+    def values(self):
+        return dict((column.name, getattr(self, column.name)) for column in self.__table__.columns
+                    if column.name != 'Offset')
+
+
+_CHANGE_TABLE = []
+_DATA_TABLE = []
+_DATA_PARTITIONS = set()
+
+
+def ensure_data_partitions(begin_date, end_date):
+    """
+    Create the yearly postgres partitions of the data table (data_<year>) covering
+    begin_date to end_date, station local time.  No-op on other backends.
+    """
+    if ee.dialect.name != 'postgresql':
+        return
+    years = [year for year in range(begin_date.year, end_date.year + 1) if year not in _DATA_PARTITIONS]
+    if not years:
+        return
+    Data.__table__.create(ee, checkfirst=True)
+    with ee.begin() as conn:
+        # writers of other processes create partitions too
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('snotel_data_partitions'))"))
+        for year in years:
+            conn.execute(text('CREATE TABLE IF NOT EXISTS "data_{0}" PARTITION OF "data" '
+                              "FOR VALUES FROM ('{0}-01-01') TO ('{1}-01-01')".format(year, year + 1)))
+    _DATA_PARTITIONS.update(years)
+
+
+def lock_change_feed(conn):
+    """
+    Serialize change row writers until their transaction ends.  Offsets then commit in
+    offset order, so a reader past an offset never misses a lower one committed later
+    (postgres sequences hand out values before commit).  Sqlite has a single writer.
+
+    :param conn: connection or session of the transaction writing the change row
+    """
+    if ee.dialect.name == 'postgresql':
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('snotel_change_feed'))"))
+
+
+def _ensure_change_table():
+    # databases created before the change feed
+    if not _CHANGE_TABLE:
+        Change.__table__.create(ee, checkfirst=True)
+        _CHANGE_TABLE.append(True)
+
+
+def _data_columns(conn):
+    return [column['name'] for column in inspect(conn).get_columns('data')]
+
+
+def _add_utc_column(conn):
+    if 'TimeUTC' not in _data_columns(conn):
+        conn.execute(text('ALTER TABLE "data" ADD COLUMN "TimeUTC" BIGINT'))
+
+
+def _ensure_data_table():
+    # databases created before UTC storage have a data table without TimeUTC,
+    # their rows keep a NULL TimeUTC and are converted from DateTime on read
+    if _DATA_TABLE:
+        return
+    Data.__table__.create(ee, checkfirst=True)
+    if 'TimeUTC' not in _data_columns(ee):
+        try:
+            write_transaction(_add_utc_column, op='migrate_data')
+        except Exception:
+            # another process added it first
+            if 'TimeUTC' not in _data_columns(ee):
+                raise
+        logger.info('Added TimeUTC column to the data table')
+    _DATA_TABLE.append(True)
+
+
 '''
 Collections
 ~~~~~~~~~~~
@@ -1053,132 +2127,354 @@ class StaticStation(object):
 
     def _set_dataframe(self):
         tablename = self._tablename_fromtriplet(self.station_triplet)
-        self.data_frame.to_sql(tablename, collection_engine, if_exists='replace')
+        data_frame = self.data_frame
+        write_transaction(lambda conn: data_frame.to_sql(tablename, conn, if_exists='replace'), op='collection')
 
     def _tablename_fromtriplet(self, triplet_string):
         return triplet_string.replace(':', '_')
 
 
+'''
+Collections
+~~~~~~~~~~~
+Stations selected by a metadata query; member data is loaded lazily, in parallel
+on first access, or streamed station by station.
+'''
+
+COLLECTION_WORKERS = 4
+COLLECTION_INDEXES = [Index('ix_element_station', Element.StationTriplet),
+                      Index('ix_element_code', Element.ElementCd, Element.Duration),
+                      Index('ix_station_location', Station.Latitude, Station.Longitude),
+                      Index('ix_station_state', Station.StateCode, Station.NetworkCode),
+                      Index('ix_station_network', Station.NetworkCode),
+                      Index('ix_station_id', Station.StationId)]
+_STATION_CODES = []
+
+
+def create_indexes():
+    """
+    Metadata indexes used to resolve collections, also added to existing databases: the
+    station code columns are added and filled from the triplets.  Run by the station and
+    element updates; databases made before can call it once.
+    """
+    metadata.create_all()
+    write_transaction(_add_station_codes, op='migrate_station')
+    for index_ in COLLECTION_INDEXES:
+        index_.create(ee, checkfirst=True)
+    _STATION_CODES[:] = [ee]
+
+
+def _add_station_codes(conn):
+    columns = [column['name'] for column in inspect(conn).get_columns('station')]
+    for column in STATION_CODE_COLUMNS:
+        if column not in columns:
+            conn.execute(text('ALTER TABLE "station" ADD COLUMN "{}" VARCHAR'.format(column)))
+    stable = Station.__table__
+    triplets = [triplet for triplet, in conn.execute(
+        select([stable.c.StationTriplet]).where(stable.c.StateCode.is_(None)))]
+    if triplets:
+        conn.execute(stable.update().where(stable.c.StationTriplet == bindparam('triplet')).values(
+            dict((column, bindparam('_' + column)) for column in STATION_CODE_COLUMNS)),
+            [dict([('triplet', triplet)] + [('_' + key, value) for key, value in station_codes(triplet).items()])
+             for triplet in triplets])
+
+
+def _station_codes_ready():
+    # no DDL on the read path: databases without the code columns are matched on the triplet
+    if not _STATION_CODES or _STATION_CODES[0] is not ee:
+        with read_scope() as session:
+            columns = [column['name'] for column in inspect(session.connection()).get_columns('station')]
+        if not set(STATION_CODE_COLUMNS) <= set(columns):
+            logger.warning('station table has no code columns, run create_indexes() for indexed collections')
+            return False
+        _STATION_CODES[:] = [ee]
+    return True
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    return [value] if isinstance(value, (str, int)) else list(value)
+
+
 class Collection(object):
+    """
+    :param state: state code(s) of the station triplets, e.g. 'AK'
+    :param network: network code(s) of the station triplets, e.g. 'SNTL'
+    :param element_cd: element code(s) a station must have, defaults to any element
+    :param bbox: (lon_min, lat_min, lon_max, lat_max)
+    :param begin_date: stations with data (or a record) after this date; frames start here
+    :param end_date: stations with data (or a record) before this date; frames end here
+    :param station_ids: station numbers, e.g. [962, 958], combined with state and network
+    :param station_triplets: explicit station triplets, combined with the other criteria
+    :param workers: threads loading member data
+    :param source: 'live' (element data) or 'frozen' (tables written by freeze)
+    :param frame_kwargs: Station.get_data_frame arguments (frequency, apply_filter, how, units, tz)
+    """
 
-    def __init__(self, update=False):
-        # init station list
-        for station_id in self.station_id_list:
-            station_ = self.find_station(station_id)
-            if station_:
-                self.station_list.append(station_)
+    def __init__(self, state=None, network=None, element_cd=None, bbox=None, begin_date=None, end_date=None,
+                 station_ids=None, station_triplets=None, workers=COLLECTION_WORKERS, source='live', update=False,
+                 **frame_kwargs):
+        self.state = _as_list(state)
+        self.network = _as_list(network)
+        self.element_cd = _as_list(element_cd)
+        self.bbox = bbox
+        self.begin_date = begin_date
+        self.end_date = end_date
+        self.station_ids = _as_list(station_ids)
+        self.triplets = _as_list(station_triplets)
+        self.workers = workers
+        self.source = source
+        self.frame_kwargs = frame_kwargs
         self.update = update
         if update:
             self.do_update()
-        self.load()
 
-    def do_update(self):
-        for station in self.station_list:
-            if station:
-                update_station_data(station)
-                self.freeze(station)
+    def __repr__(self):
+        return '<Collection: {} stations>'.format(len(self))
 
-    def freeze(self, station):
-        self._set_dataframe(station.StationTriplet, station.data_frame)
-        return None
+    def __len__(self):
+        return len(self.station_triplets)
 
-    def load(self):
-        if not self.update:
-            for station in self.station_list:
-                data_frame = self._get_dataframe(station.StationTriplet)
-                station.data_frame = data_frame
-        return None
+    def __iter__(self):
+        return self.iter_stations()
 
-    def find_station(self, station_triplet):
-        return get_station_bytriplet(station_triplet, local=False)
+    def __contains__(self, station_triplet):
+        return station_triplet in self.station_triplets
+
+    def __getitem__(self, station_triplet):
+        if station_triplet not in self:
+            raise KeyError(station_triplet)
+        return self._load_station(self.stations[self.station_triplets.index(station_triplet)])
+
+    # Membership
+    # ==========
+    def query(self, session):
+        triplet_ = Station.StationTriplet
+        query = session.query(triplet_)
+        if self.triplets is not None:
+            query = query.filter(triplet_.in_(self.triplets))
+        if (self.state or self.network or self.station_ids) and _station_codes_ready():
+            if self.state:
+                query = query.filter(Station.StateCode.in_(self.state))
+            if self.network:
+                query = query.filter(Station.NetworkCode.in_(self.network))
+            if self.station_ids:
+                query = query.filter(Station.StationId.in_([str(id_) for id_ in self.station_ids]))
+        else:
+            if self.state:
+                query = query.filter(or_(*[triplet_.like('%:{}:%'.format(state)) for state in self.state]))
+            if self.network:
+                query = query.filter(or_(*[triplet_.like('%:{}'.format(network)) for network in self.network]))
+            if self.station_ids:
+                query = query.filter(or_(*[triplet_.like('{}:%'.format(id_)) for id_ in self.station_ids]))
+        if self.bbox is not None:
+            lon_min, lat_min, lon_max, lat_max = self.bbox
+            query = query.filter(Station.Latitude.between(lat_min, lat_max),
+                                 Station.Longitude.between(lon_min, lon_max))
+        if self.element_cd or self.begin_date or self.end_date:
+            query = query.join(Element, Element.StationTriplet == triplet_). \
+                filter(Element.Duration.in_(duration_toload))
+            if self.element_cd:
+                query = query.filter(Element.ElementCd.in_(self.element_cd))
+            if self.begin_date:
+                query = query.filter(or_(Element.LocalEndDate >= self.begin_date,
+                                         and_(Element.LocalEndDate.is_(None), Element.EndDate >= self.begin_date)))
+            if self.end_date:
+                query = query.filter(or_(Element.LocalBeginDate <= self.end_date,
+                                         and_(Element.LocalBeginDate.is_(None), Element.BeginDate <= self.end_date)))
+        return query.distinct().order_by(triplet_)
+
+    @property
+    def station_triplets(self):
+        if not hasattr(self, '_station_triplets'):
+            with read_scope() as session:
+                self._station_triplets = [triplet for triplet, in self.query(session).all()]
+        return self._station_triplets
 
     @property
     def station_id_list(self):
-        if not hasattr(self, '_station_id_list'):
-            station_id_list = []
-            for station_id in station_id_list:
-                try:
-                    station_id = find_stationtriplet_byid(station_id, 'AK')
-                    station_id_list.append(station_id)
-                except Exception as e:
-                    print(e)
-            self._station_id_list = station_id_list
-        return self._station_id_list
+        return self.station_triplets
+
+    def _query_stations(self):
+        return load_stations(self.station_triplets)
+
+    @property
+    def stations(self):
+        """ Station objects of the members, metadata only until their data is accessed """
+        if not hasattr(self, '_stations'):
+            self._stations = self._query_stations()
+        return self._stations
 
     @property
     def station_list(self):
-        if not hasattr(self, '_station_list'):
-            self._station_list = []
-        return self._station_list
+        """ All members with their data loaded, in parallel on first access """
+        if not getattr(self, '_loaded', False):
+            self.load()
+        return self.stations
+
+    # Data
+    # ====
+    def _window(self, data_frame):
+        if data_frame is None or not (self.begin_date or self.end_date):
+            return data_frame
+        index_ = data_frame.index
+        bounds = []
+        for date_ in (self.begin_date, self.end_date):
+            if date_ is not None:
+                date_ = pd.Timestamp(date_)
+                if pd.api.types.is_integer_dtype(index_):
+                    date_ = date_.value
+                elif getattr(index_, 'tz', None) is not None:
+                    date_ = date_.tz_localize(index_.tz)
+            bounds.append(date_)
+        return data_frame.loc[bounds[0]:bounds[1]]
+
+    def _load_station(self, station):
+        if self.source == 'frozen':
+            data_frame = self._get_dataframe(station.StationTriplet)
+        else:
+            data_frame = station.get_data_frame(**self.frame_kwargs)
+        station.data_frame = self._window(data_frame)
+        return station
+
+    def load(self):
+        """
+        Load the data of every member with `workers` threads.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self._load_station, self.stations))
+        self._loaded = True
+        return self
+
+    def iter_stations(self, prefetch=None):
+        """
+        Stream members with their data, loading up to `prefetch` stations ahead in parallel.
+        Yielded stations are not kept by the collection, so memory is bounded by the prefetch
+        and the frame cache.
+        """
+        prefetch = prefetch or self.workers
+        station_iter = iter(self._query_stations())
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque(executor.submit(self._load_station, station)
+                            for station in it.islice(station_iter, prefetch))
+            while pending:
+                station = pending.popleft().result()
+                for next_station in it.islice(station_iter, 1):
+                    pending.append(executor.submit(self._load_station, next_station))
+                yield station
+
+    def data_frame(self, units=NATIVE, tz='utc'):
+        """
+        :return: member frames joined on the UTC axis, see get_stations_data_frame
+        """
+        kwargs = dict((key, value) for key, value in self.frame_kwargs.items() if key not in ('units', 'tz'))
+        return self._window(get_stations_data_frame(self.stations, units=units, tz=tz, **kwargs))
+
+    # Updates
+    # =======
+    def do_update(self):
+        update_data_bystations(self.station_triplets)
+
+    def freeze(self, station=None):
+        for station_ in ([station] if station is not None else self.iter_stations()):
+            self._set_dataframe(station_.StationTriplet, station_.data_frame)
 
     def _get_dataframe(self, station_id):
         tablename = self._tablename_fromtriplet(station_id)
         try:
             return pd.read_sql(tablename, collection_engine, index_col='DateTime')
-        except:
-            return
+        except Exception:
+            return None
 
     def _set_dataframe(self, station_id, data_frame):
         tablename = self._tablename_fromtriplet(station_id)
-        data_frame.to_sql(tablename, collection_engine, if_exists='replace')
+        write_transaction(lambda conn: data_frame.to_sql(tablename, conn, if_exists='replace'), op='collection')
 
     def _tablename_fromtriplet(self, triplet_string):
         return triplet_string.replace(':', '_')
 
 
-import pickle as pck
-
-
 class AlaskaCollection(Collection):
     _state_abbr = 'AK'
     _station_id_list = [962, 958, 968, 2212, 957, 1177, 1175,
                         2210, 2211, 2065, 2081, 950, 963, 1094,
                         1089, 967, 2080, 1233]
 
-    # _station_id_list = [962, 958]
-
-    def __init__(self):
-        print('no postgres - all local')
-        self.update = False
-        self._station_list = pck.load(open(os.path.join(_PATH, 'ak_col.pck'), 'r'))
-        self.load()
+    def __init__(self, **kwargs):
+        kwargs.setdefault('station_ids', self._station_id_list)
+        super(AlaskaCollection, self).__init__(state=self._state_abbr, **kwargs)
 
     @property
     def state_abbr(self):
         return self._state_abbr
 
     def find_station(self, station_id):
-        try:
-            station_triplet, = find_stationtriplet_byid(station_id, self.state_abbr)
-            return get_station_bytriplet(station_triplet, local=False)
-        except Exception as e:
-            print(Exception('Station not found {}'.format(station_id)))
+        station_triplet = find_stationtriplet_byid(station_id, self.state_abbr)
+        if station_triplet is None:
+            logger.error('Station not found %s', station_id)
             return None
+        return get_station_bytriplet(station_triplet[0], local=True)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Python SNOTEL package .')
+    parser.add_argument('-o', '--object', dest='object', default='data',
+                        help='Choose what to update [{data}, stations, elements, alaska]')
+    parser.add_argument('-u', '--update', dest='do_update', action='store_true',
+                        help='o snotel update.')
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true',
+                        help='print the data update plan, fetch nothing')
+    parser.add_argument('-j', '--journal', dest='journal', default=None,
+                        help='journal run name, resumes the run if it exists')
+    parser.add_argument('-d', '--daemon', dest='daemon', action='store_true',
+                        help='keep running, ingest new hours on a schedule')
+    parser.add_argument('--interval', dest='interval', type=float, default=15 * 60,
+                        help='daemon seconds between cycles')
+    parser.add_argument('--status', dest='status', default=None,
+                        help='daemon status json, rewritten every cycle')
+    parser.add_argument('--log-level', dest='log_level', default='INFO',
+                        help='logging level [DEBUG, {INFO}, WARNING, ERROR]')
+    parser.add_argument('--metrics', dest='metrics', default=None,
+                        help='record metrics and write them to this file on exit (.json or .prom)')
+    parser.add_argument('--profile', dest='profile', type=float, nargs='?', const=1., default=None,
+                        help='profile this fraction of entry point calls [1.0], see profiling.py')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format=LOG_FORMAT, datefmt='%m-%d %H:%M')
+    if args.metrics:
+        metrics.enable()
+    if args.profile:
+        from . import profiling
+        profiling.enable(args.profile)
+    try:
+        _run_main(args)
+    finally:
+        if args.metrics:
+            metrics.dump(args.metrics)
 
 
-def main():
-    if args.do_update:
+def _run_main(args):
+    if args.daemon:
+        from .daemon import IngestDaemon
+        station_list = get_station_list_alaska() if args.object.lower() == 'alaska' else None
+        IngestDaemon(station_list=station_list, interval=args.interval, status_path=args.status).run()
+    elif args.do_update:
         if args.object.lower() == 'data':
-            update_data_all()
+            update_data_all(dry_run=args.dry_run, journal_run=args.journal)
         elif args.object.lower() == 'stations':
             station_list = get_station_list(local=False)
-            update_station_list(station_list)
+            update_station_list(station_list, journal_run=args.journal)
         elif args.object.lower() == 'elements':
             station_list = get_station_list(local=True)
-            update_stationlist_elements(station_list)
+            update_stationlist_elements(station_list, journal_run=args.journal)
         elif args.object.lower() == 'alaska':
             station_list = get_station_list_alaska()
-            update_data_bystations(station_list)
+            update_data_bystations(station_list, dry_run=args.dry_run)
 
 
 if __name__ == '__main__':
-    # parse input args
-    parser = argparse.ArgumentParser(description='Python SNOTEL package .')
-    parser.add_argument('-o', '--object', dest='update', default='data',
-                        help='Choose what to update [{data}, stations, elements]')
-    parser.add_argument('-u', '--update', dest='update', action='store_true',
-                        help='o snotel update.')
-    global args
-    args = parser.parse_args()
-    # sys.exit(main())
-    AlaskaCollection()
+    sys.exit(main())
@@ -0,0 +1,467 @@
+''' AWDB Stand-in
+    ~~~~~~~~~~~~~
+    Local SOAP server implementing the AWDB methods this package uses
+    (getStations, getStationMetadata, getStationMetadataMultiple,
+    getStationElements, getElements, getHourlyData, getData), serving a synthetic network
+    (synthetic.py) or recorded fixtures, with configurable latency, error rate and
+    payload size.  Point the package at it with SNOTEL_AWDB_URL or
+    snotel.set_service_url(standin.url) to run full update pipelines offline.
+
+        python -m snotel.standin --stations 900 --years 10 --port 8088 --latency 0.05 --error-rate 0.01
+'''
+
+__author__ = 'nsteiner'
+
+import json
+import time
+import random
+import logging
+import argparse
+import datetime
+import threading
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .elementrecord import ELEMENTS
+from .synthetic import SyntheticNetwork, DATE_FMT
+
+logger = logging.getLogger(__name__)
+
+TNS = 'http://www.wcc.nrcs.usda.gov/ns/awdbWebService'
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+'''
+WSDL
+~~~~
+'''
+
+_TYPES = {
+    'stationMetaData': [('beginDate', 'string'), ('countyName', 'string'), ('elevation', 'decimal'),
+                        ('endDate', 'string'), ('fipsCountryCd', 'string'), ('fipsCountyCd', 'string'),
+                        ('fipsStateNumber', 'string'), ('huc', 'string'), ('hud', 'string'),
+                        ('latitude', 'decimal'), ('longitude', 'decimal'), ('name', 'string'),
+                        ('stationDataTimeZone', 'decimal'), ('stationTriplet', 'string')],
+    'heightDepth': [('unitCd', 'string'), ('value', 'decimal')],
+    'stationElement': [('beginDate', 'string'), ('dataPrecision', 'int'), ('dataSource', 'string'),
+                       ('duration', 'string'), ('elementCd', 'string'), ('endDate', 'string'),
+                       ('heightDepth', 'tns:heightDepth'), ('ordinal', 'int'), ('originalUnitCd', 'string'),
+                       ('stationTriplet', 'string'), ('storedUnitCd', 'string')],
+    'element': [('elementCd', 'string'), ('name', 'string'), ('storedUnitCd', 'string')],
+    'hourlyDataValue': [('dateTime', 'string'), ('flag', 'string'), ('value', 'decimal')],
+    'hourlyData': [('beginDate', 'string'), ('endDate', 'string'), ('stationTriplet', 'string'),
+                   ('values', 'tns:hourlyDataValue*')],
+    # daily and semimonthly: one value (nil if missing) per period from beginDate
+    'data': [('beginDate', 'string'), ('collectionDates', 'string*'), ('duration', 'string'),
+             ('endDate', 'string'), ('flags', 'string*'), ('stationTriplet', 'string'), ('values', 'decimal*')],
+}
+
+# operation: ([(parameter, type)], return type, return is a list)
+_OPERATIONS = {
+    'getStations': ([('stateCds', 'string*'), ('networkCds', 'string*'), ('logicalAnd', 'boolean')],
+                    'string', True),
+    'getStationMetadata': ([('stationTriplet', 'string')], 'tns:stationMetaData', False),
+    'getStationMetadataMultiple': ([('stationTriplets', 'string*')], 'tns:stationMetaData', True),
+    'getStationElements': ([('stationTriplet', 'string'), ('beginDate', 'string'), ('endDate', 'string')],
+                           'tns:stationElement', True),
+    'getElements': ([], 'tns:element', True),
+    'getHourlyData': ([('stationTriplets', 'string*'), ('elementCd', 'string'), ('ordinal', 'int'),
+                       ('heightDepth', 'tns:heightDepth'), ('beginDate', 'string'), ('endDate', 'string')],
+                      'tns:hourlyData', True),
+    'getData': ([('stationTriplets', 'string*'), ('elementCd', 'string'), ('ordinal', 'int'),
+                 ('heightDepth', 'tns:heightDepth'), ('duration', 'string'), ('getFlags', 'boolean'),
+                 ('beginDate', 'string'), ('endDate', 'string'), ('alwaysReturnDailyFeb29', 'boolean')],
+                'tns:data', True),
+}
+
+
+def _xs_element(name, type_):
+    many = type_.endswith('*')
+    type_ = type_.rstrip('*')
+    if not type_.startswith('tns:'):
+        type_ = 'xs:' + type_
+    return '<xs:element name="{}" type="{}" minOccurs="0"{}/>'.format(
+        name, type_, ' maxOccurs="unbounded" nillable="true"' if many else '')
+
+
+def _sequence(fields):
+    return '<xs:sequence>{}</xs:sequence>'.format(''.join(_xs_element(name, type_) for name, type_ in fields))
+
+
+def build_wsdl(location):
+    """
+    :param location: soap:address of the service
+    :return: wsdl document, document/literal wrapped
+    """
+    types_ = ''.join('<xs:complexType name="{}">{}</xs:complexType>'.format(name, _sequence(fields))
+                     for name, fields in _TYPES.items())
+    elements_, messages_, port_ops, binding_ops = [], [], [], []
+    for op, (params, return_type, many) in _OPERATIONS.items():
+        elements_.append('<xs:element name="{op}"><xs:complexType>{seq}</xs:complexType></xs:element>'.format(
+            op=op, seq=_sequence(params)))
+        elements_.append('<xs:element name="{op}Response"><xs:complexType>{seq}</xs:complexType></xs:element>'.format(
+            op=op, seq=_sequence([('return', return_type + ('*' if many else ''))])))
+        messages_.append('<wsdl:message name="{op}"><wsdl:part name="parameters" element="tns:{op}"/></wsdl:message>'
+                         '<wsdl:message name="{op}Response"><wsdl:part name="parameters" element="tns:{op}Response"/>'
+                         '</wsdl:message>'.format(op=op))
+        port_ops.append('<wsdl:operation name="{op}"><wsdl:input message="tns:{op}"/>'
+                        '<wsdl:output message="tns:{op}Response"/></wsdl:operation>'.format(op=op))
+        binding_ops.append('<wsdl:operation name="{op}"><soap:operation soapAction=""/>'
+                           '<wsdl:input><soap:body use="literal"/></wsdl:input>'
+                           '<wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>'.format(op=op))
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<wsdl:definitions name="AwdbWebService" targetNamespace="{tns}" xmlns:tns="{tns}"
+    xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:xs="http://www.w3.org/2001/XMLSchema">
+<wsdl:types><xs:schema targetNamespace="{tns}" elementFormDefault="unqualified">{types}{elements}</xs:schema></wsdl:types>
+{messages}
+<wsdl:portType name="AwdbWebService">{port_ops}</wsdl:portType>
+<wsdl:binding name="AwdbWebServiceSoapBinding" type="tns:AwdbWebService">
+<soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>{binding_ops}</wsdl:binding>
+<wsdl:service name="AwdbWebService"><wsdl:port name="AwdbWebServiceImplPort" binding="tns:AwdbWebServiceSoapBinding">
+<soap:address location="{location}"/></wsdl:port></wsdl:service>
+</wsdl:definitions>'''.format(tns=TNS, types=types_, elements=''.join(elements_), messages=''.join(messages_),
+                              port_ops=''.join(port_ops), binding_ops=''.join(binding_ops), location=location)
+
+
+'''
+SOAP
+~~~~
+'''
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_request(body):
+    """
+    :return: (operation, {parameter: value}); repeated parameters become lists
+    """
+    envelope = ElementTree.fromstring(body)
+    soap_body = [child for child in envelope if _local(child.tag) == 'Body'][0]
+    op_element = list(soap_body)[0]
+    params = {}
+    for child in op_element:
+        name = _local(child.tag)
+        if len(child):
+            value = dict((_local(sub.tag), sub.text) for sub in child)
+        else:
+            value = child.text
+        if name in params:
+            if not isinstance(params[name], list):
+                params[name] = [params[name]]
+            params[name].append(value)
+        else:
+            params[name] = value
+    return _local(op_element.tag), params
+
+
+def _to_xml(name, value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        # missing list items keep their position
+        return ''.join('<{} xsi:nil="true"/>'.format(name) if val is None else _to_xml(name, val) for val in value)
+    if isinstance(value, dict):
+        return '<{0}>{1}</{0}>'.format(name, ''.join(_to_xml(key, val) for key, val in value.items()))
+    return '<{0}>{1}</{0}>'.format(name, escape(str(value)))
+
+
+def build_response(op, result):
+    return ('<?xml version="1.0" encoding="UTF-8"?><soap:Envelope xmlns:soap="{soap}" xmlns:xsi="{xsi}">'
+            '<soap:Body><ns2:{op}Response xmlns:ns2="{tns}">{result}</ns2:{op}Response>'
+            '</soap:Body></soap:Envelope>').format(soap=SOAP_NS, xsi=XSI_NS, tns=TNS, op=op,
+                                                   result=_to_xml('return', result))
+
+
+def build_fault(message):
+    return ('<?xml version="1.0" encoding="UTF-8"?><soap:Envelope xmlns:soap="{soap}"><soap:Body>'
+            '<soap:Fault><faultcode>soap:Server</faultcode><faultstring>{msg}</faultstring></soap:Fault>'
+            '</soap:Body></soap:Envelope>').format(soap=SOAP_NS, msg=escape(message))
+
+
+'''
+Data Sources
+~~~~~~~~~~~~
+Synthetic (synthetic.SyntheticNetwork) or recorded (FixtureSource); both provide
+station_list, station_meta, station_elements, hourly_data and period_data.
+'''
+
+
+def _fixture_key(station_triplet, element_cd, depth):
+    return '{}|{}|{}'.format(station_triplet, element_cd, None if depth is None else float(depth))
+
+
+class FixtureSource(object):
+    """
+    Recorded responses, written by record_fixture.
+    """
+
+    def __init__(self, path):
+        with open(path) as fixture_file:
+            fixture = json.load(fixture_file)
+        self.stations = fixture['stations']
+        self.elements = fixture['elements']
+        self.data = fixture['data']
+
+    @property
+    def station_list(self):
+        return list(self.stations)
+
+    def station_meta(self, station_triplet):
+        return self.stations[station_triplet]
+
+    def station_elements(self, station_triplet):
+        return self.elements.get(station_triplet, [])
+
+    def hourly_data(self, station_triplet, element_cd, depth=None, begin_date=None, end_date=None):
+        rows = self.data.get(_fixture_key(station_triplet, element_cd, depth), [])
+        begin_ = begin_date.strftime(DATE_FMT) if begin_date else ''
+        end_ = end_date.strftime(DATE_FMT) if end_date else '9999'
+        values = [{'dateTime': date_time, 'flag': flag, 'value': value}
+                  for date_time, flag, value in rows if begin_ <= date_time <= end_]
+        return {'beginDate': values[0]['dateTime'] if values else None,
+                'endDate': values[-1]['dateTime'] if values else None,
+                'stationTriplet': station_triplet, 'values': values}
+
+    def period_data(self, station_triplet, element_cd, depth=None, duration='DAILY', begin_date=None,
+                    end_date=None):
+        # fixtures hold hourly data only
+        return {'stationTriplet': station_triplet, 'duration': duration, 'values': []}
+
+
+def _asdict(obj):
+    if isinstance(obj, list):
+        return [_asdict(val) for val in obj]
+    if hasattr(obj, '__keylist__'):
+        return dict((key, _asdict(val)) for key, val in obj)
+    if obj is None or isinstance(obj, (int, float, bool)):
+        return obj
+    return str(obj)
+
+
+def record_fixture(station_list, path, begin_date, end_date):
+    """
+    Record metadata and hourly data of some stations from the configured service into a fixture file.
+    """
+    from . import snotel
+    fixture = {'stations': {}, 'elements': {}, 'data': {}}
+    for station_meta in snotel.get_station_meta(station_list=station_list):
+        fixture['stations'][str(station_meta.stationTriplet)] = _asdict(station_meta)
+    for station_triplet in station_list:
+        element_list = _asdict(snotel.client.service.getStationElements(station_triplet))
+        fixture['elements'][station_triplet] = element_list
+        for element in snotel.get_element_bystationtriplet(station_triplet, local=False):
+            if element.Duration != 'HOURLY':
+                continue
+            request = snotel.cast_update_element_request(element, begin_date=begin_date, end_date=end_date)
+            data_result = snotel.get_data_hourly(request)[0]
+            rows = [(str(row.dateTime), str(row.flag), float(row.value) if row.value is not None else None)
+                    for row in getattr(data_result, 'values', [])]
+            fixture['data'][_fixture_key(station_triplet, element.ElementCd, element.HeightDepth)] = rows
+    with open(path, 'w') as fixture_file:
+        json.dump(fixture, fixture_file)
+    return path
+
+
+'''
+Server
+~~~~~~
+'''
+
+
+def _parse_date(date_str):
+    if not date_str:
+        return None
+    if len(date_str) == 10:
+        # getData dates
+        return datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    return datetime.datetime.strptime(date_str[:16], DATE_FMT)
+
+
+class StandIn(object):
+    """
+    :param source: SyntheticNetwork or FixtureSource
+    :param latency: seconds added to every call
+    :param jitter: random extra seconds, uniform in [0, jitter]
+    :param error_rate: fraction of calls dropped without a response (transport error)
+    :param fault_rate: fraction of calls answered with a SOAP fault
+    :param max_values: largest number of values per station in getHourlyData, None for all
+    """
+
+    def __init__(self, source=None, host='127.0.0.1', port=0, latency=0., jitter=0., error_rate=0.,
+                 fault_rate=0., max_values=None):
+        self.source = source if source is not None else SyntheticNetwork()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.max_values = max_values
+        self.n_calls = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    def __repr__(self):
+        return '<StandIn: {} {}>'.format(self.url, self.source)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/awdb?wsdl'.format(host, port)
+
+    @property
+    def location(self):
+        return self.url.split('?')[0]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # AWDB Methods
+    # ============
+    def getStations(self, stateCds=None, networkCds=None, logicalAnd=None):
+        station_list = self.source.station_list
+        for codes, position in ((stateCds, 1), (networkCds, 2)):
+            if codes:
+                codes = codes if isinstance(codes, list) else [codes]
+                station_list = [triplet for triplet in station_list if triplet.split(':')[position] in codes]
+        return station_list
+
+    def getStationMetadata(self, stationTriplet=None):
+        return self.source.station_meta(stationTriplet)
+
+    def getStationMetadataMultiple(self, stationTriplets=None):
+        triplets = stationTriplets if isinstance(stationTriplets, list) else [stationTriplets]
+        return [self.source.station_meta(triplet) for triplet in triplets]
+
+    def getStationElements(self, stationTriplet=None, beginDate=None, endDate=None):
+        return self.source.station_elements(stationTriplet)
+
+    def getElements(self):
+        return [{'elementCd': code, 'name': name, 'storedUnitCd': unit} for code, (name, unit, _) in ELEMENTS.items()]
+
+    def getHourlyData(self, stationTriplets=None, elementCd=None, ordinal=None, heightDepth=None,
+                      beginDate=None, endDate=None):
+        triplets = stationTriplets if isinstance(stationTriplets, list) else [stationTriplets]
+        depth = None
+        if isinstance(heightDepth, dict) and heightDepth.get('value') is not None:
+            depth = float(heightDepth['value'])
+        data_list = []
+        for triplet in triplets:
+            data_ = self.source.hourly_data(triplet, elementCd, depth=depth, begin_date=_parse_date(beginDate),
+                                            end_date=_parse_date(endDate))
+            if self.max_values is not None and len(data_['values']) > self.max_values:
+                data_['values'] = data_['values'][:self.max_values]
+                data_['endDate'] = data_['values'][-1]['dateTime']
+            if not data_['values']:
+                data_ = {'stationTriplet': triplet}
+            data_list.append(data_)
+        return data_list
+
+    def getData(self, stationTriplets=None, elementCd=None, ordinal=None, heightDepth=None, duration=None,
+                getFlags=None, beginDate=None, endDate=None, alwaysReturnDailyFeb29=None):
+        triplets = stationTriplets if isinstance(stationTriplets, list) else [stationTriplets]
+        depth = None
+        if isinstance(heightDepth, dict) and heightDepth.get('value') is not None:
+            depth = float(heightDepth['value'])
+        data_list = []
+        for triplet in triplets:
+            data_ = self.source.period_data(triplet, elementCd, depth=depth, duration=duration,
+                                            begin_date=_parse_date(beginDate), end_date=_parse_date(endDate))
+            if str(getFlags).lower() != 'true':
+                data_.pop('flags', None)
+            if not data_['values']:
+                data_ = {'stationTriplet': triplet}
+            data_list.append(data_)
+        return data_list
+
+    def dispatch(self, op, params):
+        with self._lock:
+            self.n_calls[op] = self.n_calls.get(op, 0) + 1
+        if op not in _OPERATIONS:
+            raise ValueError('Unknown operation {}'.format(op))
+        return getattr(self, op)(**params)
+
+
+def _make_handler(standin):
+
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+        def _send(self, status, body, content_type='text/xml; charset=utf-8'):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._send(200, build_wsdl(standin.location))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            delay = standin.latency + random.uniform(0., standin.jitter)
+            if delay:
+                time.sleep(delay)
+            if random.random() < standin.error_rate:
+                # drop the connection, the client sees a transport error
+                self.close_connection = True
+                self.connection.shutdown(2)
+                return
+            if random.random() < standin.fault_rate:
+                self._send(500, build_fault('Stand-in fault'))
+                return
+            try:
+                op, params = parse_request(body)
+                self._send(200, build_response(op, standin.dispatch(op, params)))
+            except Exception as e:
+                logger.exception('Stand-in error')
+                self._send(500, build_fault(str(e)))
+
+    return _Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local AWDB stand-in server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--stations', type=int, default=10, help='synthetic stations')
+    parser.add_argument('--years', type=int, default=2, help='synthetic years of hourly data')
+    parser.add_argument('--fixture', default=None, help='serve a recorded fixture instead')
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.)
+    parser.add_argument('--fault-rate', dest='fault_rate', type=float, default=0.)
+    parser.add_argument('--max-values', dest='max_values', type=int, default=None)
+    args = parser.parse_args(argv)
+    source = FixtureSource(args.fixture) if args.fixture else SyntheticNetwork(args.stations, years=args.years)
+    standin = StandIn(source, host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate, fault_rate=args.fault_rate, max_values=args.max_values)
+    print('Serving {} at {}'.format(source, standin.url))
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()
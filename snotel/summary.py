@@ -0,0 +1,331 @@
+''' Element Summary
+    ~~~~~~~~~~~~~~~
+    Latest observation and coverage of every element, kept up to date at ingest
+    so status questions are one indexed query instead of loading histories:
+
+        status(state='AK', element_cd='SNWD')        # current snow depth at every AK station
+        stale(hours=48, network='SNTL')              # sensors without a report in 48 h
+
+    element_summary has one row per element: first and last observation, last
+    valid value, flag of the last observation, valid counts of the 24 h and 7 d
+    ending at the last observation, row counts and the observed extrema.
+    element_coverage has the valid fraction of every element and UTC year.
+    Daily and semimonthly elements are counted in their own periods
+    (snotel.DURATION_HOURS): one bit of the recent mask per period, coverage
+    against the periods of the year.
+
+    commit_element_update folds each stored batch in (update_summary): only rows
+    after the last summarized observation are counted, a batch starting at or
+    before the first observation (a full refetch) resets the element.  Values
+    revised inside the summarized period are picked up by rebuild_summary.
+'''
+
+__author__ = 'nsteiner'
+
+import sys
+import logging
+import datetime
+import argparse
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import types, Column, Index, select
+
+from . import snotel
+from .snotel import Base, Collection, Element, Station, read_scope, write_transaction, NS_PER_HOUR
+
+logger = logging.getLogger(__name__)
+
+RECENT_HOURS = 7 * 24
+VALID_FLAG = 'V'
+
+
+class ElementSummary(Base):
+    """ Latest observation and counts of one element """
+
+    __tablename__ = 'element_summary'
+    ElementTriplet = Column(types.String, primary_key=True)
+    StationTriplet = Column(types.String, index=True)
+    ElementCd = Column(types.String)
+    Duration = Column(types.String)
+    HeightDepth = Column(types.Float)
+    FirstUTC = Column(types.BigInteger)  # UTC, ns since epoch
+    LastUTC = Column(types.BigInteger, index=True)  # last observation
+    LastFlag = Column(types.String(1))  # flag of the last observation
+    LastValidUTC = Column(types.BigInteger)
+    LastValue = Column(types.Float)  # last valid value
+    Recent = Column(types.String)  # hex bit mask, bit i: valid observation i periods (hours) before LastUTC
+    Count24h = Column(types.Integer)  # valid observations in the 24 h ending at LastUTC
+    Count7d = Column(types.Integer)
+    NRows = Column(types.Integer)
+    NValid = Column(types.Integer)
+    MinValue = Column(types.Float)  # valid values only
+    MaxValue = Column(types.Float)
+    UpdatedAt = Column(types.DateTime)  # UTC
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+    def __repr__(self):
+        return '<ElementSummary: {} {}>'.format(self.ElementTriplet, self.LastValue)
+
+    @property
+    def last_datetime(self):
+        return pd.Timestamp(self.LastUTC, tz='UTC') if self.LastUTC is not None else None
+
+
+class ElementCoverage(Base):
+    """ Valid observations of one element in one UTC year """
+
+    __tablename__ = 'element_coverage'
+    ElementTriplet = Column(types.String, primary_key=True)
+    Year = Column(types.Integer, primary_key=True)
+    NRows = Column(types.Integer)
+    NValid = Column(types.Integer)
+    Coverage = Column(types.Float)  # NValid / periods (hours) of the year
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+
+SUMMARY_INDEXES = [Index('ix_summary_code', ElementSummary.ElementCd, ElementSummary.Duration)]
+
+_TABLES = [None]
+
+
+def _ensure_tables():
+    # created once per engine, databases made before the summary
+    if _TABLES[0] is not snotel.ee:
+        for table_ in (ElementSummary.__table__, ElementCoverage.__table__):
+            table_.create(snotel.ee, checkfirst=True)
+        for index_ in SUMMARY_INDEXES:
+            index_.create(snotel.ee, checkfirst=True)
+        _TABLES[0] = snotel.ee
+
+
+def _hours_of_year(year):
+    return (pd.Timestamp(year + 1, 1, 1) - pd.Timestamp(year, 1, 1)) // pd.Timedelta(hours=1)
+
+
+def _periods(hours, period_hours):
+    """ whole periods of an element's duration in `hours`, at least one """
+    return max(int(hours // period_hours), 1)
+
+
+def _valid(data_frame):
+    return ((data_frame['flag'] == VALID_FLAG) & data_frame['value'].notnull()).values
+
+
+def _fold(summary, data_frame, period_hours=1):
+    """
+    Add the rows of data_frame (all after summary.LastUTC) to the summary values.
+
+    :param summary: dict of element_summary columns
+    :param period_hours: hours between observations, snotel.DURATION_HOURS of the element
+    :return: {year: (rows, valid rows)} of data_frame
+    """
+    utc_ = data_frame.index.values.astype('i8')
+    valid_ = _valid(data_frame)
+    values_ = data_frame['value'].values[valid_]
+    last_utc = int(utc_[-1])
+    n_recent = _periods(RECENT_HOURS, period_hours)
+    period_ns = period_hours * NS_PER_HOUR
+    # shift the recent mask to the new last observation, then set the new valid periods;
+    # rounded, semimonthly periods are 13 to 16 days
+    recent = int(summary['Recent'] or '0', 16)
+    if summary['LastUTC'] is not None:
+        shift_ = int(round((last_utc - summary['LastUTC']) / float(period_ns)))
+        recent = (recent << shift_) & ((1 << n_recent) - 1) if shift_ < n_recent else 0
+    for period_ in np.unique(np.round((last_utc - utc_[valid_]) / float(period_ns)).astype('i8')):
+        if period_ < n_recent:
+            recent |= 1 << int(period_)
+    summary.update(LastUTC=last_utc, LastFlag=data_frame['flag'].values[-1], Recent=format(recent, 'x'),
+                   Count24h=bin(recent & ((1 << _periods(24, period_hours)) - 1)).count('1'),
+                   Count7d=bin(recent).count('1'),
+                   NRows=(summary['NRows'] or 0) + len(utc_), NValid=(summary['NValid'] or 0) + int(valid_.sum()))
+    if summary['FirstUTC'] is None:
+        summary['FirstUTC'] = int(utc_[0])
+    if len(values_):
+        summary['LastValidUTC'] = int(utc_[valid_][-1])
+        summary['LastValue'] = float(values_[-1])
+        min_, max_ = float(values_.min()), float(values_.max())
+        summary['MinValue'] = min_ if summary['MinValue'] is None else min(summary['MinValue'], min_)
+        summary['MaxValue'] = max_ if summary['MaxValue'] is None else max(summary['MaxValue'], max_)
+    years_ = pd.DatetimeIndex(utc_.view('datetime64[ns]')).year.values
+    return dict((int(year), (int((years_ == year).sum()), int(valid_[years_ == year].sum())))
+                for year in np.unique(years_))
+
+
+def _write_summary(conn, element, data_frame, reset=False):
+    stable, ctable = ElementSummary.__table__, ElementCoverage.__table__
+    triplet_ = element.ElementTriplet
+    row = conn.execute(select([stable]).where(stable.c.ElementTriplet == triplet_)).first()
+    if row is not None and not reset and row.FirstUTC is not None and data_frame.index[0] > row.FirstUTC:
+        summary = dict(row._mapping)
+        data_frame = data_frame[data_frame.index > summary['LastUTC']]
+        coverage = dict((cov.Year, (cov.NRows, cov.NValid)) for cov in conn.execute(
+            select([ctable]).where(ctable.c.ElementTriplet == triplet_)))
+    else:
+        # new element, full refetch or rebuild
+        summary = dict((column.name, None) for column in stable.columns)
+        coverage = {}
+    if not len(data_frame):
+        return
+    summary.update(ElementTriplet=triplet_, StationTriplet=element.StationTriplet, ElementCd=element.ElementCd,
+                   Duration=element.Duration, HeightDepth=element.HeightDepth,
+                   UpdatedAt=datetime.datetime.utcnow())
+    period_hours = snotel.DURATION_HOURS.get(element.Duration, 1)
+    years = _fold(summary, data_frame, period_hours=period_hours)
+    conn.execute(stable.delete().where(stable.c.ElementTriplet == triplet_))
+    conn.execute(stable.insert().values(summary))
+    conn.execute(ctable.delete().where(ctable.c.ElementTriplet == triplet_))
+    for year, (n_rows, n_valid) in years.items():
+        rows_, valid_ = coverage.get(year, (0, 0))
+        coverage[year] = (rows_ + n_rows, valid_ + n_valid)
+    conn.execute(ctable.insert(), [dict(ElementTriplet=triplet_, Year=year, NRows=n_rows, NValid=n_valid,
+                                        Coverage=n_valid / float(_periods(_hours_of_year(year), period_hours)))
+                                   for year, (n_rows, n_valid) in sorted(coverage.items())])
+
+
+def update_summary(element, data_frame, reset=False):
+    """
+    Fold a stored batch into the element's summary and coverage rows.
+
+    :param data_frame: frame of value and flag indexed by UTC ns, e.g. from parse_data_frame
+    :param reset: recompute the element from data_frame alone
+    """
+    if data_frame is None or not len(data_frame):
+        return
+    _ensure_tables()
+    data_frame = data_frame.sort_index()
+    data_frame = data_frame[~data_frame.index.duplicated(keep='last')]
+    write_transaction(lambda conn: _write_summary(conn, element, data_frame, reset=reset), op='summary')
+
+
+def rebuild_summary(element_triplets=None, data_format='par'):
+    """
+    Recompute summaries from the stored data, e.g. after backfills or for data stored before the summary.
+
+    :param element_triplets: elements to rebuild, every element if None
+    :return: number of elements rebuilt
+    """
+    with read_scope() as session:
+        query = session.query(Element)
+        if element_triplets is not None:
+            query = query.filter(Element.ElementTriplet.in_(list(element_triplets)))
+        element_list = query.all()
+        session.expunge_all()
+    for element in element_list:
+        update_summary(element, element._load_dataframe(data_format=data_format), reset=True)
+    return len(element_list)
+
+
+'''
+Status Queries
+~~~~~~~~~~~~~~
+'''
+
+STATION_COLUMNS = ('Name', 'Latitude', 'Longitude', 'Elevation')
+SUMMARY_COLUMNS = ('ElementTriplet', 'StationTriplet', 'ElementCd', 'HeightDepth', 'LastUTC', 'LastFlag',
+                   'LastValidUTC', 'LastValue', 'Count24h', 'Count7d', 'NRows', 'NValid', 'MinValue', 'MaxValue')
+
+
+def _status_query(session, state=None, network=None, station_triplets=None, bbox=None, element_cd=None,
+                  depth=None, duration=None):
+    query = session.query(ElementSummary, Station). \
+        join(Station, Station.StationTriplet == ElementSummary.StationTriplet)
+    if any(value is not None for value in (state, network, station_triplets, bbox)):
+        station_ = Collection(state=state, network=network, station_triplets=station_triplets,
+                              bbox=bbox).query(session).subquery()
+        query = query.filter(ElementSummary.StationTriplet.in_(session.query(station_.c.StationTriplet)))
+    if element_cd is not None:
+        query = query.filter(ElementSummary.ElementCd.in_(snotel._as_list(element_cd)))
+    if duration is not None:
+        query = query.filter(ElementSummary.Duration.in_(snotel._as_list(duration)))
+    if depth is not None:
+        query = query.filter(ElementSummary.HeightDepth.in_([depth] if np.isscalar(depth) else list(depth)))
+    return query.order_by(ElementSummary.ElementTriplet)
+
+
+def _status_frame(rows):
+    records = [[getattr(summary, name) for name in SUMMARY_COLUMNS] + [getattr(station, name) for name in STATION_COLUMNS]
+               for summary, station in rows]
+    data_frame = pd.DataFrame(records, columns=SUMMARY_COLUMNS + STATION_COLUMNS)
+    for column in ('LastUTC', 'LastValidUTC'):
+        data_frame[column] = pd.to_datetime(data_frame[column], utc=True)
+    return data_frame.set_index('ElementTriplet')
+
+
+def status(**filters):
+    """
+    Latest observation of every matching element.
+
+    :param filters: state, network, station_triplets, bbox, element_cd, depth, duration
+    :return: frame indexed by element triplet, times as UTC datetimes
+    """
+    _ensure_tables()
+    with read_scope() as session:
+        return _status_frame(_status_query(session, **filters).all())
+
+
+def stale(hours=48, now=None, **filters):
+    """
+    Elements without an observation in the last `hours`.
+
+    :param now: reference time (UTC), utcnow if None
+    :param filters: status filters
+    """
+    _ensure_tables()
+    now = pd.Timestamp(now or datetime.datetime.utcnow())
+    cutoff = (now.tz_localize('UTC') if now.tz is None else now).value - int(hours * NS_PER_HOUR)
+    with read_scope() as session:
+        query = _status_query(session, **filters).filter(ElementSummary.LastUTC < cutoff)
+        return _status_frame(query.all())
+
+
+def coverage(element_triplets=None, years=None):
+    """
+    :return: frame of valid fraction, element triplets by UTC years
+    """
+    _ensure_tables()
+    with read_scope() as session:
+        query = session.query(ElementCoverage.ElementTriplet, ElementCoverage.Year, ElementCoverage.Coverage)
+        if element_triplets is not None:
+            query = query.filter(ElementCoverage.ElementTriplet.in_(list(element_triplets)))
+        if years is not None:
+            query = query.filter(ElementCoverage.Year.in_(list(years)))
+        rows = query.all()
+    data_frame = pd.DataFrame(rows, columns=['ElementTriplet', 'Year', 'Coverage'])
+    return data_frame.pivot(index='ElementTriplet', columns='Year', values='Coverage')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Latest observations and coverage from the element summary')
+    parser.add_argument('--state', help='state code(s), comma separated')
+    parser.add_argument('--network', help='network code(s), comma separated')
+    parser.add_argument('--element', help='element code(s), comma separated')
+    parser.add_argument('--stale', type=float, metavar='HOURS', help='only elements silent for HOURS')
+    parser.add_argument('--coverage', action='store_true', help='valid fraction by year instead')
+    parser.add_argument('--rebuild', action='store_true', help='recompute every summary from stored data')
+    parser.add_argument('--data-format', default='par', choices=('par', 'sql'))
+    args = parser.parse_args(argv)
+
+    def _split(value):
+        return value.split(',') if value else None
+
+    if args.rebuild:
+        logger.info('Rebuilt %s element summaries', rebuild_summary(data_format=args.data_format))
+    filters = dict(state=_split(args.state), network=_split(args.network), element_cd=_split(args.element))
+    if args.coverage:
+        print(coverage(status(**filters).index).to_string())
+    elif args.stale is not None:
+        print(stale(args.stale, **filters).to_string())
+    else:
+        print(status(**filters).to_string())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=snotel.LOG_FORMAT)
+    sys.exit(main())
@@ -0,0 +1,173 @@
+''' Synthetic Network
+    ~~~~~~~~~~~~~~~~~
+    Deterministic synthetic SNOTEL network: N stations x M elements x Y years of
+    hourly data with seasonal/diurnal signal, noise, gaps and suspect flags.
+    Elements may also be offered as DAILY and SEMIMONTHLY series, the period
+    means of the hourly values.  Used by the local AWDB stand-in (standin.py)
+    and the benchmarks.
+'''
+
+__author__ = 'nsteiner'
+
+import zlib
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from .elementrecord import ELEMENTS
+
+DATE_FMT = '%Y-%m-%d %H:%M'
+META_DATE_FMT = '%Y-%m-%d %H:%M:%S'
+# (element code, depth in inches or None)
+DEFAULT_ELEMENTS = [('TOBS', None), ('SNWD', None), ('WTEQ', None),
+                    ('STO', -2.), ('STO', -8.), ('STO', -20.),
+                    ('SMS', -2.), ('SMS', -8.), ('SMS', -20.)]
+# mean, seasonal amplitude, diurnal amplitude, noise, floor
+SIGNAL = {'TOBS': (30., 25., 8., 3., None), 'SNWD': (10., 30., 0., 1., 0.), 'WTEQ': (3., 10., 0., .2, 0.),
+          'STO': (35., 15., 2., .5, None), 'SMS': (25., 10., 0., 1., 0.)}
+# period starts of the getData durations
+PERIOD_FREQ = {'DAILY': 'D', 'SEMIMONTHLY': 'SMS-16'}
+
+
+def _seed(*keys):
+    return zlib.crc32(':'.join(str(key) for key in keys).encode())
+
+
+class SyntheticNetwork(object):
+    """
+    :param n_stations: number of stations
+    :param elements: [(element code, depth)] at every station
+    :param years: years of hourly history before `end`
+    :param state: state code of the station triplets
+    :param gap_rate: fraction of hours missing
+    :param flag_rate: fraction of values flagged suspect ('S')
+    :param end: last hour of data, defaults to the current hour
+    :param durations: durations every element is offered in, HOURLY and/or DAILY, SEMIMONTHLY
+    """
+
+    def __init__(self, n_stations=10, elements=DEFAULT_ELEMENTS, years=2, state='AK', network='SNTL',
+                 gap_rate=0.01, flag_rate=0.005, end=None, durations=('HOURLY',)):
+        self.n_stations = n_stations
+        self.elements = list(elements)
+        self.durations = list(durations)
+        self.years = years
+        self.state = state
+        self.network = network
+        self.gap_rate = gap_rate
+        self.flag_rate = flag_rate
+        self.end = (end or datetime.datetime.now()).replace(minute=0, second=0, microsecond=0)
+        self.begin = datetime.datetime(self.end.year - years + 1, 1, 1)
+
+    def __repr__(self):
+        return '<SyntheticNetwork: {} stations x {} elements x {} years>'.format(
+            self.n_stations, len(self.elements), self.years)
+
+    # Metadata
+    # ========
+    @property
+    def station_list(self):
+        return ['{}:{}:{}'.format(1000 + i, self.state, self.network) for i in range(self.n_stations)]
+
+    def station_index(self, station_triplet):
+        return int(station_triplet.split(':')[0]) - 1000
+
+    def station_meta(self, station_triplet):
+        i = self.station_index(station_triplet)
+        rng = np.random.RandomState(_seed(station_triplet))
+        return {'beginDate': self.begin.strftime(META_DATE_FMT),
+                'countyName': 'SYNTHETIC',
+                'elevation': '{:.1f}'.format(rng.uniform(100, 4000)),
+                'endDate': '2100-01-01 00:00:00',
+                'fipsCountryCd': 'US', 'fipsCountyCd': '{:03d}'.format(i % 300), 'fipsStateNumber': '02',
+                'huc': '19{:010d}'.format(i), 'hud': '19{:06d}'.format(i),
+                'latitude': '{:.5f}'.format(rng.uniform(55, 70)),
+                'longitude': '{:.5f}'.format(rng.uniform(-165, -135)),
+                'name': 'SYNTHETIC {}'.format(i),
+                'stationDataTimeZone': '-9.0',
+                'stationTriplet': station_triplet}
+
+    def station_elements(self, station_triplet):
+        element_list = []
+        for (element_cd, depth), duration in ((element_, duration_) for element_ in self.elements
+                                              for duration_ in self.durations):
+            meta = {'beginDate': self.begin.strftime(META_DATE_FMT),
+                    'dataPrecision': '1', 'dataSource': 'OBSERVED', 'duration': duration,
+                    'elementCd': element_cd, 'endDate': '2100-01-01 00:00:00', 'ordinal': '1',
+                    'originalUnitCd': ELEMENTS.get(element_cd, ('', 'unitless'))[1],
+                    'stationTriplet': station_triplet,
+                    'storedUnitCd': ELEMENTS.get(element_cd, ('', 'unitless'))[1]}
+            if depth is not None:
+                meta['heightDepth'] = {'unitCd': 'in', 'value': '{:.1f}'.format(depth)}
+            element_list.append(meta)
+        return element_list
+
+    # Data
+    # ====
+    def hourly_frame(self, station_triplet, element_cd, depth=None, begin_date=None, end_date=None):
+        """
+        :return: frame of dateTime (station local strings), flag, value for the window
+        """
+        begin_ = max(begin_date or self.begin, self.begin)
+        end_ = min(end_date or self.end, self.end)
+        # whole years are generated from their own seed so any window sees the same values
+        frame_list = [self._year_frame(station_triplet, element_cd, depth, year)
+                      for year in range(begin_.year, end_.year + 1)]
+        frame = pd.concat(frame_list) if frame_list else self._year_frame(station_triplet, element_cd, depth,
+                                                                          begin_.year)
+        in_window = (frame.index >= begin_) & (frame.index <= end_)
+        return frame[in_window].reset_index(drop=True)
+
+    def _year_frame(self, station_triplet, element_cd, depth, year):
+        hours = pd.date_range(datetime.datetime(year, 1, 1), datetime.datetime(year, 12, 31, 23), freq='h')
+        rng = np.random.RandomState(_seed(station_triplet, element_cd, depth, year))
+        mean_, season_, diurnal_, noise_, floor_ = SIGNAL.get(element_cd, (10., 5., 1., 1., None))
+        depth_damp = 1. / (1. + abs(depth or 0.) / 10.)
+        day_ = hours.dayofyear.values
+        hour_ = hours.hour.values
+        value = (mean_ - season_ * np.cos(2 * np.pi * (day_ - 15) / 365.25)
+                 + diurnal_ * depth_damp * np.sin(2 * np.pi * (hour_ - 9) / 24.)
+                 + rng.normal(0., noise_, len(hours)))
+        if floor_ is not None:
+            value = np.maximum(value, floor_)
+        keep = rng.uniform(size=len(hours)) >= self.gap_rate
+        flag = np.where(rng.uniform(size=len(hours)) < self.flag_rate, 'S', 'V')
+        return pd.DataFrame({'dateTime': hours.strftime(DATE_FMT), 'flag': flag, 'value': value.round(1)},
+                            index=hours)[keep]
+
+    def hourly_data(self, station_triplet, element_cd, depth=None, begin_date=None, end_date=None):
+        """
+        :return: getHourlyData-like dict for one station
+        """
+        frame = self.hourly_frame(station_triplet, element_cd, depth=depth, begin_date=begin_date,
+                                  end_date=end_date)
+        return {'beginDate': (frame.dateTime.iloc[0] if len(frame) else None),
+                'endDate': (frame.dateTime.iloc[-1] if len(frame) else None),
+                'stationTriplet': station_triplet,
+                'values': frame.to_dict('records')}
+
+    def period_data(self, station_triplet, element_cd, depth=None, duration='DAILY', begin_date=None,
+                    end_date=None):
+        """
+        :return: getData-like dict for one station: means of the valid hourly values of every
+                 period starting in the window, nil for periods without any
+        """
+        begin_ = max(begin_date or self.begin, self.begin)
+        end_ = min(end_date or self.end, self.end)
+        periods = pd.date_range(begin_, end_, freq=PERIOD_FREQ[duration])
+        if not len(periods):
+            return {'stationTriplet': station_triplet, 'duration': duration, 'values': []}
+        frame = self.hourly_frame(station_triplet, element_cd, depth=depth, begin_date=periods[0],
+                                  end_date=periods[-1] + pd.tseries.frequencies.to_offset(PERIOD_FREQ[duration]))
+        time_ = pd.to_datetime(frame.dateTime, format=DATE_FMT)
+        valid_ = (frame.flag == 'V').values
+        means = frame.value[valid_].groupby(periods[np.searchsorted(periods, time_[valid_], side='right') - 1]).mean()
+        means = means.reindex(periods).round(1)
+        values = [None if np.isnan(value) else float(value) for value in means.values]
+        data_ = {'beginDate': periods[0].strftime(META_DATE_FMT), 'endDate': periods[-1].strftime(META_DATE_FMT),
+                 'duration': duration, 'stationTriplet': station_triplet, 'values': values,
+                 'flags': [None if value is None else 'V' for value in values]}
+        if duration == 'SEMIMONTHLY':
+            data_['collectionDates'] = [None if value is None else date_.strftime('%Y-%m-%d')
+                                        for date_, value in zip(periods, values)]
+        return data_
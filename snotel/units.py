@@ -0,0 +1,124 @@
+''' Unit Conversion
+    ~~~~~~~~~~~~~~~
+    Convert element data from the native AWDB units recorded in
+    elementrecord.ELEMENTS into a target unit system.  Conversions are linear
+    (value * scale + offset) so a whole station frame converts in one
+    vectorized pass over its 2-D value array.
+'''
+
+__author__ = 'nsteiner'
+
+import numpy as np
+import pandas as pd
+
+from .elementrecord import ELEMENTS
+
+NATIVE = 'native'
+UNIT_SYSTEMS = (NATIVE, 'metric', 'si')
+
+# native unit -> {system: (unit, scale, offset)}
+# units missing here (pct, volt, watt/m2, unitless ...) are already SI-compatible and pass through
+CONVERSIONS = {
+    'degF':     {'metric': ('degC', 5. / 9, -32 * 5. / 9), 'si': ('K', 5. / 9, 273.15 - 32 * 5. / 9)},
+    'deg_dayF': {'metric': ('deg_dayC', 5. / 9, 0.), 'si': ('deg_dayK', 5. / 9, 0.)},
+    'in':       {'metric': ('mm', 25.4, 0.), 'si': ('m', 0.0254, 0.)},
+    'ft':       {'metric': ('m', 0.3048, 0.), 'si': ('m', 0.3048, 0.)},
+    'mile':     {'metric': ('km', 1.609344, 0.), 'si': ('m', 1609.344, 0.)},
+    'mph':      {'metric': ('km/h', 1.609344, 0.), 'si': ('m/s', 0.44704, 0.)},
+    'inch_Hg':  {'metric': ('kPa', 3.386389, 0.), 'si': ('Pa', 3386.389, 0.)},
+    'kPa':      {'si': ('Pa', 1000., 0.)},
+    'bar':      {'metric': ('kPa', 100., 0.), 'si': ('Pa', 1.e5, 0.)},
+    'cfs':      {'metric': ('m3/s', 0.028316846592, 0.), 'si': ('m3/s', 0.028316846592, 0.)},
+    'ac_ft':    {'metric': ('m3', 1233.48183754752, 0.), 'si': ('m3', 1233.48183754752, 0.)},
+    'mgram/l':  {'si': ('kg/m3', 1.e-3, 0.)},
+    'gram/l':   {'si': ('kg/m3', 1., 0.)},
+    'umho':     {'metric': ('uS', 1., 0.), 'si': ('S', 1.e-6, 0.)},
+}
+
+
+def check_unit_system(units):
+    units = NATIVE if units is None else units.lower()
+    if units not in UNIT_SYSTEMS:
+        raise ValueError('Unknown unit system {}, choose from {}'.format(units, UNIT_SYSTEMS))
+    return units
+
+
+def element_cd_fromtriplet(element_triplet):
+    """
+    :param element_triplet: element triplet (station:state:network:elementcd:duration:depth) or element code
+    :return: element code
+    """
+    parts = str(element_triplet).split(':')
+    return parts[3] if len(parts) > 3 else parts[0]
+
+
+def native_unit(element_cd):
+    try:
+        return ELEMENTS[element_cd][1]
+    except KeyError:
+        return None
+
+
+def get_conversion(unit, units):
+    """
+
+    :param unit: native unit code, e.g. 'degF'
+    :param units: target unit system
+    :return: (target unit, scale, offset)
+    """
+    units = check_unit_system(units)
+    if units == NATIVE or unit not in CONVERSIONS:
+        return unit, 1., 0.
+    return CONVERSIONS[unit].get(units, (unit, 1., 0.))
+
+
+def get_frame_conversion(columns, units):
+    """
+    Per-column conversion vectors for a frame keyed by element triplets.
+
+    :return: (list of target units, scale array, offset array)
+    """
+    conv = [get_conversion(native_unit(element_cd_fromtriplet(col)), units) for col in columns]
+    if not conv:
+        return [], np.ones(0), np.zeros(0)
+    unit_list, scale, offset = zip(*conv)
+    return list(unit_list), np.array(scale, dtype='double'), np.array(offset, dtype='double')
+
+
+def convert_frame(data_frame, units=NATIVE):
+    """
+    Convert every column of a station frame in one pass.  Unit metadata is attached
+    to the returned frame as data_frame.attrs['units'] ({column: unit}) and
+    data_frame.attrs['unit_system'].
+
+    :param data_frame: frame with element triplet columns, native units
+    :param units: target unit system, one of UNIT_SYSTEMS
+    :return: converted frame (a shallow copy when no conversion is needed)
+    """
+    units = check_unit_system(units)
+    unit_list, scale, offset = get_frame_conversion(data_frame.columns, units)
+    if np.all(scale == 1.) and not np.any(offset):
+        out_frame = data_frame.copy(deep=False)
+    else:
+        values = data_frame.to_numpy(dtype='double', copy=True)
+        np.multiply(values, scale, out=values)
+        np.add(values, offset, out=values)
+        out_frame = pd.DataFrame(values, index=data_frame.index, columns=data_frame.columns)
+    out_frame.attrs['units'] = dict(zip(data_frame.columns, unit_list))
+    out_frame.attrs['unit_system'] = units
+    return out_frame
+
+
+def convert_series(series, element_cd, units=NATIVE):
+    """
+    :param series: element value series, native units
+    :param element_cd: element code or element triplet
+    :return: converted series with series.attrs['units'] set
+    """
+    units = check_unit_system(units)
+    unit, scale, offset = get_conversion(native_unit(element_cd_fromtriplet(element_cd)), units)
+    if scale != 1. or offset:
+        series = series * scale + offset
+    series.attrs['units'] = unit
+    series.attrs['unit_system'] = units
+    return series
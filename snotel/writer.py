@@ -0,0 +1,164 @@
+''' Group Commit Writer
+    ~~~~~~~~~~~~~~~~~~~
+    A single thread owns the write path of a sqlite database.  Producers (pipeline
+    commit stage, update threads, the daemon) submit write functions and wait for
+    their result; the writer drains the queue and runs up to `max_batch` requests
+    in one transaction, so many small writes share one commit (and one fsync).
+
+    If a request fails its group is rolled back and replayed with one transaction
+    per request, so only the failing producer sees the error.
+
+    Every row write of the package goes through snotel.write_transaction: data,
+    stations, elements and the change feed, summaries, journal, lease and cursor
+    rows, and column migrations.  Only table and index creation runs on its own
+    connection, once per process on first use.
+
+        writer = GroupCommitWriter(snotel.ee)
+        writer.write(lambda conn: conn.execute(table.insert().values(rows)))
+'''
+
+__author__ = 'nsteiner'
+
+import os
+import queue
+import logging
+import threading
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH = 256
+WRITE_QUEUE = 1024
+
+
+class WriteRequest(object):
+    """ One write function and its outcome """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class GroupCommitWriter(object):
+    """
+    :param engine: sqlalchemy engine of the database
+    :param max_batch: most requests in one transaction
+    :param max_delay: seconds to wait for more requests once the queue ran empty, 0 commits
+                      whatever is queued right away
+    :param queue_size: bound of the request queue, producers block when it is full
+    """
+
+    def __init__(self, engine, max_batch=WRITE_BATCH, max_delay=0., queue_size=WRITE_QUEUE):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self.n_requests = 0
+        self.n_commits = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<GroupCommitWriter: {} requests in {} commits>'.format(self.n_requests, self.n_commits)
+
+    def start(self):
+        with self._lock:
+            # forked children (process pools, lease workers) start their own thread
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def stop(self):
+        """ Commit what is queued and stop the thread """
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+    def submit(self, fn):
+        """
+        :param fn: fn(connection), run inside the writer's transaction
+        :return: WriteRequest, wait() for the result
+        """
+        self.start()
+        request = WriteRequest(fn)
+        self._queue.put(request)
+        return request
+
+    def write(self, fn):
+        """
+        Run fn(connection) in the next group commit and wait for it.
+
+        :return: result of fn
+        """
+        if threading.current_thread() is self._thread:
+            # a write function writing again: it is already inside the transaction
+            raise RuntimeError('GroupCommitWriter.write called from the writer thread')
+        return self.submit(fn).wait()
+
+    def _next_group(self):
+        request = self._queue.get()
+        if request is None:
+            return None, True
+        group = [request]
+        while len(group) < self.max_batch:
+            try:
+                request = self._queue.get(timeout=self.max_delay) if self.max_delay else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return group, True
+            group.append(request)
+        return group, False
+
+    def _run(self):
+        while True:
+            group, stop = self._next_group()
+            if group:
+                self._commit(group)
+            if stop:
+                return
+
+    def _commit(self, group):
+        metrics.observe('write_group_size', len(group))
+        try:
+            with metrics.timer('db_transaction_seconds', op='group_commit'), self.engine.begin() as conn:
+                results = [request.fn(conn) for request in group]
+        except Exception as e:
+            if len(group) == 1:
+                group[0].error = e
+                group[0].done.set()
+                return
+            logger.warning('Group commit of %s writes failed, replaying them one by one', len(group))
+            self._replay(group)
+            return
+        self.n_commits += 1
+        self.n_requests += len(group)
+        for request, result in zip(group, results):
+            request.result = result
+            request.done.set()
+
+    def _replay(self, group):
+        for request in group:
+            try:
+                with self.engine.begin() as conn:
+                    request.result = request.fn(conn)
+                self.n_commits += 1
+                self.n_requests += 1
+            except Exception as e:
+                request.error = e
+            request.done.set()
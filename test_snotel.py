@@ -1,4 +1,6 @@
+import os
 import sys
+import time
 from snotel import snotel
 import pytest
 
@@ -58,3 +60,403 @@ def test_get_remotestation():
     print('Testing get station')
     snotel.get_element_bystationtriplet(TEST_STATION_TRIPLET, local=False)
 
+
+
+def test_convert_units():
+    print('Testing unit conversion ...')
+    station = snotel.get_station_bytriplet(TEST_STATION_TRIPLET)
+    frame_si = station.get_data_frame(units='si')
+    assert frame_si is station.get_data_frame(units='si')
+    tobs = [col for col in frame_si.columns if ':TOBS:' in col][0]
+    assert frame_si.attrs['units'][tobs] == 'K'
+
+
+def test_utc_time_views():
+    print('Testing UTC storage and local views ...')
+    station = snotel.get_station_bytriplet(TEST_STATION_TRIPLET)
+    frame_int = station.get_data_frame(tz='int')
+    assert frame_int.index.dtype == 'int64'
+    frame_local = station.get_data_frame(tz='local')
+    assert (frame_local.index.tz_convert('UTC') == station.get_data_frame(tz='utc').index).all()
+
+
+def test_plan_updates():
+    print('Testing update plan (dry run) ...')
+    plan = snotel.update_data_bystations([TEST_STATION_TRIPLET], dry_run=True)
+    assert all(item.element.StationTriplet == TEST_STATION_TRIPLET for item in plan)
+
+
+def test_update_pipeline():
+    print('Testing staged update pipeline ...')
+    element_list = snotel.get_element_bystationtriplet(TEST_STATION_TRIPLET, local=True, filters=FILTERS)
+    stats = snotel.update_element_data_list_inpool(element_list, data_format='par')
+    assert not stats['errors']
+
+
+def test_lease_workers():
+    print('Testing sharded update with local worker processes ...')
+    from snotel import lease
+    status = lease.run_local_workers('test-{}'.format(TEST_STATION_TRIPLET), [TEST_STATION_TRIPLET], n_workers=2)
+    assert status == {'done': 1}
+
+
+def test_journal_resume():
+    print('Testing journaled station update and resume ...')
+    from snotel import journal
+    run = 'test-journal'
+    snotel.update_station_list([TEST_STATION_TRIPLET], journal_run=run)
+    assert journal.resume(run) == {'done': 1}
+
+
+def test_daemon_cycle():
+    print('Testing one ingest daemon cycle ...')
+    from snotel.daemon import IngestDaemon
+    daemon = IngestDaemon(station_list=[TEST_STATION_TRIPLET], interval=60)
+    stats = daemon.cycle()
+    assert stats['errors'] == 0
+    assert TEST_STATION_TRIPLET in daemon.lag
+
+
+def test_client_breaker():
+    print('Testing client retries and circuit breaker ...')
+    from snotel.client import AWDBClient, CircuitOpenError
+    bad_client = AWDBClient('http://127.0.0.1:9/wsdl', retries=1, backoff=0.01, breaker_failures=2)
+    with pytest.raises(Exception):
+        bad_client.service.getStations()
+    with pytest.raises(CircuitOpenError):
+        bad_client.service.getStations()
+
+
+def test_breaker_half_open():
+    print('Testing circuit breaker trial call ...')
+    import threading
+    from snotel.client import CircuitBreaker, CircuitOpenError
+    breaker = CircuitBreaker(failures=2, cooldown=0.2)
+    breaker.failure()
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    time.sleep(0.25)
+    breaker.check()
+    # only the trial caller gets through
+    other = []
+    thread = threading.Thread(target=lambda: other.append(breaker.open_for()))
+    thread.start()
+    thread.join()
+    assert other[0] > 0
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    time.sleep(0.25)
+    breaker.check()
+    breaker.success()
+    assert not breaker.is_open
+
+
+def test_call_timeout():
+    print('Testing request volume of hourly and daily calls ...')
+    from snotel.client import request_volume
+    hourly = request_volume('getHourlyData', (), dict(stationTriplets=[TEST_STATION_TRIPLET],
+                                                      beginDate='2020-01-01 00:00', endDate='2020-01-11 00:00'))
+    daily = request_volume('getData', (), dict(stationTriplets=[TEST_STATION_TRIPLET],
+                                               beginDate='2000-01-01', endDate='2020-01-01'))
+    assert hourly == 240
+    assert daily == 7305
+
+
+def test_response_cache():
+    print('Testing metadata response cache ...')
+    hits = snotel.client.cache.hits
+    snotel.get_element_bystationtriplet(TEST_STATION_TRIPLET, local=False)
+    snotel.get_element_bystationtriplet(TEST_STATION_TRIPLET, local=False)
+    assert snotel.client.cache.hits > hits
+
+
+def test_standin():
+    print('Testing update against the local AWDB stand-in ...')
+    from snotel.standin import StandIn
+    from snotel.synthetic import SyntheticNetwork
+    network = SyntheticNetwork(2, years=1)
+    url = snotel.URL
+    with StandIn(network, error_rate=0.05) as standin:
+        snotel.set_service_url(standin.url)
+        try:
+            snotel.update_station_list(network.station_list)
+            snotel.update_stationlist_elements(network.station_list)
+            stats = snotel.run_plan(snotel.plan_updates(station_list=network.station_list))
+        finally:
+            snotel.set_service_url(url)
+    assert not stats['errors']
+    assert standin.n_calls['getHourlyData'] >= len(stats['committed'])
+
+
+def test_benchmark():
+    print('Testing benchmark run on a small synthetic network ...')
+    from snotel import benchmark
+    results = benchmark.run_benchmarks(n_stations=1, years=1, repeat=1,
+                                       names=['parse_data_values', 'write_par', 'get_data_frame'])
+    assert set(results['results']) == {'parse_data_values', 'write_par', 'get_data_frame'}
+    assert results['results']['write_par']['seconds'] > 0
+
+
+def test_metrics():
+    print('Testing metrics of an element update ...')
+    from snotel import metrics
+    metrics.enable()
+    try:
+        element = snotel.find_element(TEST_STATION_TRIPLET, local=True, element_cd='TOBS', depth='min')
+        snotel.update_element_data(element)
+        recorded = metrics.REGISTRY.to_dict()
+    finally:
+        metrics.disable()
+    assert 'awdb_request_seconds' in recorded
+    assert 'rows_written_total' in recorded
+    assert '# TYPE awdb_request_seconds histogram' in metrics.dump(fmt='prometheus')
+
+
+def test_profiling(tmpdir):
+    print('Testing profiled station load ...')
+    from snotel import profiling
+    profiling.enable(1., profile_dir=str(tmpdir))
+    try:
+        station = snotel.get_station_bytriplet(TEST_STATION_TRIPLET)
+        station.get_data_frame()
+    finally:
+        profiling.disable()
+    run_dir = profiling.run_dir()
+    assert (run_dir / 'index.jsonl').exists()
+    assert list(run_dir.glob('*_Station.get_data_frame.prof'))
+
+
+def test_frame_cache():
+    print('Testing byte-bounded frame cache ...')
+    from snotel.framecache import FRAME_CACHE
+    max_bytes = FRAME_CACHE.max_bytes
+    FRAME_CACHE.clear()
+    try:
+        FRAME_CACHE.set_max_bytes(2 * 1024 ** 2)
+        station = snotel.get_station_bytriplet(TEST_STATION_TRIPLET)
+        station.get_data_frame()
+        assert FRAME_CACHE.n_bytes <= FRAME_CACHE.max_bytes
+        hits = FRAME_CACHE.hits
+        snotel.get_station_bytriplet(TEST_STATION_TRIPLET).get_data_frame()
+        assert FRAME_CACHE.hits > hits
+    finally:
+        FRAME_CACHE.set_max_bytes(max_bytes)
+
+
+def test_collection():
+    print('Testing query-defined collection ...')
+    collection = snotel.Collection(station_triplets=[TEST_STATION_TRIPLET], element_cd='STO')
+    assert collection.station_triplets == [TEST_STATION_TRIPLET]
+    station_list = list(collection)
+    assert station_list[0].data_frame is not None
+    assert TEST_STATION_TRIPLET in snotel.Collection(state='AK', network='SCAN')
+
+
+def test_cube(tmpdir):
+    print('Testing chunked cube store ...')
+    import datetime
+    from snotel.cube import CubeStore
+    cube = CubeStore.create(str(tmpdir), [TEST_STATION_TRIPLET], variables=['STO', 'TOBS'],
+                            begin=datetime.datetime(2016, 1, 1), end=datetime.datetime(2016, 12, 31))
+    cube.build()
+    cube.append(end=datetime.datetime(2017, 3, 1))
+    cube = CubeStore(str(tmpdir))
+    data_frame = cube.read_frame('TOBS', begin=datetime.datetime(2017, 1, 1))
+    assert list(data_frame.columns) == [TEST_STATION_TRIPLET]
+    assert cube.chunks_read == 1
+
+
+def test_export(tmpdir):
+    print('Testing streaming export ...')
+    import datetime
+    from snotel.export import export
+    files = export(str(tmpdir / 'csv'), [TEST_STATION_TRIPLET], elements=['TOBS'],
+                   begin_date=datetime.datetime(2016, 1, 1), end_date=datetime.datetime(2016, 3, 1),
+                   daily=('mean', 'std'), chunk_days=30)
+    assert open(str(files[0])).readline().startswith('--HEADERSTART--')
+    files = export(str(tmpdir / 'export.parquet'), [TEST_STATION_TRIPLET], elements=['TOBS'],
+                   begin_date=datetime.datetime(2016, 1, 1), end_date=datetime.datetime(2016, 3, 1), fmt='parquet')
+    assert files[0].exists()
+
+
+def test_query():
+    print('Testing analytical query ...')
+    import datetime
+    from snotel.query import Query
+    query = Query(station_triplets=[TEST_STATION_TRIPLET], element_cd='TOBS', begin_date=datetime.datetime(2016, 1, 1),
+                  end_date=datetime.datetime(2016, 2, 1), bucket='day', group_by=['station_triplet'],
+                  agg=['max', 'mean'])
+    assert 'Files' in query.explain()
+    data_frame = query.to_frame()
+    assert list(data_frame.columns) == ['station_triplet', 'datetime', 'max', 'mean']
+    assert (data_frame['max'] >= data_frame['mean']).all()
+
+
+def test_data_service():
+    print('Testing local data service ...')
+    import json
+    import urllib.request
+    from snotel.service import DataService
+    element = snotel.find_element(TEST_STATION_TRIPLET, element_cd='TOBS')
+    with DataService() as service:
+        url = '{}/elements/{}/daily?begin=2016-01-01&end=2016-02-01'.format(service.url, element.ElementTriplet)
+        response = urllib.request.urlopen(url)
+        assert len(json.loads(response.read())['mean']) == 31
+        request = urllib.request.Request(url, headers={'If-None-Match': response.headers['ETag']})
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request)
+        assert e.value.code == 304
+
+
+def test_change_feed():
+    print('Testing change feed ...')
+    import datetime
+    from snotel.changes import ChangeCursor, latest_offset, read_change
+    cursor = ChangeCursor(since=latest_offset())
+    element = snotel.find_element(TEST_STATION_TRIPLET, element_cd='TOBS')
+    snotel.update_element_data(element, begin_date=datetime.datetime.now() - datetime.timedelta(days=2))
+    change_list = cursor.poll()
+    assert [change.ElementTriplet for change in change_list] == [element.ElementTriplet]
+    assert len(read_change(change_list[0])) == change_list[0].NRows
+    assert cursor.commit() == change_list[0].Offset
+
+
+def test_load_stations():
+    print('Testing bulk station and element loading ...')
+    station_list = snotel.load_stations([TEST_STATION_TRIPLET])
+    assert [station.StationTriplet for station in station_list] == [TEST_STATION_TRIPLET]
+    assert station_list[0].element_list
+    assert all(element.StationTriplet == TEST_STATION_TRIPLET for element in station_list[0].elements)
+    assert TEST_STATION_TRIPLET in snotel.get_station_list_byelement('STO')
+
+
+@pytest.mark.skipif(not os.environ.get('SNOTEL_TEST_DB_URL'), reason='SNOTEL_TEST_DB_URL not set (local postgres)')
+def test_postgres_backend():
+    print('Testing postgres backend and COPY ingest ...')
+    engine_str = snotel.engine_str
+    snotel.set_engine(os.environ['SNOTEL_TEST_DB_URL'])
+    try:
+        snotel.update_station_list([TEST_STATION_TRIPLET])
+        element_list = snotel.get_element_bystationtriplet(TEST_STATION_TRIPLET, local=False, filters=FILTERS)
+        element = [el for el in element_list if el.ElementCd == 'TOBS'][0]
+        snotel.add_element(element)
+        stats = snotel.update_element_data_list_inpool([element], data_format='sql')
+        assert not stats['errors']
+        assert snotel._DATA_PARTITIONS
+        with snotel.session_scope() as session:
+            assert session.query(snotel.Data).filter(snotel.Data.ElementTriplet == element.ElementTriplet).count()
+    finally:
+        snotel.set_engine(engine_str)
+
+
+def test_sqlite_wal():
+    print('Testing sqlite WAL mode and group commits ...')
+    import threading
+    if snotel.writer is None:
+        pytest.skip('sqlite WAL mode not enabled')
+    assert snotel.ee.execute('PRAGMA journal_mode').scalar() == 'wal'
+    element_list = snotel.get_element_bystationtriplet(TEST_STATION_TRIPLET, local=True, filters=FILTERS)
+    n_requests = snotel.writer.n_requests
+    threads = [threading.Thread(target=snotel.add_element_inpool, args=(element,)) for element in element_list * 4]
+    for thread_ in threads:
+        thread_.start()
+    for thread_ in threads:
+        thread_.join()
+    assert snotel.writer.n_requests - n_requests == len(threads)
+    with snotel.read_scope() as session:
+        assert session.query(snotel.Element).filter(snotel.Element.ElementTriplet.in_(
+            [element.ElementTriplet for element in element_list])).count() == len(element_list)
+
+
+def test_element_summary():
+    print('Testing element summary ...')
+    import datetime
+    from snotel import summary
+    element = snotel.find_element(TEST_STATION_TRIPLET, element_cd='TOBS')
+    snotel.update_element_data(element, begin_date=datetime.datetime.now() - datetime.timedelta(days=2))
+    status = summary.status(station_triplets=[TEST_STATION_TRIPLET], element_cd='TOBS')
+    assert element.ElementTriplet in status.index
+    assert status.loc[element.ElementTriplet, 'Count24h'] <= status.loc[element.ElementTriplet, 'Count7d'] <= 168
+    assert element.ElementTriplet not in summary.stale(24 * 365, station_triplets=[TEST_STATION_TRIPLET]).index
+    summary.rebuild_summary([element.ElementTriplet])
+    assert summary.coverage([element.ElementTriplet]).max().max() <= 1.
+
+
+def test_daily_ingest():
+    print('Testing daily element ingest against the local AWDB stand-in ...')
+    from snotel.standin import StandIn
+    from snotel.synthetic import SyntheticNetwork
+    network = SyntheticNetwork(1, years=1, elements=[('TOBS', None)], durations=('HOURLY', 'DAILY'))
+    url = snotel.URL
+    with StandIn(network) as standin:
+        snotel.set_service_url(standin.url)
+        snotel.set_durations(['HOURLY', 'DAILY'])
+        try:
+            snotel.update_station_list(network.station_list)
+            snotel.update_stationlist_elements(network.station_list)
+            stats = snotel.run_plan(snotel.plan_updates(station_list=network.station_list))
+            element_list = snotel.get_element_bystationtriplet(network.station_list[0], local=True, filters=None)
+        finally:
+            snotel.set_durations(['HOURLY'])
+            snotel.set_service_url(url)
+    assert not stats['errors']
+    assert standin.n_calls['getData'] >= 1
+    element = [element for element in element_list if element.Duration == 'DAILY'][0]
+    assert element.par_files and all(path.parent.name == 'daily' for path in element.par_files)
+    assert element.data_frame.shape[0] > 200
+
+
+def test_daily_load():
+    print('Testing daily station load from the daily elements ...')
+    from snotel.standin import StandIn
+    from snotel.synthetic import SyntheticNetwork
+    network = SyntheticNetwork(1, years=1, elements=[('TOBS', None)], durations=('HOURLY', 'DAILY'))
+    url = snotel.URL
+    with StandIn(network) as standin:
+        snotel.set_service_url(standin.url)
+        snotel.set_durations(['HOURLY', 'DAILY'])
+        try:
+            snotel.update_station_list(network.station_list)
+            snotel.update_stationlist_elements(network.station_list)
+            snotel.run_plan(snotel.plan_updates(station_list=network.station_list))
+            station = snotel.get_station_bytriplet(network.station_list[0])
+            daily_frame = station.get_data_frame(frequency='D')
+            hourly_frame = station.get_data_frame(frequency='h')
+        finally:
+            snotel.set_durations(['HOURLY'])
+            snotel.set_service_url(url)
+    # other sensors of the station may only be stored hourly
+    assert [column.split(':')[4] for column in daily_frame.columns if ':TOBS:' in column] == ['DAILY']
+    assert [column.split(':')[4] for column in hourly_frame.columns if ':TOBS:' in column] == ['HOURLY']
+    assert hourly_frame.filter(like=':TOBS:').count().iloc[0] > 20 * daily_frame.filter(like=':TOBS:').count().iloc[0]
+
+
+def test_data_utc_migration(tmpdir):
+    print('Testing TimeUTC migration of a data table made before UTC storage ...')
+    import sqlite3
+    import datetime
+    import pandas as pd
+    from snotel.export import read_element_window
+    path = str(tmpdir.join('old.sqlite'))
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE data ("ElementTriplet" VARCHAR NOT NULL, "StationTriplet" VARCHAR, '
+                 '"DateTime" DATETIME NOT NULL, "Flag" VARCHAR(1), "Value" FLOAT, '
+                 'PRIMARY KEY ("ElementTriplet", "DateTime"))')
+    conn.execute("INSERT INTO data VALUES ('{}', '{}', '2020-01-01 05:00:00.000000', 'V', 1.5)".format(
+        TEST_STATION_TRIPLET + ':TOBS:HOURLY:None', TEST_STATION_TRIPLET))
+    conn.commit()
+    conn.close()
+    engine_str = snotel.engine_str
+    snotel.set_engine('sqlite:///' + path)
+    try:
+        snotel.metadata.create_all()
+        element = snotel.Element(ElementTriplet=TEST_STATION_TRIPLET + ':TOBS:HOURLY:None',
+                                 StationTriplet=TEST_STATION_TRIPLET)
+        snotel.add_data([(element.ElementTriplet, element.StationTriplet, datetime.datetime(2020, 1, 2),
+                          'V', 2., int(pd.Timestamp('2020-01-02 09:00').value))])
+        element_data = read_element_window(element, 0, int(pd.Timestamp('2030-01-01').value), data_format='sql')
+    finally:
+        snotel.set_engine(engine_str)
+    assert element_data.value.tolist() == [1.5, 2.]